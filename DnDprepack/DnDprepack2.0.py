@@ -8,16 +8,22 @@ Created by L. I. Menzies 2022-04-13
 Last modified by L. I. Menzies 2024-06-17
 """
 
-import csv, time, sys
+import csv, time, sys, traceback
 import tkinter as tk
 from os import getcwd, getenv, listdir, mkdir, path, remove
 from platform import system
 from re import compile, match
-from shutil import copy2, rmtree
+from shutil import rmtree
 from tkinter import *
-from tkinter import messagebox
+from tkinter import messagebox as tk_messagebox
 from tkinter.filedialog import askopenfilename, askdirectory
 
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'SIPmaker'))
+from iohints import copy_file
+from progress import Cancelled
+from tkprogress import BackgroundRun, MainThread
+from walker import scan_dir
+
 """ Global color definitions, w/ official UAB RGB values """
 uabgreen = '#%02x%02x%02x' % (30, 107, 82)
 dragongreen = '#%02x%02x%02x' % (20, 75, 57)
@@ -30,8 +36,18 @@ gray = '#%02x%02x%02x' % (215, 210, 203)
 """ Global Variable for User OS"""
 USER_OS = system()
 
+""" Global Variable for page cache hints while copying files: 'off', 'sequential', or 'stream' to also drop what was copied, for shared servers (see SIPmaker/iohints.py) """
+COPY_IO_HINTS = 'sequential'
+
+""" Dialogs that are safe to show from the worker thread """
+messagebox = MainThread(tk_messagebox)
+
+
 class GetValues:
     def __init__(self, root):
+        self.root = root
+        # The BackgroundRun of the actions, while they are running
+        self.running = None
         frame001 = Frame(root)
         labl000 = Label(frame001, text='DnD\nPre-Packer')
         labl000.configure(fg='black', bg=gray, bd=0, font=('Arial', 10), height=3, width=20, relief=SUNKEN, justify=CENTER)
@@ -115,9 +131,9 @@ class GetValues:
         space = Label(frame003, text='')
         space.configure(fg=uabgreen, bg=uabgreen, highlightbackground='black', bd=0, font=('Arial', 8))
         space.grid(column=1, row=0, pady=0, padx=235, sticky=NSEW)
-        submit = Button(frame003, text='Submit', command=self.run_procs)
-        submit.configure(fg='black', bg=gray, highlightbackground='white', font=('Arial', 11))
-        submit.grid(column=2, row=0, pady=5, padx=5, sticky=E)
+        self.submit = Button(frame003, text='Submit', command=self.run_procs)
+        self.submit.configure(fg='black', bg=gray, highlightbackground='white', font=('Arial', 11))
+        self.submit.grid(column=2, row=0, pady=5, padx=5, sticky=E)
         frame003.configure(bg=uabgreen, highlightbackground='black', bd=5, relief=RAISED)
         frame003.grid(column=0, row=2, pady=0, padx=0, sticky=NSEW)
 
@@ -152,7 +168,8 @@ class GetValues:
         malformed file name it notifies the User which filename caused the error
         and returns False.
         """
-        for filename in listdir(chk_folder):
+        for entry in scan_dir(chk_folder):
+            filename = entry.name
             # Checks file names, ignores folder names and hidden files
             if not path.splitext(filename)[1] == '' and not filename.startswith('.'):
                 pattern = r"^[A-Z][A-Z][A-Z][A-Z]_[A-Z][A-Z][A-Z][0-9][0-9][0-9][0-9][0-9][0-9]_[0-9][0-9][0-9][0-9][a|b]"
@@ -162,11 +179,10 @@ class GetValues:
                     return False
         return True
 
-    def collate_files(self):
+    def collate_files(self, info, progress):
         ignored_files = []
         total_files = 0
         included_files = 0
-        info = self.get_entries()
         in_dir = info[0]
         good_filenames = False
         good_filenames = self.check_filenames(in_dir)
@@ -181,11 +197,18 @@ class GetValues:
             except:
                 messagebox.showwarning(message=f'There was an error creating the \'ready_to_package\' folder.')
                 return False
-        for files in listdir(in_dir):
+        accepted_files = ['.tif', '.pdf', '.xml', '.txt', '.jpg', '.iso', '.jp2', '.wav', '.mp4', '.mkv', '.mp3', '.csv']
+        listing = scan_dir(in_dir)
+        to_copy = [entry for entry in listing
+                   if path.splitext(entry.name)[1] in accepted_files and not entry.name.startswith('.')]
+        progress.start('Collating files', len(to_copy), sum(entry.stat().st_size for entry in to_copy))
+        for entry in listing:
+            # Cancelling stops between files, never part way through a copy
+            progress.check()
+            files = entry.name
             # ignore directories/ folders
             if not path.splitext(files)[1] == '':
                 total_files += 1
-            accepted_files = ['.tif', '.pdf', '.xml', '.txt', '.jpg', '.iso', '.jp2', '.wav', '.mp4', '.mkv', '.mp3', '.csv']
             # script only accepts file formats of the proper type that do not begin with '.'
             if path.splitext(files)[1] not in accepted_files or files.startswith('.'):
                 if not path.splitext(files)[1] == '' and not files.startswith('.'):
@@ -211,31 +234,31 @@ class GetValues:
                 if files[-5] == 'a':
                     newfilepath = path.join(itemfolder, files)
                     try:
-                        copy2(oldfilepath, newfilepath)
+                        copy_file(oldfilepath, newfilepath, COPY_IO_HINTS)
                     except:
                         messagebox.showwarning(message=f'There was an error copying:\n{files}')
                 elif files[-5] == 'b':
                     newfilepath = path.join(itemfolder, files)
                     try:
-                        copy2(oldfilepath, newfilepath)
+                        copy_file(oldfilepath, newfilepath, COPY_IO_HINTS)
                     except:
                         messagebox.showwarning(message=f'There was an error copying:\n{files}')
                 else:
                     messagebox.showwarning(message=f'The filename {files} does not \nend in \'a\' or \'b\'.\nSkipping it...')
+                progress.advance(1, entry.stat().st_size)
         messagebox.showinfo(message=f'Found {total_files} total files.\nCollated {included_files} files.\nIgnored the following:\n{ignored_files}')
         return True
 
     def check_ids(self, checkdir):
-        for folder_id in listdir(checkdir):
-            id_path = path.join(checkdir, folder_id)
-            if path.isdir(id_path):
+        for entry in scan_dir(checkdir):
+            folder_id = entry.name
+            if entry.is_dir():
                 pattern = r"^[A-Z][A-Z][A-Z][A-Z]_[A-Z][A-Z][A-Z][0-9][0-9][0-9][0-9][0-9][0-9]"
                 if not match(pattern, folder_id):
                     return False
         return True
 
-    def make_csv(self):
-        csv_info = self.get_entries()
+    def make_csv(self, csv_info):
         proc_dir = csv_info[1]
         ownBy = csv_info[2]
         collection = csv_info[3]
@@ -273,12 +296,10 @@ class GetValues:
         colnames = ['System UUID', 'Local ID', 'Responsible Org', 'Collection', 'Item Type', 'Packaged By']
         writer = csv.writer(newCSV)
         writer.writerow(colnames)
-        flist = listdir(obj_dir)
-        sorted_flist = sorted(flist)
         numfolders = 0
-        for dirs in sorted_flist:
-            fpath = path.join(obj_dir, dirs)
-            if path.isdir(fpath):
+        for entry in scan_dir(obj_dir):
+            dirs = entry.name
+            if entry.is_dir():
                 newrow = ['unknown', 'unknown', 'unknown', 'unknown', 'unknown', 'unknown']
                 newrow[0] = dirs
                 newrow[1] = ''
@@ -293,16 +314,39 @@ class GetValues:
         return True
 
     def run_procs(self):
-        successful = False
+        """ Starts the selected actions on a worker thread, so the window keeps responding """
+        if self.running is not None:
+            return
+        info = self.get_entries()
         collate_yesno = self.collatevar.get()
         csv_yesno = self.csvvar.get()
+        self.submit.configure(state=DISABLED)
+        self.running = BackgroundRun(self.root, 'DnD Pre-Packer Progress',
+                                     lambda progress: self.run_actions(info, collate_yesno, csv_yesno, progress),
+                                     self.actions_done)
+
+    def actions_done(self, result, error):
+        """ Back on the main thread once the worker has stopped """
+        self.running = None
+        self.submit.configure(state=NORMAL)
+        if isinstance(error, SystemExit):
+            sys.exit()
+        if isinstance(error, Cancelled):
+            messagebox.showinfo(message=f'Cancelled.\nFiles collated so far are\nin \'ready_to_package\'.')
+        elif error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            messagebox.showwarning(message=f'Stopped by an error:\n{error}')
+
+    def run_actions(self, info, collate_yesno, csv_yesno, progress):
+        """ Runs on the worker thread """
+        successful = False
         if collate_yesno == 1:
-            successful = self.collate_files()
+            successful = self.collate_files(info, progress)
             if successful == False:
                 messagebox.showwarning(message=f'Something went wrong during\ncollation. Quitting.')
                 sys.exit()
         if csv_yesno == 1:
-            successful = self.make_csv()
+            successful = self.make_csv(info)
             if successful == False:
                 messagebox.showwarning(message=f'Something went wrong during\nCSV Generation. Quitting.')
                 sys.exit()
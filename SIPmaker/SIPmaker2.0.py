@@ -19,17 +19,21 @@ or contact L. I. Menzies = menziesluke (at) gmail (dot) com
 ====================================================================
 """
 
-import bagit, bagit_profile, csv, hashlib, io, math, mimetypes, sys, tarfile, time, uuid
+import csv, sys, traceback
 import tkinter as tk
-from os import getcwd, getenv, listdir, mkdir, path, remove, rename, stat, walk
+from multiprocessing import freeze_support
+from os import getenv, path
 from platform import system
-from time import localtime, strftime
-from tkinter import messagebox, Button, Entry, Label, Checkbutton, Frame, Toplevel, OptionMenu, Radiobutton, Text, Scrollbar, StringVar, IntVar
-from tkinter.filedialog import askdirectory, askopenfilename
-from PIL import Image, ImageTk
-from rdflib import URIRef, Graph, BNode, Literal
-from rdflib.namespace import *
-from shutil import copytree, move, rmtree
+from tkinter import filedialog as tk_filedialog, messagebox as tk_messagebox
+from tkinter import Button, Entry, Label, Checkbutton, Frame, Toplevel, OptionMenu, Radiobutton, Text, Scrollbar, StringVar, IntVar
+from fixity import CACHE_MB
+from tarring import TAR_WORKERS
+from inventory import DEFAULT_WORKERS
+from iohints import IO_HINTS
+from pipeline import STAGES, SIPPipeline, StopBatch
+from progress import Cancelled
+from scheduler import run_pipelined
+from tkprogress import BackgroundRun, MainThread
 
 """ Global color definitions, w/ official UAB RGB values """
 uabgreen = '#%02x%02x%02x' % (30, 107, 82)
@@ -43,12 +47,58 @@ gray = '#%02x%02x%02x' % (215, 210, 203)
 """ Global Variable for User OS"""
 USER_OS = system()
 
+""" Global Variables for the inventory worker pool ('thread' or 'process') """
+INVENTORY_WORKERS = DEFAULT_WORKERS
+INVENTORY_POOL = 'thread'
+
+""" Global Variable for the size limit of the fixity cache in the Processing Folder """
+FIXITY_CACHE_MB = CACHE_MB
+
+""" Global Variables for APTrust bag validation: 'structural', 'tags' or 'full', and the % of files rehashed by 'full' """
+APT_VALIDATION = 'tags'
+APT_SAMPLE_PCT = 100
+
+""" Global Variable for tarring: only one archive at a time reading or writing each volume """
+TAR_ONE_PER_DEVICE = False
+
+""" Global Variable for tar compression: 'none', 'gzip' (parallel, pigz-compatible) or 'zstd' """
+TAR_COMPRESSION = 'none'
+
+""" Global Variable for the folders listed at once while walking objects (helps on SMB/NFS shares); 0 lists them one by one """
+LIST_THREADS = 8
+
+""" Global Variable for updating an existing 'manifest.csv' (rehashing only new and changed files) instead of skipping the object """
+UPDATE_MANIFESTS = False
+
+""" Global Variable for page cache hints while hashing: 'off', 'sequential' (read-ahead) or 'stream' (also drop what was read; for shared servers) """
+HASH_IO_HINTS = IO_HINTS
+
+""" Global Variable for running objects through the actions independently, when not prompting after each action """
+PIPELINED = True
+
 def resource_path(relative_path):
     """ Fixes the problem with PyInstaller not hooking associated files """
     base_path = getattr(sys, '_MEIPASS', path.dirname(path.abspath(__file__)))
     return path.join(base_path, 'data', relative_path)
 
 
+""" Dialogs that are safe to show from the worker thread """
+messagebox = MainThread(tk_messagebox)
+filedialog = MainThread(tk_filedialog)
+
+
+class DialogPrompter:
+    """ Asks the pipeline's questions with message boxes """
+    def ask(self, key, message):
+        return messagebox.askyesno(message=message)
+
+    def warn(self, message):
+        messagebox.showwarning(message=message)
+
+    def info(self, message):
+        messagebox.showinfo(message=message)
+
+
 class ToggleFrame(Frame):
     """ Creates a toggle frame for optional functions """
     def __init__(self, parent):
@@ -121,6 +171,11 @@ class ToggleFrame(Frame):
         trans_chk = Checkbutton(self.sub_frame, text='Transfer\nManifest', variable=self.transvar, fg='black',
                                 bg=smoke, relief='flat', highlightbackground=dragongreen, bd=4, font=('Arial', basefont), justify='left')
         trans_chk.grid(column=6, row=0, pady=5, padx=xpad)
+        # Force Rehash ignores digests cached from earlier runs (but still refreshes the cache)
+        self.rehashvar = IntVar(self)
+        rehash_chk = Checkbutton(self.sub_frame, text='Force\nRehash', variable=self.rehashvar, fg='black',
+                                bg=smoke, relief='flat', highlightbackground=dragongreen, bd=4, font=('Arial', basefont), justify='left')
+        rehash_chk.grid(column=7, row=0, pady=5, padx=xpad)
         # Set defaults to "checked"
         self.prebagvar.set(1)
         self.metavar.set(1)
@@ -128,6 +183,7 @@ class ToggleFrame(Frame):
         self.bagitvar.set(1)
         self.tarvar.set(1)
         self.transvar.set(1)
+        self.rehashvar.set(0)
         #
         self.sub_frame.configure(bd=2, bg=dragongreen, relief='raised')
         self.show_frame.configure(bd=2, bg=dragongreen, relief='flat')
@@ -151,8 +207,13 @@ class ObjFormatter:
         basefont = 10
         entryfont = 11
         buttonpad = 220
+        self.pipeline = SIPPipeline(DialogPrompter(), 'Glacier-Deep-OH', INVENTORY_WORKERS, INVENTORY_POOL,
+                                    APT_VALIDATION, APT_SAMPLE_PCT, TAR_WORKERS, TAR_ONE_PER_DEVICE, TAR_COMPRESSION,
+                                    LIST_THREADS, UPDATE_MANIFESTS, HASH_IO_HINTS)
 
         def load_image(imgname):
+            # PIL is only needed for the logo, so it is loaded here rather than at start-up
+            from PIL import Image, ImageTk
             imgpath = resource_path(imgname)
             openimg = Image.open(imgpath)
             return ImageTk.PhotoImage(openimg)
@@ -233,9 +294,11 @@ class ObjFormatter:
         instruct = Button(frame3, text='Instructions', command=lambda: instructions(basefont))
         instruct.configure(bg=gray, fg='black', highlightbackground=uabgreen, font=('Arial', entryfont))
         instruct.grid(column=1, row=0, pady=5, padx=buttonpad, sticky='e')
-        submit1 = Button(frame3, text='Submit', command=lambda: self.run_procs(root, frame2))
-        submit1.configure(bg=gray, fg='black', highlightbackground=uabgreen, font=('Arial', entryfont))
-        submit1.grid(column=2, row=0, pady=5, padx=xpadd, sticky='e')
+        self.submit1 = Button(frame3, text='Submit', command=lambda: self.run_procs(root, frame2))
+        self.submit1.configure(bg=gray, fg='black', highlightbackground=uabgreen, font=('Arial', entryfont))
+        self.submit1.grid(column=2, row=0, pady=5, padx=xpadd, sticky='e')
+        # The BackgroundRun of the actions, while they are running
+        self.running = None
         frame3.configure(bg=uabgreen, bd=5, relief='raised')
         frame3.grid(column=0, row=3, pady=0, padx=0, sticky='nsew')
 
@@ -249,12 +312,12 @@ class ObjFormatter:
 
     def ask_folder(self, foname):
         startfolder1 = self.user_home()
-        foname.set(path.abspath(askdirectory(initialdir=startfolder1, title='Select the Folder')))
+        foname.set(path.abspath(filedialog.askdirectory(initialdir=startfolder1, title='Select the Folder')))
         return foname
 
     def ask_file(self, fname):
         startfolder2 = self.user_home()
-        fname.set(path.abspath(askopenfilename(initialdir=startfolder2, title='Select the master CSV File')))
+        fname.set(path.abspath(filedialog.askopenfilename(initialdir=startfolder2, title='Select the master CSV File')))
         return fname
 
     def pre_bag(self, root, packdir, moreopts1):
@@ -262,24 +325,7 @@ class ObjFormatter:
         Preserves departmental folder structure during Bagging by moving
         object contents into a subdirectory named with the local object ID
         """
-        numitems = 0
-        # put all directories into a list and sort the list
-        sorted_objectlist = sorted([f for f in listdir(packdir) if len(f.split('.')) == 1])
-        for item in sorted_objectlist:
-            oldpath = path.join(packdir, item)
-            bagpath = path.join(oldpath, 'data')
-            if path.exists(bagpath):
-                stopall = messagebox.askyesno(
-                            message=f'It looks like {item} is a bag. Quit SIPmaker?')
-                if stopall == True:
-                    sys.exit()
-            newpath = path.join(oldpath, item)
-            if not path.exists(newpath):
-                numitems += 1
-                temppath = path.join(packdir, f'tempdir{numitems}')
-                mkdir(temppath)
-                move(oldpath, temppath)
-                rename(temppath, oldpath)
+        numitems = self.pipeline.pre_bag(packdir)
         if not moreopts1 == 0:
             if self.prompting == 0:
                 runnext1 = True
@@ -306,78 +352,15 @@ class ObjFormatter:
         for headr in opts:
             menu.add_command(label=headr, command=lambda idcolumn=headr: self.variable.set(idcolumn))
 
-    def meta_from_csv(self, csvIn, locids, fpath):
-        nfiles = 0
-        rfiles = 0
-        overwrite_all = False
-        firstone = True
-        with open(csvIn, 'r', encoding='UTF-8') as incsv:
-            reader = csv.DictReader(incsv)
-            headers = reader.fieldnames
-            verifyHeadrs = ['System UUID', 'Local ID', 'Responsible Org', 'Collection', 'Item Type', 'Packaged By']
-            if not headers == verifyHeadrs:
-                messagebox.showwarning(message="Your input CSV contains headers\nthat differ from what is expected.\n\nQuitting action.")
-                return [0, 0]
-            for row in reader:
-                skip1 = False
-                foldname = row['%s' % locids]
-                foldpath = path.join(fpath, foldname)
-                # Check if Local ID is blank
-                if row['Local ID'].strip() == '':
-                    skip1 = True
-                    discontinue = messagebox.askyesno(
-                        message=f"Item \'{foldname}\' has no Local ID.\nDo you want to quit SIPmaker?")
-                    if discontinue == True:
-                        sys.exit()
-                if not path.exists(foldpath):
-                    skip1 = True
-                # The function skips objects that are Bags or already have a
-                # 'metadata.csv' file. Thus it skips creating a 'metadata.xml'
-                # for these objects also.
-                if path.exists(path.join(foldpath, 'data')):
-                    skip1 = messagebox.askyesno(
-                        message=f"It appears that \'{foldname}\' is a bag.\n\nSkip creating \'metadata.csv\' for this one item?")
-                if path.exists(path.join(foldpath, 'metadata.csv')) and firstone == True:
-                    firstone = False
-                    overwrite_all = messagebox.askyesno(
-                        message="At least one \'metadata.csv\' already\nexists. Overwrite ALL of them?")
-                if path.exists(path.join(foldpath, 'metadata.csv')) and overwrite_all == False:
-                    skip1 = True
-                if skip1 == False:
-                    metafile = path.join(foldpath, 'metadata.csv')
-                    if USER_OS == 'Windows':
-                        with open(metafile, 'w', newline='', encoding='UTF-8') as newmeta:
-                            metawriter = csv.DictWriter(newmeta, fieldnames=headers)
-                            metawriter.writeheader()
-                            metawriter.writerow(row)
-                    else:
-                        with open(metafile, 'w', encoding='UTF-8') as newmeta:
-                            metawriter = csv.DictWriter(newmeta, fieldnames=headers)
-                            metawriter.writeheader()
-                            metawriter.writerow(row)
-                    nfiles += 1
-                    newmeta.close()
-                    rdfok = False
-                    # rdfok = self.make_rdf(metafile)
-                    if rdfok == True:
-                        rfiles += 1
-        return [nfiles, rfiles]
-
     def create_meta(self, folderpath, myfile, idcolname, moreopts2):
         """
         Generates minimal metadata files, 'metadata.csv' and 'metadata.xml'
         based on a master CSV or a METS xml file
         """
-        sourcetype = 'csv'  # default
-        counts = [0, 0]  # default
-        if path.splitext(myfile)[1] == '.csv':
-            sourcetype = 'csv'
-        else:
-            messagebox.showwarning(message="The metadata source file must be CSV.\nQuitting action.")
+        counts = self.pipeline.create_meta(folderpath, myfile, idcolname)
+        if counts is None:
             runnext2 = False
             return runnext2
-        if sourcetype == 'csv':
-            counts = self.meta_from_csv(myfile, idcolname, folderpath)
         if not moreopts2 == 0:
             if self.prompting == 0:
                 runnext2 = True
@@ -389,136 +372,11 @@ class ObjFormatter:
                 message=f'Created {counts[0]} \'metadata.csv\' and {counts[1]} \'metadata.xml\' files.')
         return runnext2
 
-    def md5hash(self, finame):
-        """ Generates MD5 hashes """
-        hash_md5 = hashlib.md5()
-        with open(finame, "rb") as md5file:
-            for chunk in iter(lambda: md5file.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-
-    def sha256hash(self, filnam):
-        """ Generates SHA256 hashes """
-        chunksize = io.DEFAULT_BUFFER_SIZE
-        hash_sha256 = hashlib.sha256()
-        with open(filnam, "rb") as sha256file:
-            for chunk in iter(lambda: sha256file.read(chunksize), b""):
-                hash_sha256.update(chunk)
-        return hash_sha256.hexdigest()
-
-    def sha3hash(self, filname):
-        """ Generates SHA3-256 hashes """
-        chunksize = io.DEFAULT_BUFFER_SIZE
-        hash_sha3 = hashlib.sha3_256()
-        with open(filname, "rb") as sha3file:
-            for chunks in iter(lambda: sha3file.read(chunksize), b""):
-                hash_sha3.update(chunks)
-        return hash_sha3.hexdigest()
-
-    def convert_size(self, size):
-        """ Converts bytes to human readable denominations """
-        if (size == 0):
-            return '0B'
-        # size_name = ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB")
-        # i = int(math.floor(math.log(size,1024)))
-        # p = math.pow(1024,i)
-        size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-        i = int(math.floor(math.log(size, 1000)))
-        p = math.pow(1000, i)
-        s = round(size / p, 2)
-        return '%s%s' % (s, size_name[i])
-
     def run_inventory(self, objectsdir, moreopts3):
         """
         Runs an inventory and generates 'manifest.csv' files for each object
         """
-        manifiles = 0
-        # sort the list of files and folders, so it iterates through in order
-        sorted_objectsdir = sorted(listdir(objectsdir))
-        for obj in sorted_objectsdir:
-            objpath = path.join(objectsdir, obj)
-            walkpath = path.join(objpath, obj)
-            skipit = False
-            counter = 0
-            if not path.isdir(objpath):
-                skipit = True
-            elif path.isdir(objpath):
-                if path.exists(path.join(objpath, 'data')):
-                    isabag = messagebox.askyesno(message=f'It appears that \'{obj}\' is a bag.\nSkip this object?')
-                    if isabag == True:
-                        skipit = True
-                if path.exists(path.join(objpath, 'manifest.csv')):
-                    skipit = True
-                    messagebox.showwarning(
-                        message=f"The file \'manifest.csv\' already exists.\nSkipping inventory of the object: \n{obj}")
-            if skipit == False:
-                manifiles += 1
-                temp_path = path.join(objpath, 'temp_manifest.csv')
-                if USER_OS == 'Windows':
-                    tempmani = open(temp_path, 'w', newline='', encoding='UTF-8')
-                else:
-                    tempmani = open(temp_path, 'w', encoding='UTF-8')
-                temp_writer = csv.writer(tempmani)
-                headrow = ['Filename', 'Relative Path', 'Filesize', 'Filetype', 'C-Time', 'Modified', 'Accessed',
-                            'MD5', 'SHA256', 'ChecksumDateTime', 'mode', 'inode',
-                            'device', 'enlink', 'user', 'group']
-                temp_writer.writerow(headrow)
-                for base, dirs, files in walk(walkpath):
-                    for name in files:
-                        filepathname = path.join(base, name)
-                        # Deletes .DS_Store Files
-                        if name == '.DS_Store':
-                            remove(filepathname)
-                        # elif not path.basename(filepathname) == '.DS_Store':
-                        # Ignores files that begin with '.'
-                        elif not name == '.DS_Store' and not name.startswith('.'):
-                            counter += 1
-                            rownum = str(counter)
-                            statinfo = stat(filepathname)
-                            filectime = time.strftime("%Y.%m.%d %H:%M:%S", time.localtime(statinfo.st_ctime))
-                            # note: on a Windows system, ctime is "date created" but on Unix it is
-                            # "change time", i.e. the last time the metadata was changed.
-                            modifdate = time.strftime("%Y.%m.%d %H:%M:%S", time.localtime(statinfo.st_mtime))
-                            accessdate = time.strftime("%Y.%m.%d %H:%M:%S", time.localtime(statinfo.st_atime))
-                            filesize = statinfo[6]
-                            csize = self.convert_size(filesize)
-                            filemime = str(mimetypes.guess_type(filepathname)[0])
-                            md5sum = self.md5hash(filepathname)
-                            sha256sum = self.sha256hash(filepathname)
-                            runtime = time.strftime("%Y.%m.%d %H:%M:%S")
-                            filemode = str(statinfo.st_mode)
-                            fileino = str(statinfo.st_ino)
-                            filedevice = str(statinfo.st_dev)
-                            filenlink = str(statinfo.st_nlink)
-                            fileuser = str(statinfo.st_uid)
-                            filegroup = str(statinfo.st_gid)
-                            # Displays a shortened Path for each file, excluding the directories
-                            # that precede the working directory that contains the objects.
-                            showpath = path.relpath(filepathname, objpath)
-                            newrow = [name, showpath, csize, filemime, filectime, modifdate, accessdate,
-                                        md5sum, sha256sum, runtime, filemode, fileino, filedevice,
-                                        filenlink, fileuser, filegroup]
-                            temp_writer.writerow(newrow)
-                tempmani.close()
-                # Sort the temporary manifest just created by Relative Path
-                with open(temp_path, 'r', encoding='UTF-8') as unsorted_csv:
-                    unsort_reader = csv.DictReader(unsorted_csv)
-                    sorted_list = sorted(unsort_reader, key=lambda row:(row['Relative Path']), reverse=False)
-                m = path.join(objpath, 'manifest.csv')
-                if USER_OS == 'Windows':
-                    with open(m, 'w', newline='', encoding='UTF-8') as manifest:
-                        mwriter = csv.DictWriter(manifest, fieldnames=headrow)
-                        mwriter.writeheader()
-                        for sortrow in sorted_list:
-                            mwriter.writerow(sortrow)
-                else:
-                    with open(m, 'w', encoding='UTF-8') as manifest:
-                        mwriter = csv.DictWriter(manifest, fieldnames=headrow)
-                        mwriter.writeheader()
-                        for sortrow in sorted_list:
-                            mwriter.writerow(sortrow)
-                if path.exists(m):
-                    remove(temp_path)
+        manifiles = self.pipeline.run_inventory(objectsdir)
         if not moreopts3 == 0:
             if self.prompting == 0:
                 runnext3 = True
@@ -530,82 +388,14 @@ class ObjFormatter:
             messagebox.showwarning(message=f"Created {manifiles} \'manifest.csv\' files.")
         return runnext3
 
-    def make_valid_apt_bag(self, bpath, storage):
-        bagname = path.basename(bpath)
-        aptrust_path = path.join(bpath, 'aptrust-info.txt')
-        tags_md5_path = path.join(bpath, 'tagmanifest-md5.txt')
-        tags_sha256_path = path.join(bpath, 'tagmanifest-sha256.txt')
-        md5tags_temppath = path.join(bpath, 'tagmanifest-md5-temp.txt')
-        sha256tags_temppath = path.join(bpath, 'tagmanifest-sha256-temp.txt')
-        # Create the aptrust-info.txt file
-        with open(aptrust_path, 'w') as apt_info:
-            apt_info.write(f'Access: Institution\nDescription: University of Alabama at Birmingham\nStorage-Option: {storage}\nTitle: {bagname}\n')
-        firstrow_md5 = f'{self.md5hash(aptrust_path)} aptrust-info.txt\n'
-        firstrow_sha256 = f'{self.sha256hash(aptrust_path)} aptrust-info.txt\n'
-        # Rewrite the two tagmanifest files to include hashes for aptrust-info.txt
-        with open(tags_md5_path, 'r') as md5tags:
-            with open(md5tags_temppath, 'w') as md5tags_temp:
-                md5tags_temp.write(firstrow_md5)
-                for chars in md5tags.read():
-                    md5tags_temp.write(chars)
-        with open(tags_sha256_path, 'r') as sha256tags:
-            with open(sha256tags_temppath, 'w') as sha256tags_temp:
-                sha256tags_temp.write(firstrow_sha256)
-                for chars in sha256tags.read():
-                    sha256tags_temp.write(chars)
-        remove(tags_md5_path)
-        remove(tags_sha256_path)
-        rename(md5tags_temppath, tags_md5_path)
-        rename(sha256tags_temppath, tags_sha256_path)
-        """# Validate bag
-        bag = bagit.Bag(bpath)
-        profile = bagit_profile.Profile('https://raw.githubusercontent.com/APTrust/preservation-services/master/profiles/aptrust-v2.2.json')
-        try:
-            profile.validate(bag)
-        except bagit.BagValidationError() as e:
-            print(e)
-            return False"""
-        newbag = bagit.Bag(bpath)
-        if not newbag.is_valid():
-            return False
-        return True
-
     def run_bagit(self, bagsdir, storage_opt, moreopts4):
         """ Bags all objects in a single directory, according to APTrust BagIt profile """
-        validbags = 0
-        totalbags = 0
-        if not storage_opt in ['Standard', 'Glacier-Deep-OH']:
-            messagebox.showwarning(message=f'APT Storage Option \"{storage_opt}\" is not a valid option.\nStopping...')
+        self.pipeline.storage = storage_opt
+        counts = self.pipeline.run_bagit(bagsdir)
+        if counts is None:
             runnext4 = False
             return runnext4
-        # Defining MData tags
-        bag_info = {
-            'Bag-Count': '',
-            'Bag-Group-Identifier': '',
-            'BagIt-Profile-Identifier': 'https://raw.githubusercontent.com/APTrust/preservation-services/master/profiles/aptrust-v2.2.json',
-            'Internal-Sender-Description': '',
-            'Internal-Sender-Identifier': '',
-            'Source-Organization': 'University of Alabama at Birmingham'
-            }
-        sorted_bagsdir = sorted(listdir(bagsdir))
-        for f in sorted_bagsdir:
-            inpath = path.join(bagsdir, f)
-            cont = True
-            valid_APT_bag = False
-            if path.isdir(inpath):
-                if path.exists(path.join(inpath, 'data')):
-                    cont = messagebox.askyesno(message="It appears that \'%s\' is already a bag.\nBag it anyway?" % f)
-                if cont == True:
-                    # Section to create the necessary APTrust Info file
-                    newbag = bagit.make_bag(inpath, bag_info, checksums=['md5', 'sha256'])
-                    totalbags += 1
-                    valid_APT_bag = self.make_valid_apt_bag(inpath, storage_opt)
-                    if valid_APT_bag:
-                        validbags += 1
-                    elif not valid_APT_bag:
-                        messagebox.showwarning(message=f'Bag {f} is not a valid APTrust bag.')
-                # elif cont == False:
-                #     messagebox.showwarning(message="Skipped bagging of \'%s\'." %f)
+        totalbags, validbags = counts
         if not moreopts4 == 0:
             if self.prompting == 0:
                 runnext4 = True
@@ -619,34 +409,7 @@ class ObjFormatter:
 
     def run_tar(self, tarfolder, procfolder, moreopts5):
         """ Tars all objects in a single directory """
-        tarfiles = 0
-        alreadytar = 0
-        notfolder = 0
-        outfolder = path.join(procfolder, 'ready_to_transfer')
-        if not path.exists(outfolder):
-            mkdir(outfolder)
-        sorted_tarfolder = sorted(listdir(tarfolder))
-        for i in sorted_tarfolder:
-            infile = path.join(tarfolder, i)
-            if path.isdir(infile):
-                # outfile = path.join(outfolder, f'{path.splitext(i)[0]}.tar.gz')
-                outfile = path.join(outfolder, f'{path.splitext(i)[0]}.tar')
-                if path.exists(outfile):
-                    messagebox.showwarning(
-                        message=f'The TAR file: {outfile}\nalready exists!\nTar archive not created.')
-                    alreadytar += 1
-                elif not path.exists(outfile):
-                    # with tarfile.open(outfile, 'w:gz') as newtar:
-                    with tarfile.open(outfile, 'w') as newtar:
-                        tarname = path.relpath(infile, tarfolder)
-                        newtar.add(infile, arcname=tarname)
-                    tarfiles += 1
-            else:
-                notfolder += 1
-        if not alreadytar == 0:
-            messagebox.showwarning(message=f'The folder {outfolder} already contained {alreadytar} tar files which were skipped.')
-        # if not notfolder == 0:
-        #    messagebox.showinfo(message="The target folder contained %d files, which were ignored." %notfolder)
+        tarfiles = self.pipeline.run_tar(tarfolder, procfolder)[0]
         if not moreopts5 == 0:
             if self.prompting == 0:
                 runnext5 = True
@@ -666,44 +429,132 @@ class ObjFormatter:
         if path.isdir(procdirectory):
             process_dir = procdirectory
         else:
-            process_dir = askdirectory(initialdir=self.user_home())
+            process_dir = filedialog.askdirectory(initialdir=self.user_home())
         askingdir = path.join(process_dir, 'ready_to_transfer')
         indir = ""
         tardest = messagebox.askyesno(message=f'Create manifest of {askingdir}?', default='yes')
         if tardest:
             indir = askingdir
         elif not tardest:
-            indir = askdirectory(initialdir=process_dir,
+            indir = filedialog.askdirectory(initialdir=process_dir,
                                  title="In which folder are the objects to be transferred?")
-        outdir = path.join(process_dir, 'transfer_manifests')
-        if not path.exists(outdir):
-            mkdir(outdir)
-        tar_list = open(path.join(outdir, f'transfer_{time.strftime("%Y%b%d_%H%M%S")}.csv'),
-                        'w', encoding='utf-8', newline='')
-        sorted_tarlist = sorted([t for t in listdir(indir) if '.tar' in t])
-        for tars in sorted_tarlist:
-            tar_path = path.join(indir, tars)
-            md5sum = self.md5hash(tar_path)
-            sha256sum = self.sha256hash(tar_path)
-            # sha3sum = self.sha3hash(tar_path)
-            tar_list.write(f'{tars},{md5sum},{sha256sum}\n')
-        tar_list.close()
+        ntars = self.pipeline.trans_manifest(indir, process_dir)[1]
         if self.prompting == 1:
-            messagebox.showinfo(message=f'Transfer Manifest Created\nfor {len(sorted_tarlist)} Tar Files')
+            messagebox.showinfo(message=f'Transfer Manifest Created\nfor {ntars} Tar Files')
         return
 
+    def meta_inputs(self, choices):
+        """ Returns the master CSV and its ID column, or [None, None] after a warning """
+        metainput = choices['csvfile']
+        idcolumn = choices['idcolumn']
+        if metainput == "":
+            messagebox.showwarning(message="You must choose a CSV master metadata file.")
+            return [None, None]
+        if not path.exists(metainput):
+            messagebox.showwarning(message="CSV file:\n\'%s\'\nnot found. Stopping action." % metainput)
+            return [None, None]
+        if path.splitext(metainput)[1] == '.csv' and idcolumn == "":
+            messagebox.showwarning(message="You must choose the column of ID's in the CSV.")
+            return [None, None]
+        return [metainput, idcolumn]
+
+    def run_pipelined(self, root, itemsdir, procdir, selected, choices):
+        """ Runs the selected actions object by object, with the actions overlapping across objects """
+        stages = [stage for stage, chosen in zip(STAGES, selected) if chosen == 1]
+        metainput, idcolumn = [None, None]
+        if 'meta' in stages:
+            metainput, idcolumn = self.meta_inputs(choices)
+            if metainput is None:
+                return
+        self.pipeline.storage = self.apt_storage
+        summary = run_pipelined(self.pipeline, itemsdir, procdir, [s for s in stages if not s == 'transfer'],
+                                metainput, idcolumn)
+        report = []
+        if 'prebagged' in summary:
+            report.append(f'Pre-Bagged {summary["prebagged"]} Objects.')
+        if 'metadata_csv' in summary:
+            report.append(f'Created {summary["metadata_csv"]} \'metadata.csv\' and {summary["metadata_xml"]} \'metadata.xml\' files.')
+        if 'manifests' in summary:
+            report.append(f"Created {summary['manifests']} \'manifest.csv\' files.")
+        if 'bags' in summary:
+            report.append(f"Created {summary['bags']} total bags,\nof which {summary['valid_bags']} are valid.")
+        if 'tars' in summary:
+            report.append(f'Created {summary["tars"]} tar archives.')
+        if summary.get('failed'):
+            report.append(f'{len(summary["failed"])} objects failed: {", ".join(summary["failed"])}')
+        if report:
+            messagebox.showinfo(message='\n'.join(report))
+        # Make Transfer Manifest
+        if 'transfer' in stages:
+            self.trans_manifest(itemsdir, procdir)
+        messagebox.showinfo(message='Done!')
+        return True
+
+    def read_choices(self, frame2):
+        """ The entries and options of the window, read on the main thread before the actions start """
+        return {'itemsdir': self.e1.get(), 'procdir': self.e2.get(), 'csvfile': self.e3.get(),
+                'idcolumn': self.e4.get(), 'pre': frame2.prebagvar.get(), 'meta': frame2.metavar.get(),
+                'inv': frame2.invenvar.get(), 'bagit': frame2.bagitvar.get(), 'tar': frame2.tarvar.get(),
+                'trans': frame2.transvar.get(), 'prompting': frame2.prompt.get(),
+                'storage': frame2.aptStorage.get(), 'rehash': frame2.rehashvar.get()}
+
     def run_procs(self, root, frame2):
+        """ Starts the selected actions on a worker thread, so the window keeps responding """
+        if self.running is not None:
+            return
+        choices = self.read_choices(frame2)
+        self.submit1.configure(state='disabled')
+        self.running = BackgroundRun(root, 'SIPmaker Progress',
+                                     lambda progress: self.run_batch(root, choices, progress),
+                                     lambda finished, error: self.batch_done(root, finished, error))
+
+    def run_batch(self, root, choices, progress):
+        """ Runs on the worker thread. Returns True once every selected action is done """
+        procdir = choices['procdir']
+        self.pipeline.progress = progress
+        # Digests are cached in the Processing Folder, so re-runs only stat unchanged files
+        self.pipeline.open_cache(procdir, trust=(choices['rehash'] == 0), max_mb=FIXITY_CACHE_MB)
+        # The job journal lets a batch cut short by a crash pick up where it stopped
+        self.pipeline.open_journal(procdir)
+        # Files are indexed by digest, to report copies across objects and batches
+        self.pipeline.open_duplicates(procdir)
+        # Stage timings and counts go to 'run_reports' in the Processing Folder
+        self.pipeline.open_report(procdir)
+        try:
+            return self.run_stages(root, choices)
+        finally:
+            self.pipeline.close_report()
+            self.pipeline.close_journal()
+            self.pipeline.close_duplicates()
+            self.pipeline.close_cache()
+            self.pipeline.progress = None
+
+    def batch_done(self, root, finished, error):
+        """ Back on the main thread once the worker has stopped """
+        self.running = None
+        self.submit1.configure(state='normal')
+        if isinstance(error, StopBatch):
+            sys.exit()
+        if isinstance(error, Cancelled):
+            messagebox.showinfo(message='Cancelled.\n\nObjects left unfinished will be\nrolled back by the next run.')
+        elif error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            messagebox.showwarning(message=f'Stopped by an error:\n{error}')
+        elif finished:
+            root.quit()
+
+    def run_stages(self, root, choices):
         runnext = True
-        itemsdir = self.e1.get()
-        procdir = self.e2.get()
-        pre = frame2.prebagvar.get()
-        meta = frame2.metavar.get()
-        inv = frame2.invenvar.get()
-        bagit = frame2.bagitvar.get()
-        tar = frame2.tarvar.get()
-        trans = frame2.transvar.get()
-        self.prompting = frame2.prompt.get()
-        self.apt_storage = frame2.aptStorage.get()
+        itemsdir = choices['itemsdir']
+        procdir = choices['procdir']
+        pre = choices['pre']
+        meta = choices['meta']
+        inv = choices['inv']
+        bagit = choices['bagit']
+        tar = choices['tar']
+        trans = choices['trans']
+        self.prompting = choices['prompting']
+        self.apt_storage = choices['storage']
         nselect = 0
         for d in [pre, meta, inv, bagit, tar, trans]:
             if d == 1:
@@ -713,11 +564,16 @@ class ObjFormatter:
                 messagebox.showwarning(message="You must first select a folder.")
                 return
             if not path.exists(itemsdir):
-                messagebox.showwarning(message="Items folder:\n\'%s\'\nnot found." % olditemsdir)
+                messagebox.showwarning(message="Items folder:\n\'%s\'\nnot found." % itemsdir)
                 return
         if nselect == 0:
             messagebox.showwarning(message="You have not selected any \'Options\'.")
             return
+        selected = [pre, meta, inv, bagit, tar, trans]
+        self.pipeline.start_progress(itemsdir, [stage for stage, chosen in zip(STAGES, selected) if chosen == 1])
+        # Without prompts between actions, objects flow through the stages independently
+        if PIPELINED and self.prompting == 0 and nselect > 1:
+            return self.run_pipelined(root, itemsdir, procdir, selected, choices)
         # PreBag items
         if pre == 1:
             nselect -= 1
@@ -727,16 +583,8 @@ class ObjFormatter:
         # Run CSV meta
         if meta == 1:
             nselect -= 1
-            metainput = self.e3.get()
-            idcolumn = self.e4.get()
-            if metainput == "":
-                messagebox.showwarning(message="You must choose a CSV master metadata file.")
-                return
-            if not path.exists(metainput):
-                messagebox.showwarning(message="CSV file:\n\'%s\'\nnot found. Stopping action." % metainput)
-                return
-            if path.splitext(metainput)[1] == '.csv' and idcolumn == "":
-                messagebox.showwarning(message="You must choose the column of ID's in the CSV.")
+            metainput, idcolumn = self.meta_inputs(choices)
+            if metainput is None:
                 return
             runnext = self.create_meta(itemsdir, metainput, idcolumn, nselect)
             if runnext == False:
@@ -764,7 +612,7 @@ class ObjFormatter:
         if trans == 1:
             self.trans_manifest(itemsdir, procdir)
         messagebox.showinfo(message='Done!')
-        root.quit()
+        return True
 
 def instructions(fontsize):
     new = Toplevel()
@@ -820,4 +668,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # Needed for the 'process' worker pool when frozen with PyInstaller
+    freeze_support()
     main()
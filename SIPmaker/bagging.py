@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Bag writer for SIP Maker
+Builds BagIt bags from the digests that the inventory already wrote to
+each object's 'manifest.csv', instead of reading the payload again.
+Files whose exact size, mtime (ns), inode or device no longer match
+their 'manifest.csv' row (and files the inventory never saw, such as
+'metadata.csv') are hashed fresh.
+Also validates bags against the APTrust profile in tiers, so that a bag
+that was just built does not have to be read back in full.
+====================================================================
+"""
+
+import random, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from os import chmod, listdir, path, remove, rename, rmdir, sep, stat
+from fixity import multi_hash, multi_hash_bytes, read_manifest, verify_manifest, write_atomic
+from inventory import DEFAULT_WORKERS, read_inventory, row_matches
+from walker import entry_stat, walk_files
+
+""" Global Variables """
+BAGIT_TXT = 'BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n'
+SOFTWARE_AGENT = 'SIPmaker 2.0.0 <https://github.com/lukemenzies/uab_dnd_scripts>'
+# Columns of 'manifest.csv' that hold each BagIt algorithm
+INVENTORY_COLUMNS = {'md5': 'MD5', 'sha256': 'SHA256'}
+# APTrust BagIt profile v2.2
+BAG_ALGORITHMS = ('md5', 'sha256')
+REQUIRED_TAG_FILES = ['bagit.txt', 'bag-info.txt', 'aptrust-info.txt', 'manifest-md5.txt', 'manifest-sha256.txt',
+                      'tagmanifest-md5.txt', 'tagmanifest-sha256.txt']
+APTRUST_ACCESS = ('Consortia', 'Institution', 'Restricted')
+APTRUST_STORAGE = ('Standard', 'Glacier-OH', 'Glacier-OR', 'Glacier-VA', 'Glacier-Deep-OH', 'Glacier-Deep-OR',
+                   'Glacier-Deep-VA', 'Wasabi-OR', 'Wasabi-VA')
+VALIDATION_TIERS = ('structural', 'tags', 'full')
+
+
+def encode_filename(name):
+    """ BagIt manifests percent-encode line breaks in file names """
+    return name.replace('\r', '%0D').replace('\n', '%0A')
+
+
+def inventory_digests(row, statinfo, algorithms):
+    """
+    Returns the digests recorded in a 'manifest.csv' row, but only if the
+    file still matches what the inventory saw. Otherwise returns None.
+    """
+    if row is None:
+        return None
+    if not all(alg in INVENTORY_COLUMNS and row.get(INVENTORY_COLUMNS[alg]) for alg in algorithms):
+        return None
+    if not row_matches(row, statinfo):
+        return None
+    return {alg: row[INVENTORY_COLUMNS[alg]].lower() for alg in algorithms}
+
+
+def payload_entries(data_dir):
+    """ Yields ('/' separated path relative to the bag, DirEntry) for every payload file, in BagIt order """
+    bag_dir = path.dirname(data_dir)
+    for entry in walk_files(data_dir, hidden=True, ds_store='keep'):
+        yield path.relpath(entry.path, bag_dir).replace(sep, '/'), entry
+
+
+def payload_files(data_dir):
+    """ Yields '/' separated paths of every payload file, relative to the bag, in BagIt order """
+    for bagpath, entry in payload_entries(data_dir):
+        yield bagpath
+
+
+def write_tag_file(tagpath, tags):
+    """ Writes 'Label: value' tag files the same way bagit does, sorted by label """
+    with open(tagpath, 'w', newline='', encoding='UTF-8') as tagfile:
+        for label in sorted(tags):
+            values = tags[label]
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                value = str(value).replace('\r', '').replace('\n', '')
+                tagfile.write(f'{label}: {value}\n')
+
+
+def write_tagmanifests(bag_dir, algorithms):
+    """ Hashes the (small) tag files and writes 'tagmanifest-<alg>.txt' """
+    tagfiles = sorted(f for f in listdir(bag_dir)
+                      if path.isfile(path.join(bag_dir, f)) and not f.startswith('tagmanifest-'))
+    digests = {f: multi_hash(path.join(bag_dir, f), algorithms) for f in tagfiles}
+    for alg in algorithms:
+        with open(path.join(bag_dir, f'tagmanifest-{alg}.txt'), 'w', newline='', encoding='UTF-8') as tagmanifest:
+            for f in tagfiles:
+                tagmanifest.write(f'{digests[f][alg]} {f}\n')
+
+
+def add_aptrust_info(bag_dir, storage, description='University of Alabama at Birmingham'):
+    """
+    Writes 'aptrust-info.txt' and adds it to both tag manifests. The file
+    is built in memory and both digests come from that buffer; each tag
+    manifest is rewritten with a single write and an atomic rename.
+    """
+    bagname = path.basename(path.abspath(bag_dir))
+    apt_info = (f'Access: Institution\nDescription: {description}\n'
+                f'Storage-Option: {storage}\nTitle: {bagname}\n').encode('UTF-8')
+    digests = multi_hash_bytes(apt_info, BAG_ALGORITHMS)
+    write_atomic(path.join(bag_dir, 'aptrust-info.txt'), apt_info)
+    for alg in BAG_ALGORITHMS:
+        tagpath = path.join(bag_dir, f'tagmanifest-{alg}.txt')
+        with open(tagpath, 'rb') as tagmanifest:
+            # Drop any entry left by an earlier run, then put aptrust-info.txt first
+            lines = [line for line in tagmanifest.read().splitlines(keepends=True)
+                     if not line.rstrip(b'\r\n').endswith(b' aptrust-info.txt')]
+        newline = f'{digests[alg]} aptrust-info.txt\n'.encode('UTF-8')
+        write_atomic(tagpath, newline + b''.join(lines))
+    return digests
+
+
+def make_bag_from_inventory(bag_dir, bag_info=None, checksums=('md5', 'sha256'), cache=None,
+                            workers=DEFAULT_WORKERS):
+    """
+    Converts a directory into a bag, like bagit.make_bag, taking payload
+    digests from the object's 'manifest.csv' (or the fixity cache) where
+    they can be trusted. Returns [payload bytes, payload files, files rehashed].
+    """
+    bag_dir = path.abspath(bag_dir)
+    inventory = read_inventory(path.join(bag_dir, 'manifest.csv'))
+    # Move the payload into 'data', via a temporary folder as bagit does
+    temp_data = tempfile.mkdtemp(dir=bag_dir)
+    for f in listdir(bag_dir):
+        if not path.join(bag_dir, f) == temp_data:
+            rename(path.join(bag_dir, f), path.join(temp_data, f))
+    data_dir = path.join(bag_dir, 'data')
+    rename(temp_data, data_dir)
+    chmod(data_dir, stat(bag_dir).st_mode)
+    # Reuse the inventory digests, and rehash anything that changed or is new
+    entries = []
+    rehash = []
+    for bagpath, entry in payload_entries(data_dir):
+        filepath = entry.path
+        statinfo = entry_stat(entry)
+        digests = None
+        if cache is not None:
+            digests = cache.lookup(statinfo, checksums)
+        if digests is None:
+            digests = inventory_digests(inventory.get(bagpath[len('data/'):]), statinfo, checksums)
+            if digests is not None and cache is not None:
+                cache.store(statinfo, digests, filepath)
+        if digests is None:
+            rehash.append(len(entries))
+        entries.append([bagpath, statinfo.st_size, digests])
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        fresh = pool.map(lambda n: multi_hash(path.join(bag_dir, entries[n][0]), checksums, cache=cache), rehash)
+        for n, digests in zip(rehash, fresh):
+            entries[n][2] = digests
+    for alg in checksums:
+        with open(path.join(bag_dir, f'manifest-{alg}.txt'), 'w', newline='', encoding='UTF-8') as manifest:
+            for bagpath, size, digests in entries:
+                manifest.write(f'{digests[alg]}  {encode_filename(bagpath)}\n')
+    total_bytes = sum(size for bagpath, size, digests in entries)
+    # Tag files
+    with open(path.join(bag_dir, 'bagit.txt'), 'w', newline='', encoding='UTF-8') as bagit_txt:
+        bagit_txt.write(BAGIT_TXT)
+    tags = dict(bag_info or {})
+    if 'Bagging-Date' not in tags:
+        tags['Bagging-Date'] = date.today().strftime('%Y-%m-%d')
+    if 'Bag-Software-Agent' not in tags:
+        tags['Bag-Software-Agent'] = SOFTWARE_AGENT
+    tags['Payload-Oxum'] = f'{total_bytes}.{len(entries)}'
+    write_tag_file(path.join(bag_dir, 'bag-info.txt'), tags)
+    write_tagmanifests(bag_dir, checksums)
+    return [total_bytes, len(entries), len(rehash)]
+
+
+def unbag(bag_dir, payload):
+    """
+    Undoes a bag that was interrupted while being made: moves the payload
+    back out of 'data' (or the temporary folder it was moved into first)
+    and removes the tag files. 'payload' is the list of names at the top
+    of the folder before bagging started. Returns False if it cannot tell
+    the payload from the bag, and leaves the folder alone.
+    """
+    if 'data' in payload:
+        return False
+    names = listdir(bag_dir)
+    for name in names:
+        if name in payload:
+            continue
+        fullpath = path.join(bag_dir, name)
+        if path.isdir(fullpath) and (name == 'data' or name.startswith('tmp')):
+            for f in listdir(fullpath):
+                if f in payload and not path.exists(path.join(bag_dir, f)):
+                    rename(path.join(fullpath, f), path.join(bag_dir, f))
+            if not listdir(fullpath):
+                rmdir(fullpath)
+        elif name in REQUIRED_TAG_FILES or name.startswith(('manifest-', 'tagmanifest-')):
+            remove(fullpath)
+    return True
+
+
+def read_tag_file(tagpath):
+    """ Returns the 'Label: value' pairs of a tag file as a dict """
+    tags = {}
+    with open(tagpath, 'r', encoding='UTF-8') as tagfile:
+        for line in tagfile:
+            if ':' in line:
+                label, value = line.split(':', 1)
+                tags[label.strip()] = value.strip()
+    return tags
+
+
+def check_structure(bag_dir):
+    """
+    The "structural" tier: checks the APTrust profile requirements, the
+    Payload-Oxum against a stat scan, and that every payload manifest
+    lists exactly the files in 'data'. Reads no payload bytes.
+    Returns a list of problems (empty if the bag passes).
+    """
+    problems = []
+    for tagname in REQUIRED_TAG_FILES:
+        if not path.isfile(path.join(bag_dir, tagname)):
+            problems.append(f'Missing required tag file {tagname}')
+    if problems:
+        return problems
+    if not read_tag_file(path.join(bag_dir, 'bagit.txt')).get('BagIt-Version'):
+        problems.append('bagit.txt has no BagIt-Version')
+    bag_info = read_tag_file(path.join(bag_dir, 'bag-info.txt'))
+    if not bag_info.get('Source-Organization'):
+        problems.append('bag-info.txt has no Source-Organization')
+    apt_info = read_tag_file(path.join(bag_dir, 'aptrust-info.txt'))
+    if not apt_info.get('Title'):
+        problems.append('aptrust-info.txt has no Title')
+    if apt_info.get('Access') not in APTRUST_ACCESS:
+        problems.append(f'aptrust-info.txt Access \'{apt_info.get("Access")}\' is not valid')
+    if apt_info.get('Storage-Option') not in APTRUST_STORAGE:
+        problems.append(f'aptrust-info.txt Storage-Option \'{apt_info.get("Storage-Option")}\' is not valid')
+    # Payload-Oxum against a stat scan of 'data'
+    data_dir = path.join(bag_dir, 'data')
+    on_disk = dict(payload_entries(data_dir))
+    total_bytes = sum(entry.stat().st_size for entry in on_disk.values())
+    oxum = f'{total_bytes}.{len(on_disk)}'
+    if not bag_info.get('Payload-Oxum') == oxum:
+        problems.append(f'Payload-Oxum is {bag_info.get("Payload-Oxum")} but the payload is {oxum}')
+    # Every manifest must list exactly the files that are on disk
+    for alg in BAG_ALGORITHMS:
+        listed = set(read_manifest(path.join(bag_dir, f'manifest-{alg}.txt')))
+        for missing in sorted(listed - set(on_disk)):
+            problems.append(f'{missing} is listed in manifest-{alg}.txt but missing')
+        for extra in sorted(set(on_disk) - listed):
+            problems.append(f'{extra} is not listed in manifest-{alg}.txt')
+    return problems
+
+
+def check_payload(bag_dir, sample=100, workers=DEFAULT_WORKERS):
+    """
+    The "full" tier: rehashes the payload against both manifests, one
+    read per file, on a thread pool. With sample below 100 only that
+    percentage of files (at least one) is rehashed.
+    Returns a list of problems (empty if the bag passes).
+    """
+    expected = {alg: read_manifest(path.join(bag_dir, f'manifest-{alg}.txt')) for alg in BAG_ALGORITHMS}
+    files = sorted(expected[BAG_ALGORITHMS[0]])
+    if sample < 100 and files:
+        files = sorted(random.sample(files, max(1, int(len(files) * sample / 100))))
+    problems = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        found = pool.map(lambda f: multi_hash(path.join(bag_dir, f), BAG_ALGORITHMS), files)
+        for f, digests in zip(files, found):
+            for alg in BAG_ALGORITHMS:
+                if not expected[alg].get(f) == digests[alg]:
+                    problems.append(f'{f} {alg} mismatch: expected {expected[alg].get(f)}, found {digests[alg]}')
+    return problems
+
+
+def validate_bag(bag_dir, tier='tags', sample=100, workers=DEFAULT_WORKERS):
+    """
+    Tiered APTrust bag validation, cheapest first:
+      'structural' - profile, Payload-Oxum and manifest completeness only
+      'tags'       - structural, plus the tag manifests (small files)
+      'full'       - tags, plus a parallel rehash of the payload (or a sample %)
+    Freshly built bags only need 'tags', since their payload digests were
+    just computed. Returns a list of problems (empty if the bag is valid).
+    """
+    if tier not in VALIDATION_TIERS:
+        raise ValueError(f'Unknown validation tier: {tier}')
+    problems = check_structure(bag_dir)
+    if problems or tier == 'structural':
+        return problems
+    for alg in BAG_ALGORITHMS:
+        problems += verify_manifest(bag_dir, f'tagmanifest-{alg}.txt', alg)
+    if problems or tier == 'tags':
+        return problems
+    return check_payload(bag_dir, sample, workers)
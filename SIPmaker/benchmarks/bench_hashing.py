@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+====================================================================
+SIP Maker - hashing benchmark
+Hashes one large file with each way of reading it and prints MB/s and
+the CPU time spent, against the small read() loops SIP Maker used to
+have (8 KB chunks).
+
+    python benchmarks/bench_hashing.py                   # a 1 GB temporary file
+    python benchmarks/bench_hashing.py --size-mb 4096 --algorithms md5
+    python benchmarks/bench_hashing.py --file /mnt/share/big.mkv --cold
+
+Without --cold, every run after the first reads the file from the page
+cache, which shows the CPU cost of each method; --cold (Linux) drops
+the file from the cache before each run, which shows the disk.
+====================================================================
+"""
+
+import argparse, io, os, statistics, sys, tempfile, time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from fixity import CHUNKSIZE, DEFAULT_ALGORITHMS, multi_hash, new_hashers
+
+""" Global Variables """
+MB = 1000000
+RUNS = 3
+SIZE_MB = 1024
+
+
+def read_loop(filepath, algorithms, chunksize):
+    """ The old way: a new bytes object from read() for every chunk """
+    hashers = new_hashers(algorithms)
+    with open(filepath, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunksize), b''):
+            for h in hashers.values():
+                h.update(chunk)
+    return {alg: h.hexdigest() for alg, h in hashers.items()}
+
+
+METHODS = {
+    'read 8 KB': lambda filepath, algorithms: read_loop(filepath, algorithms, io.DEFAULT_BUFFER_SIZE),
+    'read 8 MB': lambda filepath, algorithms: read_loop(filepath, algorithms, CHUNKSIZE),
+    'readinto': lambda filepath, algorithms: multi_hash(filepath, algorithms, strategy='readinto'),
+    'mmap': lambda filepath, algorithms: multi_hash(filepath, algorithms, strategy='mmap'),
+    'auto': lambda filepath, algorithms: multi_hash(filepath, algorithms, strategy='auto'),
+    # readinto, dropping what was read from the page cache (see iohints.py)
+    'stream': lambda filepath, algorithms: multi_hash(filepath, algorithms, hints='stream'),
+    }
+
+
+def drop_cached(filepath):
+    """ Drops a file from the OS page cache, where the OS allows it """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def make_file(folder, size_mb):
+    """ A file of random bytes, written a block at a time """
+    fd, filepath = tempfile.mkstemp(dir=folder, prefix='sipbench_', suffix='.bin')
+    block = os.urandom(CHUNKSIZE)
+    left = size_mb * MB
+    with open(fd, 'wb') as outfile:
+        while left > 0:
+            outfile.write(block[:left])
+            left -= len(block)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    return filepath
+
+
+def time_method(method, filepath, algorithms, runs, cold):
+    """ [(wall seconds, CPU seconds)] of each run """
+    times = []
+    for _ in range(runs):
+        if cold and not drop_cached(filepath):
+            raise OSError('--cold is not supported on this OS')
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        digests = method(filepath, algorithms)
+        times.append((time.perf_counter() - wall, time.process_time() - cpu))
+    return times, digests
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compare ways of reading a file for hashing.')
+    parser.add_argument('--file', help='hash this file instead of a temporary one')
+    parser.add_argument('--size-mb', type=int, default=SIZE_MB, help=f'size of the temporary file (default: {SIZE_MB})')
+    parser.add_argument('--workdir', help='where to write the temporary file (default: the system temp folder)')
+    parser.add_argument('--algorithms', default=','.join(DEFAULT_ALGORITHMS),
+                        help=f'comma-separated digests (default: {",".join(DEFAULT_ALGORITHMS)})')
+    parser.add_argument('--methods', default=','.join(METHODS), help=f'comma-separated, from: {", ".join(METHODS)}')
+    parser.add_argument('--runs', type=int, default=RUNS, help=f'runs of each method (default: {RUNS})')
+    parser.add_argument('--cold', action='store_true', help='drop the file from the OS page cache before each run')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    algorithms = [a.strip() for a in args.algorithms.split(',') if a.strip()]
+    methods = [m.strip() for m in args.methods.split(',') if m.strip()]
+    for name in methods:
+        if name not in METHODS:
+            print(f'Unknown method: {name}', file=sys.stderr)
+            return 2
+    filepath = args.file or make_file(args.workdir, args.size_mb)
+    try:
+        size = path.getsize(filepath)
+        print(f'{filepath}: {size / MB:.0f} MB, {"+".join(algorithms)}, median of {args.runs} runs'
+              f'{", cold cache" if args.cold else ""}')
+        expected = None
+        for name in methods:
+            times, digests = time_method(METHODS[name], filepath, algorithms, args.runs, args.cold)
+            if expected is None:
+                expected = digests
+            elif digests != expected:
+                print(f'{name}: digests differ from {methods[0]}!', file=sys.stderr)
+                return 1
+            wall = statistics.median(t[0] for t in times)
+            cpu = statistics.median(t[1] for t in times)
+            print(f'{name:>10}: {size / MB / wall:8.1f} MB/s   {cpu:6.2f} s CPU')
+    finally:
+        if not args.file:
+            os.remove(filepath)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+====================================================================
+SIP Maker - stage benchmark
+Builds a synthetic batch (see synthetic_batch.py) in a temporary
+folder, runs the SIP Maker stages over it without the window, and
+prints each stage's median time and throughput, taken from the run
+report. No display is needed.
+
+    python benchmarks/bench_stages.py --profile xml --save-baseline base_xml.json
+    ... change something ...
+    python benchmarks/bench_stages.py --profile xml --baseline base_xml.json
+
+Against a baseline, exits with 1 if any stage is slower by more than
+the tolerance (default 15%, and at least 0.05 s). The batch is written
+just before each run, so its files are usually still in the page
+cache; --cold asks the OS to drop them first (Linux).
+====================================================================
+"""
+
+import argparse, json, os, platform, statistics, sys, tempfile
+from os import mkdir, path
+from shutil import rmtree
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from synthetic_batch import MB, add_batch_args, batch_options, make_batch
+from inventory import DEFAULT_WORKERS, POOL_MODES
+from iohints import IO_HINT_MODES, IO_HINTS
+from tarring import COMPRESSIONS, TAR_WORKERS
+from pipeline import STAGES, Policy, SIPPipeline, run_batch
+
+""" Global Variables """
+RUNS = 3
+TOLERANCE = 0.15
+# Differences smaller than this many seconds are noise
+NOISE_SECONDS = 0.05
+
+
+def drop_cached(folder):
+    """ Writes out and drops the page cache of every file below folder, where the OS allows it """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for f in filenames:
+            fd = os.open(path.join(dirpath, f), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def run_once(args, stages):
+    """ One run over a fresh batch. Returns the run report (a dict) and the batch's counts """
+    workdir = tempfile.mkdtemp(prefix='sipbench_', dir=args.workdir)
+    try:
+        made = make_batch(workdir, **batch_options(args))
+        procdir = path.join(workdir, 'processing')
+        mkdir(procdir)
+        if args.cold and not drop_cached(workdir):
+            print('--cold is not supported on this OS; timing with a warm cache.', file=sys.stderr)
+            args.cold = False
+        pipeline = SIPPipeline(Policy(log=lambda message: None), workers=args.workers, pool=args.pool,
+                               tar_workers=args.tar_workers, compression=args.compression, io_hints=args.io_hints)
+        summary = run_batch(pipeline, made['items'], procdir, stages, made['csv'], trust=False,
+                            pipelined=args.pipelined)
+        if summary.get('failed'):
+            raise RuntimeError(f'Objects failed: {summary["failed"]}')
+        with open(summary['run_report'], 'r', encoding='UTF-8') as rfile:
+            return json.load(rfile), made
+    finally:
+        if args.keep:
+            print(f'Kept {workdir}')
+        else:
+            rmtree(workdir, ignore_errors=True)
+
+
+def stage_seconds(report):
+    """ {stage: seconds} of one run, with the whole run as 'total' """
+    seconds = {stage: stats['wall_seconds'] for stage, stats in report['stages'].items()
+               if stats['wall_seconds'] is not None}
+    seconds['total'] = report['wall_seconds']
+    return seconds
+
+
+def compare(medians, baseline, tolerance):
+    """ Prints each stage against the baseline. Returns the stages that got slower """
+    slower = []
+    for stage, seconds in medians.items():
+        before = baseline['seconds'].get(stage)
+        if before is None:
+            print(f'{stage:>10}: {seconds:8.3f} s   (not in the baseline)')
+            continue
+        change = (seconds - before) / before if before else 0.0
+        flag = ''
+        if change > tolerance and seconds - before > NOISE_SECONDS:
+            flag = '  SLOWER'
+            slower.append(stage)
+        elif change < -tolerance and before - seconds > NOISE_SECONDS:
+            flag = '  faster'
+        print(f'{stage:>10}: {seconds:8.3f} s   baseline {before:8.3f} s   {change * 100:+6.1f}%{flag}')
+    return slower
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time the SIP Maker stages over a synthetic batch.')
+    add_batch_args(parser)
+    parser.add_argument('--runs', type=int, default=RUNS, help=f'runs, each over a fresh batch (default: {RUNS})')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated stages to run')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='let objects flow through the stages (only the total time is comparable)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='inventory worker count')
+    parser.add_argument('--pool', default='thread', choices=POOL_MODES, help='inventory worker pool')
+    parser.add_argument('--tar-workers', type=int, default=TAR_WORKERS, help='archives built at once')
+    parser.add_argument('--compression', default='none', choices=sorted(COMPRESSIONS), help='tar compression')
+    parser.add_argument('--io-hints', default=IO_HINTS, choices=IO_HINT_MODES,
+                        help=f'page cache hints while hashing (default: {IO_HINTS})')
+    parser.add_argument('--cold', action='store_true', help="drop the batch from the OS page cache before each run")
+    parser.add_argument('--workdir', help='where to write the batches (default: the system temp folder)')
+    parser.add_argument('--keep', action='store_true', help='keep the batches afterwards')
+    parser.add_argument('--baseline', help='JSON file of an earlier --save-baseline to compare against')
+    parser.add_argument('--save-baseline', help='write the medians of this run to a JSON file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help=f'slowdown allowed against the baseline, as a fraction (default: {TOLERANCE})')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    options = dict(batch_options(args), stages=stages, pipelined=args.pipelined, workers=args.workers,
+                   pool=args.pool, tar_workers=args.tar_workers, compression=args.compression, cold=args.cold,
+                   io_hints=args.io_hints)
+    runs = []
+    for run in range(args.runs):
+        report, made = run_once(args, stages)
+        runs.append(report)
+        print(f'Run {run + 1}: {report["wall_seconds"]:.3f} s')
+    print(f'{made["objects"]} objects, {made["files"]} files, {made["bytes"] / MB:.1f} MB; '
+          f'median of {args.runs} runs:')
+    medians = {}
+    for stage in stage_seconds(runs[0]):
+        medians[stage] = round(statistics.median(stage_seconds(report).get(stage, 0.0) for report in runs), 3)
+    slower = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='UTF-8') as bfile:
+            baseline = json.load(bfile)
+        if baseline['options'] != options:
+            print('The baseline was taken with different options; the comparison may not be fair.')
+        slower = compare(medians, baseline, args.tolerance)
+    else:
+        for stage, seconds in medians.items():
+            nbytes = statistics.median(report['stages'].get(stage, {}).get('bytes_read', 0) for report in runs)
+            rate = f'{nbytes / seconds / MB:8.1f} MB/s read' if seconds and nbytes else ''
+            print(f'{stage:>10}: {seconds:8.3f} s   {rate}')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='UTF-8') as bfile:
+            json.dump({'options': options, 'python': platform.python_version(), 'platform': platform.platform(),
+                       'seconds': medians}, bfile, indent=2)
+        print(f'Saved the baseline to {args.save_baseline}')
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+====================================================================
+SIP Maker - start-up benchmark
+Times cold starts of the SIP Maker entry points, each in a fresh
+interpreter, and lists the slowest imports of each, so a heavy import
+creeping back into start-up shows up before users notice it.
+
+    python benchmarks/bench_startup.py               # source entry points
+    python benchmarks/bench_startup.py --gui         # also open the window (needs a display)
+    python benchmarks/bench_startup.py --command dist/sipmaker_cli.exe --help
+                                                     # e.g. a PyInstaller build
+
+Exits with 1 if any median is over the budget (default 1 second).
+====================================================================
+"""
+
+import argparse, statistics, subprocess, sys, time
+from os import path
+
+""" Global Variables """
+SIPMAKER_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+RUNS = 7
+BUDGET = 1.0
+# What each entry point does before it would start real work
+ENTRY_POINTS = {
+    'sipmaker_cli --help': [path.join(SIPMAKER_DIR, 'sipmaker_cli.py'), '--help'],
+    'catalog_cli --help': [path.join(SIPMAKER_DIR, 'catalog_cli.py'), '--help'],
+    'import pipeline': ['-c', 'import pipeline'],
+    # Loads the window's module without opening it
+    'SIPmaker2.0 (no window)': ['-c', f'import runpy; runpy.run_path({path.join(SIPMAKER_DIR, "SIPmaker2.0.py")!r}, '
+                                      f'run_name="bench")'],
+    }
+# Opens the window and closes it as soon as it is idle
+GUI_ENTRY = ['-c', 'import runpy, tkinter as tk\n'
+                   f'app = runpy.run_path({path.join(SIPMAKER_DIR, "SIPmaker2.0.py")!r}, run_name="bench")\n'
+                   'root = tk.Tk()\n'
+                   'app["ObjFormatter"](root)\n'
+                   'root.after_idle(root.destroy)\n'
+                   'root.mainloop()\n']
+
+
+def time_command(command, runs=RUNS):
+    """ Wall-clock seconds of each run of a command """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=SIPMAKER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def slowest_imports(args, count=5):
+    """ The top-level imports that took longest, from python -X importtime: [(ms, module)] """
+    found = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=SIPMAKER_DIR,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    imports = []
+    for line in found.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        selftime, cumulative, module = line[len('import time:'):].split('|')
+        # Top-level imports are the ones not indented under another
+        if not module.startswith('  '):
+            imports.append((int(cumulative) / 1000, module.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time cold starts of the SIP Maker entry points.')
+    parser.add_argument('--runs', type=int, default=RUNS, help=f'runs of each entry point (default: {RUNS})')
+    parser.add_argument('--budget', type=float, default=BUDGET, help=f'seconds allowed (default: {BUDGET})')
+    parser.add_argument('--gui', action='store_true', help='also time opening the window')
+    parser.add_argument('--command', nargs=argparse.REMAINDER,
+                        help='time this command instead, e.g. a frozen build')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command:
+        commands = {' '.join(args.command): (args.command, None)}
+    else:
+        commands = {name: ([sys.executable] + entry, entry) for name, entry in ENTRY_POINTS.items()}
+        if args.gui:
+            commands['SIPmaker2.0 window'] = ([sys.executable] + GUI_ENTRY, GUI_ENTRY)
+    over = False
+    for name, (command, entry) in commands.items():
+        try:
+            times = time_command(command, args.runs)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f'{name}: failed ({e})')
+            over = True
+            continue
+        median = statistics.median(times)
+        over = over or median > args.budget
+        print(f'{name}: median {median * 1000:.0f} ms, best {min(times) * 1000:.0f} ms'
+              f'{"  OVER BUDGET" if median > args.budget else ""}')
+        if entry is not None:
+            for ms, module in slowest_imports(entry):
+                print(f'    {ms:7.1f} ms  {module}')
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+====================================================================
+SIP Maker - synthetic batches
+Writes a reproducible batch of made-up objects for benchmarking: the
+same seed gives the same names, sizes and bytes every time. Objects
+are named like 'AAAA_BBB000001' and their files like
+'AAAA_BBB000001_0001a.xml', as DnDprepack expects. A master CSV for
+the metadata stage is written next to the items.
+
+    python benchmarks/synthetic_batch.py /tmp/batch --profile xml
+    python benchmarks/synthetic_batch.py /tmp/batch --profile video --scale 1   # real 20 GB MKVs
+    python benchmarks/synthetic_batch.py /tmp/batch --layout flat               # DnDprepack input
+
+Profile sizes are multiplied by --scale. Each profile has its own
+default, so the video profile (20 MB files rather than 20 GB) fits on
+a laptop unless asked otherwise.
+====================================================================
+"""
+
+import argparse, base64, csv, math, random, sys
+from os import makedirs, path
+
+""" Global Variables """
+MB = 1000000
+# objects, files per object, smallest and largest file (bytes), extensions,
+# and the default scale of the sizes
+PROFILES = {
+    # Many small XML files, as from a digitized manuscript collection
+    'xml': {'objects': 200, 'files': 20, 'min_size': 2000, 'max_size': 20000, 'extensions': ['.xml'],
+            'scale': 1},
+    # A few very large video masters
+    'video': {'objects': 3, 'files': 1, 'min_size': 20000 * MB, 'max_size': 20000 * MB, 'extensions': ['.mkv'],
+              'scale': 0.001},
+    # Page images, with their text and a PDF
+    'mixed': {'objects': 20, 'files': 12, 'min_size': 5000, 'max_size': 200 * MB,
+              'extensions': ['.tif', '.xml', '.txt', '.pdf', '.jpg'], 'scale': 0.1},
+    }
+SEED = 1
+# Written a block at a time, so large files do not sit in memory
+BLOCK = 4 * MB
+LAYOUTS = ['objects', 'flat']
+CSV_HEADROW = ['System UUID', 'Local ID', 'Responsible Org', 'Collection', 'Item Type', 'Packaged By']
+
+
+def object_name(number, prefix='AAAA_BBB'):
+    return f'{prefix}{number:06d}'
+
+
+def file_name(objname, number, extension):
+    """ 'a' and 'b' sides alternate, e.g. _0001a, _0001b, _0002a """
+    return f'{objname}_{number // 2 + 1:04d}{"ab"[number % 2]}{extension}'
+
+
+def file_size(rng, min_size, max_size):
+    """ Sizes are spread evenly on a log scale, so small files are not drowned out """
+    if max_size <= min_size:
+        return min_size
+    return int(math.exp(rng.uniform(math.log(max(1, min_size)), math.log(max_size))))
+
+
+def write_file(filepath, size, rng):
+    """ Writes size bytes from rng; XML files are text, everything else is random bytes """
+    with open(filepath, 'wb') as newfile:
+        if filepath.endswith('.xml'):
+            head = b'<?xml version="1.0" encoding="UTF-8"?>\n<record>\n'
+            tail = b'\n</record>\n'
+            body = base64.b64encode(rng.randbytes(max(0, size - len(head) - len(tail))))
+            newfile.write((head + body)[:max(0, size - len(tail))] + tail)
+            return
+        left = size
+        while left > 0:
+            chunk = min(BLOCK, left)
+            newfile.write(rng.randbytes(chunk))
+            left -= chunk
+
+
+def make_batch(folder, profile='xml', objects=None, files=None, min_size=None, max_size=None, depth=0,
+               layout='objects', scale=None, seed=SEED):
+    """
+    Writes a batch under folder: 'items' (one folder per object, files up
+    to depth subfolders deep; or every file in 'items' itself, with
+    layout='flat') and 'master.csv'. Returns a dict of the items folder,
+    the CSV, and the object, file and byte counts.
+    """
+    settings = dict(PROFILES[profile])
+    for key, value in (('objects', objects), ('files', files), ('min_size', min_size), ('max_size', max_size),
+                       ('scale', scale)):
+        if value is not None:
+            settings[key] = value
+    low = max(1, int(settings['min_size'] * settings['scale']))
+    high = max(low, int(settings['max_size'] * settings['scale']))
+    rng = random.Random(seed)
+    itemsdir = path.join(folder, 'items')
+    makedirs(itemsdir)
+    nfiles = 0
+    nbytes = 0
+    names = []
+    for o in range(settings['objects']):
+        objname = object_name(o + 1)
+        names.append(objname)
+        objdir = itemsdir if layout == 'flat' else path.join(itemsdir, objname)
+        for f in range(settings['files']):
+            extension = settings['extensions'][f % len(settings['extensions'])]
+            filedir = objdir
+            if layout != 'flat':
+                # Files go as deep as asked, spread over a few folders at each level
+                for level in range(depth):
+                    filedir = path.join(filedir, f'level{level + 1}_{(f >> level) % 2}')
+            makedirs(filedir, exist_ok=True)
+            size = file_size(rng, low, high)
+            write_file(path.join(filedir, file_name(objname, f, extension)), size, rng)
+            nfiles += 1
+            nbytes += size
+    csvfile = path.join(folder, 'master.csv')
+    with open(csvfile, 'w', encoding='UTF-8', newline='') as master:
+        cwriter = csv.writer(master)
+        cwriter.writerow(CSV_HEADROW)
+        for number, objname in enumerate(names):
+            cwriter.writerow([number + 1, objname, 'UAB', 'Synthetic', profile, 'benchmark'])
+    return {'items': itemsdir, 'csv': csvfile, 'objects': len(names), 'files': nfiles, 'bytes': nbytes}
+
+
+def add_batch_args(parser):
+    """ The batch options, shared with bench_stages.py """
+    parser.add_argument('--profile', default='xml', choices=sorted(PROFILES), help='kind of batch (default: xml)')
+    parser.add_argument('--objects', type=int, help="number of objects (default: the profile's)")
+    parser.add_argument('--files', type=int, help="files per object (default: the profile's)")
+    parser.add_argument('--min-size', type=int, help="smallest file in bytes, before scaling (default: the profile's)")
+    parser.add_argument('--max-size', type=int, help="largest file in bytes, before scaling (default: the profile's)")
+    parser.add_argument('--depth', type=int, default=0, help='subfolders between an object and its files (default: 0)')
+    parser.add_argument('--scale', type=float, help="multiplies every file size (default: the profile's)")
+    parser.add_argument('--seed', type=int, default=SEED, help=f'random seed (default: {SEED})')
+
+
+def batch_options(args):
+    return {'profile': args.profile, 'objects': args.objects, 'files': args.files, 'min_size': args.min_size,
+            'max_size': args.max_size, 'depth': args.depth, 'scale': args.scale, 'seed': args.seed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a reproducible synthetic batch for benchmarking.')
+    parser.add_argument('folder', help='new folder for the batch')
+    parser.add_argument('--layout', default='objects', choices=LAYOUTS,
+                        help="'objects' for SIP Maker, 'flat' for DnDprepack (default: objects)")
+    add_batch_args(parser)
+    args = parser.parse_args(argv)
+    if path.exists(args.folder):
+        print(f'{args.folder} already exists.', file=sys.stderr)
+        return 2
+    made = make_batch(args.folder, layout=args.layout, **batch_options(args))
+    print(f'Wrote {made["objects"]} objects, {made["files"]} files, {made["bytes"] / MB:.1f} MB to {made["items"]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Fixity catalog for SIP Maker
+Gathers every 'manifest.csv' and 'transfer_manifests/transfer_*.csv'
+into one indexed SQLite database, so questions like "which tar holds
+this file" or "what was its SHA-256 on that date" are a lookup rather
+than a grep through hundreds of CSV files.
+A source file that has not changed since it was ingested is skipped;
+a changed one is ingested again beside the old rows, so the catalog
+keeps the history of each file's digests.
+====================================================================
+"""
+
+import csv, hashlib, io, sqlite3, time
+from os import path, stat
+from walker import list_folder
+
+""" Global Variables """
+CATALOG_NAME = 'sipmaker_catalog.sqlite'
+# Rows inserted per transaction
+BATCH_ROWS = 50000
+# SQLite page cache, in megabytes
+CACHE_MB = 256
+FILE_COLUMNS = ['object', 'relpath', 'filename', 'size', 'filetype', 'modified', 'md5', 'sha256', 'checked']
+TAR_COLUMNS = ['object', 'tarname', 'md5', 'sha256', 'transferred']
+INDEXES = [('files', 'relpath'), ('files', 'filename'), ('files', 'object'), ('files', 'md5'),
+           ('files', 'sha256'), ('files', 'checked'),
+           ('tars', 'object'), ('tars', 'tarname'), ('tars', 'md5'), ('tars', 'sha256')]
+
+
+def find_sources(top):
+    """
+    Yields ('manifest' | 'transfer', path) for the SIP Maker outputs below
+    top. A folder with a 'manifest.csv' is an object, so the payload under
+    it is not walked.
+    """
+    files, subdirs = list_folder(top, hidden=False, ds_store='skip')
+    names = [entry.name for entry in files]
+    if 'manifest.csv' in names:
+        yield ('manifest', path.join(top, 'manifest.csv'))
+        return
+    if path.basename(top) == 'transfer_manifests':
+        for name in names:
+            if name.startswith('transfer_') and name.endswith('.csv'):
+                yield ('transfer', path.join(top, name))
+    for subdir in subdirs:
+        yield from find_sources(subdir)
+
+
+def object_name(manipath):
+    """ The object a 'manifest.csv' belongs to: its folder, or the bag around its 'data' folder """
+    folder = path.dirname(path.abspath(manipath))
+    if path.basename(folder) == 'data':
+        folder = path.dirname(folder)
+    return path.basename(folder)
+
+
+def transfer_date(transpath):
+    """ The time in a 'transfer_<%Y%b%d_%H%M%S>.csv' name, in the manifest date format """
+    try:
+        made = time.strptime(path.basename(transpath)[len('transfer_'):-len('.csv')], "%Y%b%d_%H%M%S")
+    except ValueError:
+        made = time.localtime(stat(transpath).st_mtime)
+    return time.strftime("%Y.%m.%d %H:%M:%S", made)
+
+
+def day_range(start, end=None):
+    """ 'YYYY.MM.DD' (or YYYY-MM-DD) days as the bounds of a ChecksumDateTime range """
+    start = start.replace('-', '.')
+    end = (end or start).replace('-', '.')
+    return (start, f'{end} 99')
+
+
+class Catalog:
+    """ The catalog database; see the module notes """
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self._db = sqlite3.connect(dbpath)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # Six indexes take new rows at once; keep their pages in memory
+        self._db.execute(f'PRAGMA cache_size=-{CACHE_MB * 1024}')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sources ('
+            'id INTEGER PRIMARY KEY, path TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER, '
+            'digest TEXT UNIQUE, ingested TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sources_path ON sources (path, size, mtime_ns)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files (source INTEGER, object TEXT, relpath TEXT, filename TEXT, '
+            'size TEXT, filetype TEXT, modified TEXT, md5 TEXT, sha256 TEXT, checked TEXT)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS tars (source INTEGER, object TEXT, tarname TEXT, '
+            'md5 TEXT, sha256 TEXT, transferred TEXT)')
+        self.create_indexes()
+        self.pending = 0
+
+    def create_indexes(self):
+        for table, column in INDEXES:
+            self._db.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})')
+        self._db.commit()
+
+    def drop_indexes(self):
+        for table, column in INDEXES:
+            self._db.execute(f'DROP INDEX IF EXISTS {table}_{column}')
+        self._db.commit()
+
+    def _source(self, sourcepath, kind):
+        """ Registers a source file and returns (id, content), or None if it is already in the catalog """
+        statinfo = stat(sourcepath)
+        abspath = path.abspath(sourcepath)
+        if self._db.execute('SELECT 1 FROM sources WHERE path=? AND size=? AND mtime_ns=?',
+                            (abspath, statinfo.st_size, statinfo.st_mtime_ns)).fetchone():
+            return None
+        with open(sourcepath, 'rb') as sfile:
+            content = sfile.read()
+        digest = hashlib.sha256(content).hexdigest()
+        known = self._db.execute('SELECT id FROM sources WHERE digest=?', (digest,)).fetchone()
+        if known is not None:
+            # The same file seen elsewhere, e.g. 'manifest.csv' moved into a bag
+            self._db.execute('UPDATE sources SET path=?, size=?, mtime_ns=? WHERE id=?',
+                             (abspath, statinfo.st_size, statinfo.st_mtime_ns, known[0]))
+            return None
+        found = self._db.execute('INSERT INTO sources (path, kind, size, mtime_ns, digest, ingested) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)',
+                                 (abspath, kind, statinfo.st_size, statinfo.st_mtime_ns, digest,
+                                  time.strftime("%Y.%m.%d %H:%M:%S")))
+        return found.lastrowid, content.decode('UTF-8')
+
+    def _insert(self, table, columns, rows):
+        marks = ', '.join('?' * (len(columns) + 1))
+        self._db.executemany(f'INSERT INTO {table} (source, {", ".join(columns)}) VALUES ({marks})', rows)
+        self.pending += len(rows)
+        if self.pending >= BATCH_ROWS:
+            self._db.commit()
+            self.pending = 0
+
+    def ingest_manifest(self, manipath):
+        """ Adds one 'manifest.csv'. Returns the number of files added """
+        found = self._source(manipath, 'manifest')
+        if found is None:
+            return 0
+        source, content = found
+        obj = object_name(manipath)
+        rows = []
+        added = 0
+        for row in csv.DictReader(io.StringIO(content, newline='')):
+            rows.append((source, obj, row['Relative Path'].replace('\\', '/'), row['Filename'], row['Filesize'],
+                         row['Filetype'], row['Modified'], row['MD5'].lower(), row['SHA256'].lower(),
+                         row['ChecksumDateTime']))
+            if len(rows) >= BATCH_ROWS:
+                self._insert('files', FILE_COLUMNS, rows)
+                added += len(rows)
+                rows = []
+        self._insert('files', FILE_COLUMNS, rows)
+        return added + len(rows)
+
+    def ingest_transfer(self, transpath):
+        """ Adds one transfer manifest (tar name, MD5, SHA-256 rows). Returns the number of tars added """
+        found = self._source(transpath, 'transfer')
+        if found is None:
+            return 0
+        source, content = found
+        transferred = transfer_date(transpath)
+        rows = []
+        for row in csv.reader(io.StringIO(content, newline='')):
+            if len(row) < 3:
+                continue
+            tarname = row[0]
+            rows.append((source, tarname.split('.tar')[0], tarname, row[1].lower(), row[2].lower(), transferred))
+        self._insert('tars', TAR_COLUMNS, rows)
+        return len(rows)
+
+    def ingest(self, folders, log=None, bulk=None):
+        """
+        Adds every output found below the folders, in one pass. Returns
+        [manifests, files, transfer manifests, tars] newly added.
+        With bulk=True the indexes are dropped and built again afterwards,
+        which is several times faster than updating them row by row when
+        the new rows outnumber the old; by default that is done when the
+        catalog is empty.
+        """
+        counts = [0, 0, 0, 0]
+        if bulk is None:
+            bulk = self._db.execute('SELECT COUNT(*) FROM sources').fetchone()[0] == 0
+        if bulk:
+            self.drop_indexes()
+        try:
+            for folder in folders:
+                for kind, sourcepath in find_sources(folder):
+                    if kind == 'manifest':
+                        added = self.ingest_manifest(sourcepath)
+                        counts[0] += added > 0
+                        counts[1] += added
+                    else:
+                        added = self.ingest_transfer(sourcepath)
+                        counts[2] += added > 0
+                        counts[3] += added
+                    if log is not None and added > 0:
+                        log(f'{sourcepath}: {added}')
+        finally:
+            self._db.commit()
+            self.pending = 0
+            if bulk:
+                self.create_indexes()
+        return counts
+
+    def _files(self, where, params, limit):
+        query = (f'SELECT DISTINCT {", ".join(FILE_COLUMNS)} FROM files WHERE {where} '
+                 f'ORDER BY object, relpath, checked DESC')
+        if limit:
+            query += f' LIMIT {int(limit)}'
+        return [dict(zip(FILE_COLUMNS, row)) for row in self._db.execute(query, params)]
+
+    def by_path(self, pattern, on=None, limit=None):
+        """
+        Files whose Relative Path or file name matches a glob pattern
+        ('*' and '?'). Patterns that start with a literal are looked up in
+        the index; a leading '*' has to read every row. With on='YYYY.MM.DD'
+        only the latest record of each file as of that day is returned.
+        """
+        where = '(relpath GLOB ? OR filename GLOB ?)'
+        params = [pattern, pattern]
+        if on is not None:
+            where += ' AND checked <= ?'
+            params.append(day_range(on)[1])
+        found = self._files(where, params, None if on else limit)
+        if on is None:
+            return found
+        latest = []
+        for row in found:
+            if not latest or not (latest[-1]['object'], latest[-1]['relpath']) == (row['object'], row['relpath']):
+                latest.append(row)
+        return latest[:limit] if limit else latest
+
+    def by_digest(self, digest, limit=None):
+        """ Files with an MD5 (32 hex digits) or SHA-256 (64) """
+        column = 'md5' if len(digest) == 32 else 'sha256'
+        return self._files(f'{column} = ?', [digest.lower()], limit)
+
+    def by_object(self, obj, limit=None):
+        return self._files('object = ?', [obj], limit)
+
+    def by_date(self, start, end=None, limit=None):
+        """ Files whose digests were made from day start to day end (inclusive) """
+        return self._files('checked BETWEEN ? AND ?', list(day_range(start, end)), limit)
+
+    def tars(self, obj=None, digest=None):
+        """ The tars transferred for an object, or with a digest, newest first """
+        if digest is not None:
+            column = 'md5' if len(digest) == 32 else 'sha256'
+            where, params = f'{column} = ?', [digest.lower()]
+        else:
+            where, params = 'object = ?', [obj]
+        query = f'SELECT DISTINCT {", ".join(TAR_COLUMNS)} FROM tars WHERE {where} ORDER BY transferred DESC'
+        return [dict(zip(TAR_COLUMNS, row)) for row in self._db.execute(query, params)]
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+====================================================================
+SIP Maker - fixity catalog command line
+Ingests the 'manifest.csv' and transfer manifests SIP Maker wrote, and
+looks files up by path, digest, object or date. Results are CSV on
+standard output, with the tars each file's object was transferred in.
+
+Examples:
+    python catalog_cli.py ingest /data/items /data/processing
+    python catalog_cli.py path 'AAAA_BBB000123_0001/*.tif'
+    python catalog_cli.py path 'AAAA_BBB000123_0001/page_001.tif' --on 2024.03.01
+    python catalog_cli.py digest 9e107d9d372bb6826bd81d3542a419d6
+    python catalog_cli.py object AAAA_BBB000123_0001
+    python catalog_cli.py date 2024.03.01 --until 2024.03.31
+====================================================================
+"""
+
+import argparse, csv, sys
+from os import path
+from catalog import CATALOG_NAME, FILE_COLUMNS, Catalog
+
+""" Exit codes """
+EXIT_OK = 0
+EXIT_NOT_FOUND = 1
+EXIT_USAGE = 2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Query the fixity records of SIP Maker batches.')
+    parser.add_argument('--db', default=CATALOG_NAME, help=f'catalog database (default: {CATALOG_NAME})')
+    query = argparse.ArgumentParser(add_help=False)
+    query.add_argument('--limit', type=int, default=0, help='most rows to show (default: all)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest = commands.add_parser('ingest', help='add the manifests found below some folders')
+    ingest.add_argument('folders', nargs='+', help='Folders of Items, bags or Processing Folders')
+    ingest.add_argument('-v', '--verbose', action='store_true', help='list each file ingested')
+    ingest.add_argument('--bulk', action='store_true', default=None,
+                        help='rebuild the indexes afterwards; faster when adding more rows than the catalog holds')
+    bypath = commands.add_parser('path', parents=[query], help="files by Relative Path or name ('*' and '?' allowed)")
+    bypath.add_argument('pattern')
+    bypath.add_argument('--on', help='the record as of this day (YYYY.MM.DD)')
+    bydigest = commands.add_parser('digest', parents=[query], help='files and tars by MD5 or SHA-256')
+    bydigest.add_argument('digest')
+    byobject = commands.add_parser('object', parents=[query], help='files of an object, e.g. its Local ID')
+    byobject.add_argument('object')
+    bydate = commands.add_parser('date', parents=[query], help='files whose checksums were made on a day (YYYY.MM.DD)')
+    bydate.add_argument('day')
+    bydate.add_argument('--until', help='last day of a range')
+    return parser.parse_args(argv)
+
+
+def write_files(catalog, rows):
+    """ Writes file rows as CSV, each with its object's tars """
+    writer = csv.writer(sys.stdout)
+    writer.writerow(FILE_COLUMNS + ['tars'])
+    tars = {}
+    for row in rows:
+        if row['object'] not in tars:
+            tars[row['object']] = ';'.join(t['tarname'] for t in catalog.tars(obj=row['object']))
+        writer.writerow([row[column] for column in FILE_COLUMNS] + [tars[row['object']]])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'ingest':
+        for folder in args.folders:
+            if not path.isdir(folder):
+                print(f'Folder \'{folder}\' not found.', file=sys.stderr)
+                return EXIT_USAGE
+    catalog = Catalog(args.db)
+    try:
+        if args.command == 'ingest':
+            log = (lambda message: print(message, file=sys.stderr)) if args.verbose else None
+            manifests, files, transfers, tars = catalog.ingest(args.folders, log, args.bulk)
+            print(f'manifests: {manifests}\nfiles: {files}\ntransfer_manifests: {transfers}\ntars: {tars}')
+            return EXIT_OK
+        if args.command == 'path':
+            rows = catalog.by_path(args.pattern, args.on, args.limit)
+        elif args.command == 'digest':
+            if len(args.digest) not in (32, 64):
+                print('Give an MD5 (32 hex digits) or SHA-256 (64 hex digits).', file=sys.stderr)
+                return EXIT_USAGE
+            rows = catalog.by_digest(args.digest, args.limit)
+            if not rows:
+                # A tar's own digest, from a transfer manifest
+                found = catalog.tars(digest=args.digest)
+                for tar in found:
+                    print(f'{tar["tarname"]},{tar["md5"]},{tar["sha256"]},{tar["transferred"]}')
+                return EXIT_OK if found else EXIT_NOT_FOUND
+        elif args.command == 'object':
+            rows = catalog.by_object(args.object, args.limit)
+        else:
+            rows = catalog.by_date(args.day, args.until, args.limit)
+        write_files(catalog, rows)
+        return EXIT_OK if rows else EXIT_NOT_FOUND
+    finally:
+        catalog.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Duplicate index for SIP Maker
+Every file the inventory sees is recorded, by SHA-256, in a SQLite
+database in the Processing Folder. The same content scanned into
+several objects, in this batch or an earlier one, is then one index
+lookup away, and each batch gets a report of its duplicates and of
+the bytes that preserving only one copy would save.
+====================================================================
+"""
+
+import csv, sqlite3, threading, time
+from os import mkdir, path
+
+""" Global Variables """
+DUPLICATES_NAME = 'duplicate_index.sqlite'
+REPORT_HEADROW = ['SHA256', 'Bytes', 'Object', 'Relative Path', 'Batch', 'Copy']
+# Files recorded per INSERT batch
+FLUSH_ROWS = 10000
+# SQLite page cache, in megabytes
+CACHE_MB = 256
+
+
+class DuplicateIndex:
+    """
+    Files keyed by (object, Relative Path), with an index on the digest.
+    Digests are stored as 32 raw bytes, and the digest index holds only
+    them and the rowid, so at tens of millions of files as much of it as
+    possible stays in the page cache.
+    Objects are known by their folder name, so an object inventoried
+    again in a later batch replaces its earlier entries.
+    """
+    def __init__(self, dbpath, batch=None):
+        self.dbpath = dbpath
+        # Sortable, so earlier batches come first in a report
+        self.batch = batch or time.strftime("%Y%m%d_%H%M%S")
+        self.pending = []
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(dbpath, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # Random digests land all over the index; keep more of it in memory
+        self._db.execute(f'PRAGMA cache_size=-{CACHE_MB * 1024}')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'object TEXT, relpath TEXT, sha256 BLOB, size INTEGER, batch TEXT, '
+            'PRIMARY KEY (object, relpath))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_batch ON files (batch)')
+        self._db.commit()
+
+    def begin(self, objpath):
+        """ Forgets what an earlier inventory of the object recorded """
+        with self._lock:
+            self._db.execute('DELETE FROM files WHERE object=?', (path.basename(objpath),))
+
+    def add(self, objpath, relpath, sha256, size):
+        with self._lock:
+            self.pending.append((path.basename(objpath), relpath.replace('\\', '/'), bytes.fromhex(sha256),
+                                 size, self.batch))
+            if len(self.pending) >= FLUSH_ROWS:
+                self._flush()
+
+    def finish(self, objpath):
+        """ Commits the object, once its 'manifest.csv' is written """
+        with self._lock:
+            self._flush()
+            self._db.commit()
+
+    def _flush(self):
+        # Called with the lock held
+        self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', self.pending)
+        self.pending = []
+
+    def duplicates(self, batch=None):
+        """
+        Yields a list of (sha256, size, object, relpath, batch) for each
+        digest held by more than one file, if at least one of them is in
+        the batch (by default this one). Oldest copy first.
+        """
+        with self._lock:
+            self._flush()
+            self._db.commit()
+            found = self._db.execute(
+                'WITH here AS (SELECT DISTINCT sha256 FROM files WHERE batch=?), '
+                'dup AS (SELECT sha256 FROM files JOIN here USING (sha256) GROUP BY sha256 HAVING COUNT(*) > 1) '
+                'SELECT sha256, size, object, relpath, batch FROM files JOIN dup USING (sha256) '
+                'ORDER BY sha256, batch, object, relpath', (batch or self.batch,)).fetchall()
+        group = []
+        for row in found:
+            row = (row[0].hex(),) + tuple(row[1:])
+            if group and not row[0] == group[0][0]:
+                yield group
+                group = []
+            group.append(row)
+        if group:
+            yield group
+
+    def report(self, reportdir):
+        """
+        Writes 'duplicates_<batch>.csv' to reportdir if this batch has any
+        duplicates. Returns [report path or None, duplicate files, bytes
+        that keeping one copy of each would save].
+        """
+        copies = 0
+        saved = 0
+        reportpath = None
+        rfile = None
+        try:
+            for group in self.duplicates():
+                if rfile is None:
+                    if not path.isdir(reportdir):
+                        mkdir(reportdir)
+                    reportpath = path.join(reportdir, f'duplicates_{self.batch}.csv')
+                    rfile = open(reportpath, 'w', newline='', encoding='UTF-8')
+                    rwriter = csv.writer(rfile)
+                    rwriter.writerow(REPORT_HEADROW)
+                copies += len(group) - 1
+                saved += group[0][1] * (len(group) - 1)
+                for n, (sha256, size, obj, relpath, batch) in enumerate(group):
+                    rwriter.writerow([sha256, size, obj, relpath, batch, 'first' if n == 0 else 'duplicate'])
+        finally:
+            if rfile is not None:
+                rfile.close()
+        return [reportpath, copies, saved]
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.commit()
+            self._db.close()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Fixity helpers for SIP Maker
+Reads each file once and feeds every requested digest from the same
+buffer, so large TIFF/WAV/MKV files are not re-read once per algorithm.
+Files are read into one reusable buffer per thread, or, when they are
+large and on a local disk, hashed straight from a memory map; either
+way no new bytes object is made per chunk. The OS is told how each
+file will be read (see iohints.py).
+====================================================================
+"""
+
+import hashlib, mmap, os, re, sqlite3, tempfile, threading, time
+from os import chmod, fstat, fsync, path, remove, replace, stat, umask
+from iohints import ReadHints, check_hints
+
+""" Global Variables """
+# Large reads keep the Python loop out of the way on multi-GB files
+CHUNKSIZE = 8 * 1024 * 1024
+# How files are read for hashing: 'auto' picks per file (see read_strategy)
+READ_STRATEGIES = ('auto', 'readinto', 'mmap')
+READ_STRATEGY = 'auto'
+# 'auto' memory-maps local files of at least this size
+MMAP_MIN_SIZE = 64 * 1024 * 1024
+# A mapped file that shrinks on the server crashes the process, so
+# network filesystems are always read instead
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', '9p', 'afs', 'ceph', 'glusterfs', 'lustre',
+                       'davfs', 'fuse.sshfs', 'fuse.rclone', 'fuse.s3fs', 'fuse.glusterfs')
+# Digests that SIPmaker knows how to generate, in hashlib naming
+ALGORITHMS = ('md5', 'sha256', 'sha3_256', 'sha512')
+DEFAULT_ALGORITHMS = ('md5', 'sha256')
+# Size limit for the on-disk digest cache, in megabytes
+CACHE_MB = 512
+CACHE_NAME = 'fixity_cache.sqlite'
+# Read once, at import: umask() can only be read by setting it
+UMASK = umask(0o022)
+umask(UMASK)
+
+
+def stat_key(statinfo):
+    """ What identifies one version of a file: (device, inode, size in bytes, mtime in ns) """
+    return (statinfo.st_dev, statinfo.st_ino, statinfo.st_size, statinfo.st_mtime_ns)
+
+
+def new_hashers(algorithms=DEFAULT_ALGORITHMS):
+    """ Returns a dict of fresh hashlib objects, keyed by algorithm """
+    hashers = {}
+    for alg in algorithms:
+        if alg not in ALGORITHMS:
+            raise ValueError(f'Unsupported checksum algorithm: {alg}')
+        hashers[alg] = hashlib.new(alg)
+    return hashers
+
+
+_buffers = threading.local()
+_mounts = None
+
+
+def read_buffer(chunksize=CHUNKSIZE):
+    """ A buffer of chunksize bytes, reused for every file the calling thread hashes """
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != chunksize:
+        buf = _buffers.buf = bytearray(chunksize)
+    return buf
+
+
+def mount_table():
+    """ [(mount point, filesystem type)] from /proc/self/mounts, longest first; read once """
+    global _mounts
+    if _mounts is None:
+        mounts = []
+        try:
+            with open('/proc/self/mounts', 'r', encoding='UTF-8') as mfile:
+                for line in mfile:
+                    fields = line.split()
+                    if len(fields) >= 3:
+                        # Spaces etc. in mount points are octal escapes (\040); nothing else is escaped
+                        mountpoint = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+                        mounts.append((mountpoint, fields[2]))
+        except OSError:
+            pass
+        _mounts = sorted(mounts, key=lambda m: len(m[0]), reverse=True)
+    return _mounts
+
+
+def is_local_file(filepath):
+    """ True if filepath is known to be on a local disk; False if remote or unknown """
+    fullpath = path.realpath(filepath)
+    if os.name == 'nt':
+        if fullpath.startswith('\\\\'):
+            return False
+        import ctypes
+        # 3 is DRIVE_FIXED
+        return ctypes.windll.kernel32.GetDriveTypeW(path.splitdrive(fullpath)[0] + '\\') == 3
+    for mountpoint, fstype in mount_table():
+        if fullpath == mountpoint or fullpath.startswith(mountpoint.rstrip('/') + '/'):
+            return fstype not in NETWORK_FILESYSTEMS
+    return False
+
+
+def read_strategy(filepath, size, strategy=None, hints=None):
+    """
+    'mmap' for large files on local disks, otherwise 'readinto', unless
+    one is chosen. Mapped pages cannot be dropped as they are read, so
+    'stream' I/O hints (see iohints.py) always read.
+    """
+    strategy = strategy or READ_STRATEGY
+    if strategy not in READ_STRATEGIES:
+        raise ValueError(f'Unknown read strategy: {strategy}')
+    if size == 0:
+        # Empty files cannot be mapped
+        return 'readinto'
+    if strategy == 'auto':
+        if check_hints(hints) == 'stream':
+            return 'readinto'
+        return 'mmap' if size >= MMAP_MIN_SIZE and is_local_file(filepath) else 'readinto'
+    return strategy
+
+
+def multi_hash(filepath, algorithms=DEFAULT_ALGORITHMS, chunksize=CHUNKSIZE, cache=None, strategy=None,
+               hints=None):
+    """
+    Generates several digests in a single pass over the file.
+    Returns a dict of hex digests, keyed by algorithm.
+    If a FixityCache is given, unchanged files are answered from it.
+    """
+    if cache is not None:
+        statinfo = stat(filepath)
+        digests = cache.lookup(statinfo, algorithms)
+        if digests is None:
+            digests = multi_hash(filepath, algorithms, chunksize, strategy=strategy, hints=hints)
+            cache.store(statinfo, digests, filepath)
+        return digests
+    return multi_hash_head(filepath, algorithms, 0, chunksize, strategy, hints)[0]
+
+
+def multi_hash_head(filepath, algorithms=DEFAULT_ALGORITHMS, head_bytes=0, chunksize=CHUNKSIZE, strategy=None,
+                    hints=None):
+    """
+    multi_hash(), also returning the first head_bytes of the file from the
+    same read, e.g. for format identification: (digests, head).
+    'hints' is an iohints mode, by default iohints.IO_HINTS.
+    """
+    hashers = new_hashers(algorithms)
+    updaters = [h.update for h in hashers.values()]
+    head = b''
+    with open(filepath, 'rb', buffering=0) as infile:
+        size = fstat(infile.fileno()).st_size
+        advice = ReadHints(infile.fileno(), hints)
+        if read_strategy(filepath, size, strategy, hints) == 'mmap':
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                head = mapped[:head_bytes]
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(mapped), chunksize):
+                        # Views of the map must be released before it is closed
+                        with view[offset:offset + chunksize] as chunk:
+                            for update in updaters:
+                                update(chunk)
+        else:
+            buf = read_buffer(chunksize)
+            offset = 0
+            with memoryview(buf) as view:
+                while True:
+                    nbytes = infile.readinto(buf)
+                    if not nbytes:
+                        break
+                    with view[:nbytes] as chunk:
+                        if len(head) < head_bytes:
+                            head += bytes(chunk[:head_bytes - len(head)])
+                        for update in updaters:
+                            update(chunk)
+                    offset += nbytes
+                    advice.consumed(offset)
+        advice.done()
+    return {alg: h.hexdigest() for alg, h in hashers.items()}, head
+
+
+def multi_hash_bytes(data, algorithms=DEFAULT_ALGORITHMS):
+    """ Same as multi_hash, for content that is already in memory """
+    hashers = new_hashers(algorithms)
+    for h in hashers.values():
+        h.update(data)
+    return {alg: h.hexdigest() for alg, h in hashers.items()}
+
+
+def replace_file(temppath, filepath):
+    """
+    Renames a finished temporary file over filepath, giving it the mode of
+    the file it replaces (or the usual one for a new file), since
+    temporary files are only readable by their owner
+    """
+    if path.exists(filepath):
+        chmod(temppath, stat(filepath).st_mode & 0o7777)
+    else:
+        chmod(temppath, 0o666 & ~UMASK)
+    replace(temppath, filepath)
+
+
+def write_atomic(filepath, data):
+    """
+    Writes bytes to a temporary file beside filepath and renames it into
+    place, so readers never see a half-written file
+    """
+    fd, temppath = tempfile.mkstemp(dir=path.dirname(filepath), prefix=f'.{path.basename(filepath)}.')
+    try:
+        with open(fd, 'wb') as tempfile_out:
+            tempfile_out.write(data)
+            tempfile_out.flush()
+            fsync(tempfile_out.fileno())
+        replace_file(temppath, filepath)
+    except BaseException:
+        if path.exists(temppath):
+            remove(temppath)
+        raise
+
+
+def read_manifest(manipath):
+    """ Returns the entries of a BagIt style manifest as {relative path: digest} """
+    entries = {}
+    with open(manipath, 'r', encoding='UTF-8') as manifile:
+        for line in manifile:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            digest, relpath = line.split(None, 1)
+            # BagIt percent-encodes line breaks in file names
+            relpath = relpath.strip().replace('%0A', '\n').replace('%0D', '\r')
+            entries[relpath] = digest.lower()
+    return entries
+
+
+def verify_manifest(basedir, manifest_name, algorithm, cache=None):
+    """
+    Checks every 'digest  path' line of a BagIt style manifest against
+    the files under basedir. Returns a list of problems (empty if valid).
+    """
+    problems = []
+    for relpath, expected in read_manifest(path.join(basedir, manifest_name)).items():
+        filepath = path.join(basedir, relpath)
+        if not path.isfile(filepath):
+            problems.append(f'{relpath} is listed in {manifest_name} but missing')
+            continue
+        found = multi_hash(filepath, [algorithm], cache=cache)[algorithm]
+        if not found == expected:
+            problems.append(f'{relpath} {algorithm} mismatch: expected {expected}, found {found}')
+    return problems
+
+
+class FixityCache:
+    """
+    On-disk digest cache, keyed by (st_dev, st_ino, size, mtime_ns).
+    A file that has not been touched since it was hashed keeps its key
+    when it is moved within the same volume (e.g. into a bag's 'data'
+    folder), so later stages only pay for a stat.
+    With trust=False every lookup misses, forcing a full rehash, but the
+    fresh digests are still written back.
+    """
+    def __init__(self, dbpath, trust=True, max_mb=CACHE_MB):
+        self.dbpath = dbpath
+        self.trust = trust
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(dbpath, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+            'md5 TEXT, sha256 TEXT, sha3_256 TEXT, sha512 TEXT, '
+            'filepath TEXT, last_used REAL, '
+            'PRIMARY KEY (dev, ino, size, mtime_ns))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)')
+        # What the content says about its format is kept by SHA-256 (see formats.py)
+        self._db.execute('CREATE TABLE IF NOT EXISTS formats (sha256 TEXT PRIMARY KEY, format TEXT, version INTEGER)')
+        self._db.commit()
+
+    def _key(self, statinfo):
+        return stat_key(statinfo)
+
+    def lookup(self, statinfo, algorithms=DEFAULT_ALGORITHMS):
+        """ Returns the cached digests for a stat result, or None on a miss """
+        if not self.trust:
+            self.misses += 1
+            return None
+        columns = ', '.join(algorithms)
+        with self._lock:
+            found = self._db.execute(
+                f'SELECT {columns} FROM digests WHERE dev=? AND ino=? AND size=? AND mtime_ns=?',
+                self._key(statinfo)).fetchone()
+            if found is None or None in found:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE digests SET last_used=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=?',
+                             (time.time(),) + self._key(statinfo))
+            self._tick()
+        self.hits += 1
+        return dict(zip(algorithms, found))
+
+    def store(self, statinfo, digests, filepath=''):
+        """ Records digests for a stat result, keeping any other algorithms already known """
+        for alg in digests:
+            if alg not in ALGORITHMS:
+                raise ValueError(f'Unsupported checksum algorithm: {alg}')
+        values = [digests.get(alg) for alg in ALGORITHMS]
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (dev, ino, size, mtime_ns) DO UPDATE SET '
+                'md5=COALESCE(excluded.md5, md5), sha256=COALESCE(excluded.sha256, sha256), '
+                'sha3_256=COALESCE(excluded.sha3_256, sha3_256), sha512=COALESCE(excluded.sha512, sha512), '
+                'filepath=excluded.filepath, last_used=excluded.last_used',
+                list(self._key(statinfo)) + values + [filepath, time.time()])
+            self._tick()
+
+    def lookup_format(self, sha256, version):
+        """ The format recorded for some content by that version of the signatures, or None """
+        with self._lock:
+            found = self._db.execute('SELECT format FROM formats WHERE sha256=? AND version=?',
+                                     (sha256, version)).fetchone()
+        if found is None:
+            return None
+        return found[0]
+
+    def store_format(self, sha256, fileformat, version):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO formats VALUES (?, ?, ?)', (sha256, fileformat, version))
+            self._tick()
+
+    def _tick(self):
+        """ Commits in batches; WAL mode keeps readers working meanwhile """
+        self._pending += 1
+        if self._pending >= 1000:
+            self._db.commit()
+            self._pending = 0
+
+    def evict(self):
+        """ Drops the least recently used entries until the cache fits in max_mb """
+        with self._lock:
+            self._db.commit()
+            page_size = self._db.execute('PRAGMA page_size').fetchone()[0]
+            while True:
+                pages = self._db.execute('PRAGMA page_count').fetchone()[0]
+                free = self._db.execute('PRAGMA freelist_count').fetchone()[0]
+                entries = self._db.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+                if (pages - free) * page_size <= self.max_bytes or entries == 0:
+                    break
+                # Remove the oldest tenth per round
+                self._db.execute(
+                    'DELETE FROM digests WHERE rowid IN '
+                    '(SELECT rowid FROM digests ORDER BY last_used LIMIT ?)', (max(1, entries // 10),))
+                self._db.commit()
+            self._db.execute('DELETE FROM formats WHERE sha256 NOT IN (SELECT sha256 FROM digests)')
+            self._db.commit()
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._db.commit()
+            self._db.close()
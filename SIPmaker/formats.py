@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Format identification for SIP Maker
+Names the format of a file from the signature in its first few KB
+(the 'magic number'), which the hashing pass has already read, and
+falls back to the file extension only when the content says nothing.
+What the content says is kept by SHA-256, so a file that was hashed
+before, or a copy of one, is identified without being opened again;
+the extension is applied afresh for each file, as copies of the same
+bytes (an empty file, text or CSV, a ZIP or a DOCX) may be named for
+different formats.
+====================================================================
+"""
+
+import mimetypes
+
+""" Global Variables """
+# Enough for the ISO 9660/UDF volume descriptors at 32 KB in
+SNIFF_BYTES = 40 * 1024
+# Bump when the signatures change, so cached results are worked out again
+FORMATS_VERSION = 2
+UNKNOWN = 'application/octet-stream'
+# Containers shared by many formats: the extension is more telling, if known
+GENERIC = {'application/zip', 'application/x-ole-storage', 'application/xml', 'image/tiff',
+           'application/x-msdownload', 'application/gzip'}
+
+
+def riff_type(head):
+    return {b'WAVE': 'audio/x-wav', b'AVI ': 'video/x-msvideo',
+            b'WEBP': 'image/webp'}.get(head[8:12])
+
+
+def ftyp_type(head):
+    brand = head[8:12]
+    if brand == b'qt  ':
+        return 'video/quicktime'
+    if brand in (b'M4A ', b'M4B '):
+        return 'audio/mp4'
+    if brand in (b'heic', b'heix', b'mif1'):
+        return 'image/heic'
+    return 'video/mp4'
+
+
+def jp2_type(head):
+    return {b'jpx ': 'image/jpx', b'jpm ': 'image/jpm'}.get(head[20:24], 'image/jp2')
+
+
+def ebml_type(head):
+    if b'webm' in head[:64]:
+        return 'video/webm'
+    return 'video/x-matroska'
+
+
+def disc_image(head):
+    # Volume descriptors sit in the 2 KB sectors from 16 on
+    for offset in (0x8001, 0x8801, 0x9001):
+        if head[offset:offset + 5] in (b'CD001', b'BEA01', b'NSR02', b'NSR03'):
+            return 'application/x-iso9660-image'
+    return None
+
+
+def mpeg_ts(head):
+    if len(head) >= 377 and head[0] == head[188] == head[376] == 0x47:
+        return 'video/mp2t'
+    return None
+
+
+def tar_type(head):
+    if head[257:262] == b'ustar':
+        return 'application/x-tar'
+    return None
+
+
+""" Global Variable for the signatures: (offset, magic bytes, format or function of the head) """
+SIGNATURES = [
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'II+\x00', 'image/tiff'),
+    (0, b'MM\x00+', 'image/tiff'),
+    (0, b'\x00\x00\x00\x0cjP  \r\n\x87\n', jp2_type),
+    (0, b'\xff\x4f\xff\x51', 'image/x-jp2-codestream'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'8BPS', 'image/vnd.adobe.photoshop'),
+    (0, b'SDPX', 'image/x-dpx'),
+    (0, b'XPDS', 'image/x-dpx'),
+    (0, b'RIFF', riff_type),
+    (0, b'RF64', riff_type),
+    (0, b'FORM', lambda head: 'audio/x-aiff' if head[8:12] in (b'AIFF', b'AIFC') else None),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'\x1a\x45\xdf\xa3', ebml_type),
+    (4, b'ftyp', ftyp_type),
+    (4, b'moov', 'video/quicktime'),
+    (4, b'mdat', 'video/quicktime'),
+    (4, b'wide', 'video/quicktime'),
+    (0, b'\x00\x00\x01\xba', 'video/mpeg'),
+    (0, b'\x00\x00\x01\xb3', 'video/mpeg'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'%!PS', 'application/postscript'),
+    (0, b'{\\rtf', 'application/rtf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (0, b'MZ', 'application/x-msdownload'),
+    (0, b'<?xml', 'application/xml'),
+    (0, b'', disc_image),
+    (0, b'', mpeg_ts),
+    (0, b'', tar_type),
+]
+
+
+def sniff(head):
+    """ The format named by the signature at the start of head, or None """
+    for offset, magic, found in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            if callable(found):
+                found = found(head)
+            if found is not None:
+                return found
+    return None
+
+
+def looks_like_text(head):
+    if not head or b'\x00' in head:
+        return False
+    try:
+        # A multi-byte character may be cut off at the end of the head
+        head.decode('UTF-8')
+    except UnicodeDecodeError as e:
+        return e.start >= len(head) - 3
+    return True
+
+
+def content_format(head):
+    """
+    What the first SNIFF_BYTES of a file say on their own: the format of
+    its signature, or 'text/plain' or UNKNOWN when it has none. This is
+    the part of identify() that FormatCache keeps.
+    """
+    found = sniff(head)
+    if found is not None:
+        return found
+    if looks_like_text(head):
+        return 'text/plain'
+    return UNKNOWN
+
+
+def with_extension(found, filename):
+    """
+    The MIME type of a file from content_format() of its head. A specific
+    signature wins; for shared containers (ZIP, OLE, XML, TIFF) and for
+    content with no signature, the extension is used if it is known.
+    """
+    if found not in GENERIC and found not in ('text/plain', UNKNOWN):
+        return found
+    guessed = mimetypes.guess_type(filename)[0]
+    if guessed is not None:
+        return guessed
+    return found
+
+
+def identify(head, filename):
+    """ The MIME type of a file from the first SNIFF_BYTES of its content and its name """
+    return with_extension(content_format(head), filename)
+
+
+def identify_file(filepath):
+    """ identify() for a file that has not been read yet; only its head is read """
+    with open(filepath, 'rb') as infile:
+        return identify(infile.read(SNIFF_BYTES), filepath)
+
+
+class FormatCache:
+    """
+    content_format() of content already seen, keyed by SHA-256, in memory
+    and, if a FixityCache is given, in its database for later runs. Pass
+    what it returns through with_extension() for each file.
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.known = {}
+
+    def get(self, sha256):
+        found = self.known.get(sha256)
+        if found is None and self.cache is not None:
+            found = self.cache.lookup_format(sha256, FORMATS_VERSION)
+            if found is not None:
+                self.known[sha256] = found
+        return found
+
+    def put(self, sha256, found):
+        if self.known.get(sha256) == found:
+            return
+        self.known[sha256] = found
+        if self.cache is not None:
+            self.cache.store_format(sha256, found, FORMATS_VERSION)
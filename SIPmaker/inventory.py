@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Inventory engine for SIP Maker
+Generates the 'manifest.csv' for each object, hashing files on a pool
+of worker threads or processes. hashlib releases the GIL on large
+buffers, so threads are the default; processes are available for
+boxes where the interpreter itself becomes the bottleneck.
+An existing 'manifest.csv' can be brought up to date instead: only new
+files and files whose exact size, mtime, inode or device changed are
+hashed again (see row_matches).
+====================================================================
+"""
+
+import csv, heapq, math, tempfile, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import cpu_count, fsync, path, remove, sep
+from fixity import multi_hash_head, replace_file, stat_key
+from formats import SNIFF_BYTES, FormatCache, content_format, with_extension
+from walker import WALK_THREADS, entry_stat, walk_files
+
+""" Global Variables """
+HEADROW = ['Filename', 'Relative Path', 'Filesize', 'Filetype', 'C-Time', 'Modified', 'Accessed',
+           'MD5', 'SHA256', 'ChecksumDateTime', 'mode', 'inode',
+           'device', 'enlink', 'user', 'group', 'bytes', 'mtime_ns']
+POOL_MODES = ('thread', 'process')
+DEFAULT_WORKERS = min(16, cpu_count() or 1)
+# Number of queued files per worker; keeps memory flat on huge objects
+QUEUE_DEPTH = 4
+# Rows of one manifest kept in memory; past this, sorted runs are spilled to disk
+SORT_RUN_ROWS = 200000
+
+
+def convert_size(size):
+    """ Converts bytes to human readable denominations """
+    if (size == 0):
+        return '0B'
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    i = int(math.floor(math.log(size, 1000)))
+    p = math.pow(1000, i)
+    s = round(size / p, 2)
+    return '%s%s' % (s, size_name[i])
+
+
+def object_files(walkpath, list_threads=WALK_THREADS):
+    """
+    Yields a DirEntry for each file in an object that belongs in the
+    manifest. Deletes '.DS_Store' files and ignores files beginning with '.'
+    """
+    return walk_files(walkpath, hidden=False, ds_store='remove', threads=list_threads)
+
+
+def hash_file(filepathname, digests=None, hints=None):
+    """
+    Worker task: both digests and the format from a single read of the
+    file. With digests already known, only the head is read, for the format.
+    'hints' is an iohints mode. Returns (digests, content_format() of the
+    head); the extension is applied by the caller.
+    """
+    if digests is not None:
+        with open(filepathname, 'rb') as infile:
+            return digests, content_format(infile.read(SNIFF_BYTES))
+    digests, head = multi_hash_head(filepathname, ['md5', 'sha256'], SNIFF_BYTES, hints=hints)
+    return digests, content_format(head)
+
+
+def file_row(filepathname, objpath, statinfo, digests, filemime):
+    """ Builds the 'manifest.csv' row for a single file """
+    # note: on a Windows system, ctime is "date created" but on Unix it is
+    # "change time", i.e. the last time the metadata was changed.
+    filectime = time.strftime("%Y.%m.%d %H:%M:%S", time.localtime(statinfo.st_ctime))
+    modifdate = time.strftime("%Y.%m.%d %H:%M:%S", time.localtime(statinfo.st_mtime))
+    accessdate = time.strftime("%Y.%m.%d %H:%M:%S", time.localtime(statinfo.st_atime))
+    csize = convert_size(statinfo.st_size)
+    runtime = time.strftime("%Y.%m.%d %H:%M:%S")
+    # Displays a shortened Path for each file, excluding the directories
+    # that precede the working directory that contains the objects.
+    showpath = path.relpath(filepathname, objpath)
+    return [path.basename(filepathname), showpath, csize, filemime, filectime, modifdate, accessdate,
+            digests['md5'], digests['sha256'], runtime, str(statinfo.st_mode), str(statinfo.st_ino),
+            str(statinfo.st_dev), str(statinfo.st_nlink), str(statinfo.st_uid), str(statinfo.st_gid),
+            str(statinfo.st_size), str(statinfo.st_mtime_ns)]
+
+
+def relative_path(row):
+    return row[1]
+
+
+def read_inventory(manipath):
+    """ Returns the rows of a 'manifest.csv', keyed by '/' separated Relative Path """
+    rows = {}
+    if not path.isfile(manipath):
+        return rows
+    with open(manipath, 'r', newline='', encoding='UTF-8') as manifest:
+        for row in csv.DictReader(manifest):
+            rows[row['Relative Path'].replace('\\', '/')] = row
+    return rows
+
+
+def manifest_current(objpath, walkpath, list_threads=WALK_THREADS):
+    """
+    True if the object's 'manifest.csv' lists exactly the files now below
+    walkpath, each of them unchanged (see row_matches). Only stats the files.
+    """
+    manipath = path.join(objpath, 'manifest.csv')
+    if not path.isfile(manipath):
+        return False
+    rows = read_inventory(manipath)
+    for entry in object_files(walkpath, list_threads):
+        row = rows.pop(path.relpath(entry.path, objpath).replace(sep, '/'), None)
+        if row is None or not row_matches(row, entry_stat(entry)):
+            return False
+    return not rows
+
+
+def row_matches(row, statinfo):
+    """
+    True if a file still has the exact device, inode, size in bytes and
+    mtime in ns recorded in its 'manifest.csv' row (the same key as the
+    FixityCache), i.e. its digests can be trusted. The display columns
+    'Filesize' and 'Modified' are too coarse for this, so manifests
+    written before the 'bytes' and 'mtime_ns' columns never match.
+    """
+    try:
+        recorded = (int(row['device']), int(row['inode']), int(row['bytes']), int(row['mtime_ns']))
+    except (KeyError, TypeError, ValueError):
+        return False
+    return recorded == stat_key(statinfo)
+
+
+class ManifestRows:
+    """
+    Collects the rows of one 'manifest.csv'. Up to run_rows they are
+    sorted in memory; beyond that, each full batch is sorted and spilled
+    as a run to a temporary file beside the manifest, and the runs are
+    merged (k-way) as the manifest is written.
+    """
+    def __init__(self, objpath, run_rows=SORT_RUN_ROWS):
+        self.objpath = objpath
+        self.run_rows = run_rows
+        self.rows = []
+        self.runs = []
+
+    def __len__(self):
+        return len(self.rows) + sum(count for run, count in self.runs)
+
+    def append(self, row):
+        self.rows.append(tuple(row))
+        if len(self.rows) >= self.run_rows:
+            self.spill()
+
+    def spill(self):
+        self.rows.sort(key=relative_path)
+        # Deleted as soon as it is closed, or if SIP Maker dies
+        run = tempfile.TemporaryFile('w+', newline='', encoding='UTF-8', dir=self.objpath, prefix='.manifest_run')
+        csv.writer(run).writerows(self.rows)
+        run.seek(0)
+        self.runs.append((run, len(self.rows)))
+        self.rows = []
+
+    def sorted_rows(self):
+        """ All rows, sorted by Relative Path """
+        self.rows.sort(key=relative_path)
+        if not self.runs:
+            return iter(self.rows)
+        return heapq.merge(self.rows, *[csv.reader(run) for run, count in self.runs], key=relative_path)
+
+    def close(self):
+        for run, count in self.runs:
+            run.close()
+        self.runs = []
+        self.rows = []
+
+
+def write_manifest(manipath, rows):
+    """
+    Writes 'manifest.csv', sorted by Relative Path, from a list or
+    ManifestRows. It is written beside the old one and renamed into
+    place, so an earlier manifest is never left half overwritten.
+    """
+    if isinstance(rows, list):
+        rows.sort(key=relative_path)
+        sorted_rows = rows
+    else:
+        sorted_rows = rows.sorted_rows()
+    # newline='' gives the same '\r\n' rows on every OS
+    manifest = tempfile.NamedTemporaryFile('w', newline='', encoding='UTF-8', dir=path.dirname(manipath),
+                                           prefix='.manifest', suffix='.csv', delete=False)
+    try:
+        with manifest:
+            mwriter = csv.writer(manifest)
+            mwriter.writerow(HEADROW)
+            mwriter.writerows(sorted_rows)
+            manifest.flush()
+            fsync(manifest.fileno())
+        replace_file(manifest.name, manipath)
+    except BaseException:
+        if path.exists(manifest.name):
+            remove(manifest.name)
+        raise
+
+
+def make_executor(workers=DEFAULT_WORKERS, mode='thread'):
+    """ Returns a thread or process pool with the given number of workers """
+    if mode not in POOL_MODES:
+        raise ValueError(f'Unknown worker pool mode: {mode}')
+    if mode == 'process':
+        # multiprocessing is only loaded when it is used
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=max(1, workers))
+    return ThreadPoolExecutor(max_workers=max(1, workers))
+
+
+def inventory_objects(objects, workers=DEFAULT_WORKERS, mode='thread', cache=None, on_finish=None,
+                      list_threads=WALK_THREADS, update=False, index=None, progress=None, report=None,
+                      hints=None):
+    """
+    Inventories many objects at once. 'objects' is a list of
+    (objpath, walkpath) pairs. Files from all objects share one pool, so
+    a large object is hashed in parallel and small objects overlap.
+    Writes each 'manifest.csv' as soon as all of its files are done and
+    returns the list of objpaths that received a manifest.
+    The FixityCache, if given, is consulted and filled here rather than in
+    the workers, so it also works with the 'process' pool. What the content
+    says about each format is kept by SHA-256 in the same database, so a
+    cached or repeated file is not read at all; the extension is applied
+    to each file afresh.
+    'objects' may be any iterable, e.g. one fed by an earlier stage, and
+    on_finish(objpath, changes), if given, is called as each manifest is written.
+    list_threads lists that many folders of an object at once (see walker).
+    With update=True an existing 'manifest.csv' is brought up to date:
+    rows of files that still match it are kept as they are, and 'changes'
+    counts the files 'added', 'changed', 'removed' and 'unchanged'. For an
+    object inventoried from scratch, 'changes' is None.
+    Every row is also recorded in the DuplicateIndex, if given, and
+    counted on the Progress, which is checked before each file; once it
+    is cancelled, the objects still open get no 'manifest.csv'.
+    The RunReport, if given, gets each object's time from the start of its
+    listing to its 'manifest.csv', its files, the bytes actually hashed,
+    and the size of the manifest.
+    'hints' is the iohints mode for the files hashed (passed on, so it
+    also reaches the 'process' pool).
+    """
+    rows = {}
+    previous = {}
+    changes = {}
+    # Outstanding files per object, plus one while its listing is running
+    remaining = {}
+    owners = {}
+    finished = []
+    limit = max(1, workers) * QUEUE_DEPTH
+    formats = FormatCache(cache)
+
+    def add_row(objpath, row, statinfo, hashed=False):
+        rows[objpath].append(row)
+        if report is not None:
+            report.add('inventory', objpath, files=1, bytes_read=statinfo.st_size if hashed else 0)
+        if index is not None:
+            index.add(objpath, relative_path(row), row[HEADROW.index('SHA256')], statinfo.st_size)
+        if progress is not None:
+            progress.advance(1, statinfo.st_size)
+
+    def finish(objpath):
+        objrows = rows.pop(objpath)
+        objchanges = changes.pop(objpath)
+        leftover = previous.pop(objpath, {})
+        if objchanges is not None:
+            objchanges['removed'] = len(leftover)
+        try:
+            write_manifest(path.join(objpath, 'manifest.csv'), objrows)
+        finally:
+            objrows.close()
+        if report is not None:
+            report.add('inventory', objpath, bytes_written=path.getsize(path.join(objpath, 'manifest.csv')))
+            report.end('inventory', objpath)
+        del remaining[objpath]
+        if index is not None:
+            index.finish(objpath)
+        finished.append(objpath)
+        if on_finish is not None:
+            on_finish(objpath, objchanges)
+
+    def collect(done):
+        for fut in done:
+            objpath, filepathname, statinfo, hashed = owners.pop(fut)
+            digests, found = fut.result()
+            if cache is not None and hashed:
+                cache.store(statinfo, digests, filepathname)
+            formats.put(digests['sha256'], found)
+            filemime = with_extension(found, filepathname)
+            # Files whose digests were cached only had their head read, for the format
+            add_row(objpath, file_row(filepathname, objpath, statinfo, digests, filemime), statinfo, hashed)
+            remaining[objpath] -= 1
+            if remaining[objpath] == 0:
+                finish(objpath)
+
+    try:
+        with make_executor(workers, mode) as pool:
+            inflight = set()
+            for objpath, walkpath in objects:
+                rows[objpath] = ManifestRows(objpath)
+                remaining[objpath] = 1
+                changes[objpath] = None
+                if index is not None:
+                    index.begin(objpath)
+                if report is not None:
+                    report.begin('inventory', objpath)
+                if update:
+                    previous[objpath] = read_inventory(path.join(objpath, 'manifest.csv'))
+                    if previous[objpath]:
+                        changes[objpath] = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+                for entry in object_files(walkpath, list_threads):
+                    if progress is not None and progress.cancelled:
+                        # Files not yet started are dropped; the ones being hashed finish
+                        for fut in inflight:
+                            fut.cancel()
+                        progress.check()
+                    filepathname = entry.path
+                    statinfo = entry_stat(entry)
+                    if changes[objpath] is not None:
+                        old = previous[objpath].pop(path.relpath(filepathname, objpath).replace(sep, '/'), None)
+                        if old is None:
+                            changes[objpath]['added'] += 1
+                        elif row_matches(old, statinfo):
+                            changes[objpath]['unchanged'] += 1
+                            add_row(objpath, [old.get(column, '') for column in HEADROW], statinfo)
+                            continue
+                        else:
+                            changes[objpath]['changed'] += 1
+                    digests = None
+                    if cache is not None:
+                        digests = cache.lookup(statinfo, ['md5', 'sha256'])
+                        if digests is not None:
+                            found = formats.get(digests['sha256'])
+                            if found is not None:
+                                filemime = with_extension(found, filepathname)
+                                add_row(objpath, file_row(filepathname, objpath, statinfo, digests, filemime), statinfo)
+                                continue
+                    if len(inflight) >= limit:
+                        done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    fut = pool.submit(hash_file, filepathname, digests, hints)
+                    owners[fut] = (objpath, filepathname, statinfo, digests is None)
+                    remaining[objpath] += 1
+                    inflight.add(fut)
+                remaining[objpath] -= 1
+                if remaining[objpath] == 0:
+                    finish(objpath)
+            while inflight:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                collect(done)
+    finally:
+        # Left open only if the run stopped part way
+        for objrows in rows.values():
+            objrows.close()
+    return finished
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+====================================================================
+I/O hints for SIP Maker
+Tells the OS how a file is about to be read, so hashing a batch of
+terabytes does not push everything else out of the page cache on a
+shared server. The modes are:
+    'off'         no hints
+    'sequential'  read-ahead: the file is marked SEQUENTIAL, and the
+                  next stretch of it is asked for (WILLNEED) as it is read
+    'stream'      as 'sequential', and what has been read is dropped from
+                  the page cache (DONTNEED) as it goes
+Where the OS has no posix_fadvise (Windows, macOS) every mode is 'off'.
+
+The default is 'sequential', which does NOT drop anything: nothing is
+evicted from the page cache unless 'stream' is chosen (--io-hints
+stream, HASH_IO_HINTS in SIPmaker2.0.py, COPY_IO_HINTS in DnDprepack
+and DVD Inventory). Soon after an object is hashed, the tar stage reads
+it again; when the batch fits in memory that read comes from the cache,
+and 'stream' would send it back to the disk. Choose 'stream' on a
+shared server, or for batches far larger than its memory, where the
+cache could not have kept them anyway.
+copy_file() is shutil.copy2 in every mode but 'stream', which also
+drops what it has copied (used by DnDprepack and DVD Inventory).
+====================================================================
+"""
+
+import os, shutil
+
+""" Global Variables """
+IO_HINT_MODES = ('off', 'sequential', 'stream')
+# Read-ahead only; see above for why 'stream' is not the default
+IO_HINTS = 'sequential'
+# Bytes asked for ahead of the reader
+WILLNEED_BYTES = 32 * 1024 * 1024
+# With 'stream', files are copied in chunks of this many bytes, and what
+# has been written is flushed and dropped every DROP_BYTES
+COPY_CHUNK = 8 * 1024 * 1024
+DROP_BYTES = 64 * 1024 * 1024
+HAVE_FADVISE = hasattr(os, 'posix_fadvise')
+
+
+def check_hints(mode):
+    """ Returns the mode to use: the default for None; ValueError for an unknown one """
+    mode = mode or IO_HINTS
+    if mode not in IO_HINT_MODES:
+        raise ValueError(f'Unknown I/O hints: {mode}')
+    return mode
+
+
+class ReadHints:
+    """
+    Hints for one file read from start to end. Call consumed(offset) as
+    the reader moves on and done() at the end; both are cheap no-ops
+    when the mode is 'off' or the OS has no posix_fadvise.
+    """
+    def __init__(self, fd, mode=None):
+        self.fd = fd
+        self.mode = check_hints(mode)
+        self.active = HAVE_FADVISE and self.mode != 'off'
+        self.ahead = 0
+        self.dropped = 0
+        if self.active:
+            self.advise(0, 0, os.POSIX_FADV_SEQUENTIAL)
+            self.consumed(0)
+
+    def advise(self, offset, length, advice):
+        try:
+            os.posix_fadvise(self.fd, offset, length, advice)
+        except OSError:
+            # e.g. a pipe, or a filesystem that does not take hints
+            self.active = False
+
+    def consumed(self, offset):
+        """ Everything before offset has been read """
+        if not self.active:
+            return
+        if offset + WILLNEED_BYTES // 2 >= self.ahead:
+            self.advise(self.ahead, WILLNEED_BYTES, os.POSIX_FADV_WILLNEED)
+            self.ahead += WILLNEED_BYTES
+        if self.mode == 'stream' and offset > self.dropped:
+            self.advise(self.dropped, offset - self.dropped, os.POSIX_FADV_DONTNEED)
+            self.dropped = offset
+
+    def done(self):
+        """ The file has been read to the end """
+        if self.active and self.mode == 'stream':
+            self.advise(0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def drop_written(fd):
+    """ Writes out what has been written to fd and drops it from the page cache; False if the OS would not """
+    try:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        return False
+    return True
+
+
+def copy_file(src, dst, mode=None):
+    """
+    shutil.copy2, which copies in the kernel where the OS can. Only with
+    'stream' is the file copied through one buffer, with ReadHints on the
+    source and what has been written dropped every DROP_BYTES, so a large
+    copy does not crowd everyone else's files out of the page cache.
+    Returns the path of the copy, as copy2 does.
+    """
+    if check_hints(mode) != 'stream' or not HAVE_FADVISE:
+        return shutil.copy2(src, dst)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    buf = bytearray(COPY_CHUNK)
+    with memoryview(buf) as view, open(src, 'rb', buffering=0) as fsrc, open(dst, 'wb') as fdst:
+        hints = ReadHints(fsrc.fileno(), 'stream')
+        offset = 0
+        written = 0
+        for nbytes in iter(lambda: fsrc.readinto(buf), 0):
+            fdst.write(view[:nbytes])
+            offset += nbytes
+            hints.consumed(offset)
+            # Written pages can only be dropped once they are on disk
+            if offset - written >= DROP_BYTES:
+                fdst.flush()
+                drop_written(fdst.fileno())
+                written = offset
+        hints.done()
+        fdst.flush()
+        drop_written(fdst.fileno())
+    shutil.copystat(src, dst)
+    return dst
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Job journal for SIP Maker
+A write-ahead log, kept in the Processing Folder, of every stage started
+and finished for every object. Each record is one JSON line, flushed and
+fsync'd before the work it describes goes ahead, so after a crash the
+journal shows exactly which objects are done and which were cut off
+halfway. The next run skips the finished work and rolls back the rest.
+====================================================================
+"""
+
+import json, threading, time
+from os import fsync, path
+from fixity import write_atomic
+
+""" Global Variables """
+JOURNAL_NAME = 'sipmaker_journal.jsonl'
+
+
+class Journal:
+    """
+    The latest record for each (object, stage). Records are
+    {'object': <abs path>, 'stage': ..., 'event': 'begin' | 'done' | 'rolled back',
+    'time': ..., plus whatever the stage needs to finish or undo its work}.
+    With no journalpath the journal only lives in memory.
+    """
+    def __init__(self, journalpath=None):
+        self.journalpath = journalpath
+        self.state = {}
+        self.lock = threading.Lock()
+        self.file = None
+        if journalpath is not None:
+            if path.exists(journalpath):
+                self._load()
+            # Compact to one line per (object, stage), so the file stays small
+            lines = ''.join(json.dumps(record) + '\n' for record in self.state.values())
+            write_atomic(journalpath, lines.encode('UTF-8'))
+            self.file = open(journalpath, 'a', encoding='UTF-8')
+
+    def _load(self):
+        with open(self.journalpath, 'r', encoding='UTF-8') as jfile:
+            for line in jfile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line torn by the crash; nothing after it was written
+                    break
+                self.state[(record['object'], record['stage'])] = record
+
+    def _append(self, objpath, stage, event, info):
+        record = {'object': path.abspath(objpath), 'stage': stage, 'event': event,
+                  'time': time.strftime("%Y.%m.%d %H:%M:%S")}
+        record.update(info)
+        with self.lock:
+            self.state[(record['object'], stage)] = record
+            if self.file is not None:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+                fsync(self.file.fileno())
+        return record
+
+    def begin(self, objpath, stage, **info):
+        return self._append(objpath, stage, 'begin', info)
+
+    def end(self, objpath, stage, **info):
+        return self._append(objpath, stage, 'done', info)
+
+    def discard(self, objpath, stage):
+        return self._append(objpath, stage, 'rolled back', {})
+
+    def done(self, objpath, stage):
+        """ The 'done' record of a stage, or None """
+        record = self.state.get((path.abspath(objpath), stage))
+        if record is not None and record['event'] == 'done':
+            return record
+        return None
+
+    def records(self, event):
+        return [record for record in list(self.state.values()) if record['event'] == event]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,713 @@
+#!/usr/bin/env python
+"""
+====================================================================
+SIP Maker pipeline
+The stages of SIP Maker (pre-bag, metadata, inventory, BagIt, tar and
+transfer manifest) without any user interface. Every yes/no question a
+stage needs answered goes through a "prompter": the SIP Maker window
+passes one that shows dialogs, and the command line passes a Policy
+that answers from a policy file. Importing this module does not load
+tkinter or PIL.
+====================================================================
+"""
+
+import csv, io, json, sys, time
+from os import listdir, mkdir, path, remove, rename, rmdir, stat
+from shutil import move
+from bagging import REQUIRED_TAG_FILES, add_aptrust_info, make_bag_from_inventory, unbag, validate_bag
+from duplicates import DUPLICATES_NAME, DuplicateIndex
+from fixity import CACHE_MB, CACHE_NAME, FixityCache, multi_hash, write_atomic
+from inventory import DEFAULT_WORKERS, convert_size, inventory_objects, manifest_current
+from iohints import IO_HINTS
+from journal import JOURNAL_NAME, Journal
+from progress import tree_totals
+from runreport import REPORTS_FOLDER, RunReport
+from scheduler import run_pipelined
+from tarring import COMPRESSIONS, TAR_WORKERS, TarDigests, tar_many
+from walker import WALK_THREADS
+
+""" Global Variables """
+STAGES = ['prebag', 'meta', 'inventory', 'bagit', 'tar', 'transfer']
+STORAGE_OPTIONS = ['Standard', 'Glacier-Deep-OH']
+META_HEADERS = ['System UUID', 'Local ID', 'Responsible Org', 'Collection', 'Item Type', 'Packaged By']
+BAG_INFO = {
+    'Bag-Count': '',
+    'Bag-Group-Identifier': '',
+    'BagIt-Profile-Identifier': 'https://raw.githubusercontent.com/APTrust/preservation-services/master/profiles/aptrust-v2.2.json',
+    'Internal-Sender-Description': '',
+    'Internal-Sender-Identifier': '',
+    'Source-Organization': 'University of Alabama at Birmingham'
+    }
+
+
+class StopBatch(Exception):
+    """ Raised when the answer to a question is to stop SIP Maker altogether """
+
+
+class Policy:
+    """
+    Answers the yes/no questions of a batch without asking anyone.
+    The defaults are the cautious answers; a JSON policy file can
+    override any of them, e.g. {"meta_overwrite": true}
+    """
+    DEFAULTS = {
+        # "It looks like <item> is a bag. Quit SIPmaker?" (pre-bag)
+        'prebag_quit_if_bag': True,
+        # "Item <x> has no Local ID. Do you want to quit SIPmaker?" (metadata)
+        'meta_quit_if_no_local_id': False,
+        # "It appears that <x> is a bag. Skip creating 'metadata.csv'?" (metadata)
+        'meta_skip_bags': True,
+        # "At least one 'metadata.csv' already exists. Overwrite ALL of them?" (metadata)
+        'meta_overwrite': False,
+        # "It appears that <x> is a bag. Skip this object?" (inventory)
+        'inventory_skip_bags': True,
+        # "It appears that <x> is already a bag. Bag it anyway?" (BagIt)
+        'bag_existing_bags': False,
+        }
+
+    def __init__(self, answers=None, log=None):
+        self.answers = dict(self.DEFAULTS)
+        for key, value in (answers or {}).items():
+            if key not in self.DEFAULTS:
+                raise ValueError(f'Unknown policy setting: {key}')
+            self.answers[key] = bool(value)
+        self.log = log or (lambda message: print(message, file=sys.stderr))
+
+    @classmethod
+    def from_file(cls, policyfile, log=None):
+        with open(policyfile, 'r', encoding='UTF-8') as pfile:
+            return cls(json.load(pfile), log)
+
+    def ask(self, key, message):
+        answer = self.answers[key]
+        self.log(f'{" ".join(message.split())} -> {"yes" if answer else "no"} (policy: {key})')
+        return answer
+
+    def warn(self, message):
+        self.log(f'WARNING: {" ".join(message.split())}')
+
+    def info(self, message):
+        self.log(" ".join(message.split()))
+
+
+class SIPPipeline:
+    """ Runs the SIP Maker stages over a folder of objects """
+    def __init__(self, prompter=None, storage='Glacier-Deep-OH', workers=DEFAULT_WORKERS, pool='thread',
+                 validation='tags', sample=100, tar_workers=TAR_WORKERS, one_per_device=False,
+                 compression='none', list_threads=WALK_THREADS, update_manifests=False, io_hints=IO_HINTS):
+        self.prompter = prompter or Policy()
+        self.storage = storage
+        self.workers = workers
+        self.pool = pool
+        self.validation = validation
+        self.sample = sample
+        self.tar_workers = tar_workers
+        self.one_per_device = one_per_device
+        self.compression = compression
+        self.list_threads = list_threads
+        # Bring an existing 'manifest.csv' up to date instead of skipping the object
+        self.update_manifests = update_manifests
+        self.io_hints = io_hints
+        self.inventory_changes = {}
+        self.cache = None
+        self.duplicates = None
+        self.tar_digests = TarDigests()
+        self.journal = Journal()
+        # A Progress, if the caller shows one (or lets the run be cancelled)
+        self.progress = None
+        self.report = RunReport()
+
+    def check_cancel(self):
+        """ Raises Cancelled if the run has been cancelled """
+        if self.progress is not None:
+            self.progress.check()
+
+    def start_progress(self, itemsdir, stages):
+        """
+        Sets the progress total from the bytes below the items folder: the
+        inventory and tar stages each read every byte once. Files are only
+        counted, since bagging adds tag files along the way.
+        """
+        if self.progress is None:
+            return
+        passes = [name for stage, name in [('inventory', 'Inventory'), ('tar', 'Tar')] if stage in stages]
+        nbytes = tree_totals(itemsdir, self.list_threads)[1] if passes and path.isdir(itemsdir) else 0
+        label = ' and '.join(passes) or ', '.join(stage.capitalize() for stage in stages)
+        self.progress.start(label, 0, nbytes * len(passes))
+
+    def open_cache(self, procdir, trust=True, max_mb=CACHE_MB):
+        """ Digests are cached in the Processing Folder, so re-runs only stat unchanged files """
+        self.close_cache()
+        if path.isdir(procdir):
+            self.cache = FixityCache(path.join(procdir, CACHE_NAME), trust=trust, max_mb=max_mb)
+        return self.cache
+
+    def close_cache(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def open_duplicates(self, procdir):
+        """ Files are indexed by digest in the Processing Folder, to find copies across objects and batches """
+        self.close_duplicates()
+        if path.isdir(procdir):
+            self.duplicates = DuplicateIndex(path.join(procdir, DUPLICATES_NAME))
+            self.duplicates.reportdir = path.join(procdir, 'duplicate_reports')
+        return self.duplicates
+
+    def close_duplicates(self):
+        if self.duplicates is not None:
+            self.duplicates.close()
+            self.duplicates = None
+
+    def report_duplicates(self):
+        """
+        Writes the duplicate report for this batch, if it has duplicates, and
+        says how much space they take. Returns [report path, files, bytes]
+        """
+        if self.duplicates is None:
+            return [None, 0, 0]
+        report = self.duplicates.report(self.duplicates.reportdir)
+        reportpath, copies, saved = report
+        if reportpath is not None:
+            self.prompter.info(f'{copies} files duplicate other files in this or earlier batches.\n'
+                               f'Keeping one copy of each would save {convert_size(saved)}.\n'
+                               f'See {reportpath}')
+        return report
+
+    def open_report(self, procdir):
+        """ Starts timing a run; the report is written to the Processing Folder when it is closed """
+        settings = {'workers': self.workers, 'pool': self.pool, 'list_threads': self.list_threads,
+                    'update_manifests': self.update_manifests, 'validation': self.validation,
+                    'sample': self.sample, 'tar_workers': self.tar_workers,
+                    'one_per_device': self.one_per_device, 'compression': self.compression,
+                    'io_hints': self.io_hints}
+        reportdir = path.join(procdir, REPORTS_FOLDER) if path.isdir(procdir) else None
+        self.report = RunReport(reportdir, settings)
+        return self.report
+
+    def close_report(self):
+        """ Writes the run report, if there is a Processing Folder. Returns its path, or None """
+        reportpath = self.report.write()
+        self.report = RunReport()
+        return reportpath
+
+    def open_journal(self, procdir):
+        """
+        Opens the job journal in the Processing Folder, rolls back whatever
+        an earlier run left half done, and remembers the tars it finished.
+        Returns the number of stages rolled back.
+        """
+        self.close_journal()
+        if not path.isdir(procdir):
+            return 0
+        self.journal = Journal(path.join(procdir, JOURNAL_NAME))
+        for record in self.journal.records('done'):
+            if record['stage'] == 'tar':
+                self.tar_digests.remember(record['outfile'], record['size'], record['mtime_ns'], record['digests'])
+        rolled = self.recover()
+        if not rolled == 0:
+            self.prompter.info(f'Rolled back {rolled} unfinished steps\nleft by an earlier run.')
+        return rolled
+
+    def close_journal(self):
+        self.journal.close()
+        self.journal = Journal()
+
+    def recover(self):
+        """ Finishes or undoes each stage the journal shows was cut off. Returns the number handled """
+        rolled = 0
+        for record in self.journal.records('begin'):
+            objpath = record['object']
+            stage = record['stage']
+            if stage == 'prebag':
+                # Either the move never happened (the temp folder is empty), or
+                # only the last rename is missing
+                temppath = record['temp']
+                if path.isdir(temppath):
+                    if path.exists(objpath):
+                        rmdir(temppath)
+                    else:
+                        rename(temppath, objpath)
+                        self.journal.end(objpath, stage)
+                        rolled += 1
+                        continue
+            elif stage == 'inventory':
+                # An update leaves the old 'manifest.csv' whole until the new one replaces it
+                leftovers = ['temp_manifest.csv'] if record.get('update') else ['manifest.csv', 'temp_manifest.csv']
+                if path.isdir(objpath):
+                    leftovers += [f for f in listdir(objpath) if f.startswith('.manifest') and f.endswith('.csv')]
+                for leftover in leftovers:
+                    if path.exists(path.join(objpath, leftover)):
+                        remove(path.join(objpath, leftover))
+            elif stage == 'bagit':
+                if not unbag(objpath, record['payload']):
+                    self.prompter.warn(f'Could not undo the unfinished bag:\n{objpath}\nPlease check it by hand.')
+                    continue
+            elif stage == 'tar':
+                if path.exists(record['outfile']):
+                    remove(record['outfile'])
+            self.journal.discard(objpath, stage)
+            rolled += 1
+        return rolled
+
+    def output_exists(self, objpath, stage):
+        """ True if what a stage made for an object is still on disk """
+        if stage == 'prebag':
+            return path.isdir(path.join(objpath, path.basename(objpath)))
+        if stage == 'meta':
+            return path.isfile(path.join(objpath, 'metadata.csv'))
+        if stage == 'inventory':
+            return manifest_current(objpath, path.join(objpath, path.basename(objpath)), self.list_threads)
+        if stage == 'bagit':
+            return path.isdir(path.join(objpath, 'data')) and all(
+                path.isfile(path.join(objpath, tagname)) for tagname in REQUIRED_TAG_FILES)
+        return True
+
+    def already_done(self, objpath, stage):
+        """
+        True if the journal shows the stage done for the object and its
+        output is still there. The journal outlives the objects, so an
+        object supplied again, or unbagged, may have a 'done' record with
+        nothing behind it: that record is dropped, with a warning, and the
+        stage runs again.
+        """
+        if self.journal.done(objpath, stage) is None:
+            return False
+        if self.output_exists(objpath, stage):
+            return True
+        self.journal.discard(objpath, stage)
+        self.prompter.warn(f"The journal shows '{stage}' finished for\n{path.basename(objpath)},\n"
+                           f"but its output is gone. Doing it again.")
+        return False
+
+    def prebag_object(self, packdir, item, number):
+        """ Moves one object's contents into a subfolder of the same name. Returns True if moved """
+        oldpath = path.join(packdir, item)
+        # Bagging moves what the earlier stages made into 'data', so it is checked first
+        if self.already_done(oldpath, 'bagit') or self.already_done(oldpath, 'prebag'):
+            return False
+        bagpath = path.join(oldpath, 'data')
+        if path.exists(bagpath):
+            if self.prompter.ask('prebag_quit_if_bag', f'It looks like {item} is a bag. Quit SIPmaker?'):
+                raise StopBatch(f'{item} is a bag')
+        newpath = path.join(oldpath, item)
+        if path.exists(newpath):
+            return False
+        temppath = path.join(packdir, f'tempdir{number}')
+        self.journal.begin(oldpath, 'prebag', temp=path.abspath(temppath))
+        with self.report.timed('prebag', oldpath):
+            mkdir(temppath)
+            move(oldpath, temppath)
+            rename(temppath, oldpath)
+        self.journal.end(oldpath, 'prebag')
+        return True
+
+    def pre_bag(self, packdir):
+        """
+        Preserves departmental folder structure during Bagging by moving
+        object contents into a subdirectory named with the local object ID.
+        Returns the number of objects pre-bagged.
+        """
+        numitems = 0
+        # put all directories into a list and sort the list
+        sorted_objectlist = sorted([f for f in listdir(packdir) if len(f.split('.')) == 1])
+        with self.report.stage('prebag'):
+            for item in sorted_objectlist:
+                self.check_cancel()
+                if self.prebag_object(packdir, item, numitems + 1):
+                    numitems += 1
+        return numitems
+
+    def read_meta_csv(self, csvIn):
+        """ Returns the headers and rows of the master CSV, or None if the headers are not as expected """
+        with open(csvIn, 'r', encoding='UTF-8') as incsv:
+            reader = csv.DictReader(incsv)
+            headers = reader.fieldnames
+            if not headers == META_HEADERS:
+                self.prompter.warn("Your input CSV contains headers\nthat differ from what is expected.\n\nQuitting action.")
+                return None
+            rows = list(reader)
+        # Answers that apply to the whole metadata run
+        self.meta_state = {'firstone': True, 'overwrite_all': False}
+        return [headers, rows]
+
+    def meta_for_row(self, row, headers, locids, fpath):
+        """ Writes the 'metadata.csv' for one row of the master CSV. Returns [csv files, xml files] """
+        skip1 = False
+        foldname = row['%s' % locids]
+        foldpath = path.join(fpath, foldname)
+        if self.already_done(foldpath, 'bagit') or self.already_done(foldpath, 'meta'):
+            return [0, 0]
+        # Check if Local ID is blank
+        if row['Local ID'].strip() == '':
+            skip1 = True
+            if self.prompter.ask('meta_quit_if_no_local_id',
+                                 f"Item \'{foldname}\' has no Local ID.\nDo you want to quit SIPmaker?"):
+                raise StopBatch(f'{foldname} has no Local ID')
+        if not path.exists(foldpath):
+            skip1 = True
+        # The function skips objects that are Bags or already have a
+        # 'metadata.csv' file. Thus it skips creating a 'metadata.xml'
+        # for these objects also.
+        if path.exists(path.join(foldpath, 'data')):
+            skip1 = self.prompter.ask('meta_skip_bags',
+                f"It appears that \'{foldname}\' is a bag.\n\nSkip creating \'metadata.csv\' for this one item?")
+        if path.exists(path.join(foldpath, 'metadata.csv')) and self.meta_state['firstone'] == True:
+            self.meta_state['firstone'] = False
+            self.meta_state['overwrite_all'] = self.prompter.ask('meta_overwrite',
+                "At least one \'metadata.csv\' already\nexists. Overwrite ALL of them?")
+        if path.exists(path.join(foldpath, 'metadata.csv')) and self.meta_state['overwrite_all'] == False:
+            skip1 = True
+        if not skip1 == False:
+            return [0, 0]
+        metafile = path.join(foldpath, 'metadata.csv')
+        # newline='' gives the same '\r\n' rows on every OS
+        newmeta = io.StringIO(newline='')
+        metawriter = csv.DictWriter(newmeta, fieldnames=headers)
+        metawriter.writeheader()
+        metawriter.writerow(row)
+        metabytes = newmeta.getvalue().encode('UTF-8')
+        with self.report.timed('meta', foldpath):
+            write_atomic(metafile, metabytes)
+        self.report.add('meta', foldpath, files=1, bytes_written=len(metabytes))
+        self.journal.end(foldpath, 'meta')
+        rdfok = False
+        # rdfok = self.make_rdf(metafile)
+        return [1, 1 if rdfok == True else 0]
+
+    def meta_from_csv(self, csvIn, locids, fpath):
+        """ Writes a 'metadata.csv' for each row of the master CSV. Returns [csv files, xml files] """
+        nfiles = 0
+        rfiles = 0
+        with self.report.stage('meta'):
+            metacsv = self.read_meta_csv(csvIn)
+            if metacsv is None:
+                return [0, 0]
+            headers, rows = metacsv
+            for row in rows:
+                self.check_cancel()
+                made = self.meta_for_row(row, headers, locids, fpath)
+                nfiles += made[0]
+                rfiles += made[1]
+        return [nfiles, rfiles]
+
+    def create_meta(self, folderpath, myfile, idcolname):
+        """
+        Generates minimal metadata files, 'metadata.csv' and 'metadata.xml'
+        based on a master CSV. Returns [csv files, xml files], or None if
+        the source file cannot be used.
+        """
+        if not path.splitext(myfile)[1] == '.csv':
+            self.prompter.warn("The metadata source file must be CSV.\nQuitting action.")
+            return None
+        return self.meta_from_csv(myfile, idcolname, folderpath)
+
+    def inventory_wanted(self, objectsdir, obj):
+        """ True if the object should get a 'manifest.csv', in which case its inventory is journaled as started """
+        objpath = path.join(objectsdir, obj)
+        if not path.isdir(objpath):
+            return False
+        if self.already_done(objpath, 'bagit'):
+            return False
+        if not self.update_manifests and self.already_done(objpath, 'inventory'):
+            return False
+        has_manifest = path.exists(path.join(objpath, 'manifest.csv'))
+        skipit = False
+        if path.exists(path.join(objpath, 'data')):
+            if self.prompter.ask('inventory_skip_bags', f'It appears that \'{obj}\' is a bag.\nSkip this object?'):
+                skipit = True
+        if has_manifest and not self.update_manifests:
+            skipit = True
+            self.prompter.warn(
+                f"The file \'manifest.csv\' already exists.\nSkipping inventory of the object: \n{obj}")
+        if skipit == False:
+            self.journal.begin(objpath, 'inventory', update=has_manifest)
+        return skipit == False
+
+    def inventory_finished(self, objpath, changes=None):
+        self.journal.end(objpath, 'inventory', changes=changes)
+        if changes is not None:
+            self.inventory_changes[objpath] = changes
+
+    def report_changes(self):
+        """ Sums up, in one message, the 'manifest.csv' files updated since the last report """
+        if not self.inventory_changes:
+            return
+        counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        for objpath in list(self.inventory_changes):
+            for key, value in self.inventory_changes.pop(objpath).items():
+                counts[key] += value
+        self.prompter.info(f"Updated existing \'manifest.csv\' files:\n{counts['added']} new, "
+                           f"{counts['changed']} changed and {counts['removed']} removed files.\n"
+                           f"{counts['unchanged']} unchanged files were not rehashed.")
+
+    def run_inventory(self, objectsdir):
+        """
+        Runs an inventory and generates 'manifest.csv' files for each object.
+        Returns the number of 'manifest.csv' files created.
+        """
+        to_inventory = []
+        # sort the list of files and folders, so it iterates through in order
+        sorted_objectsdir = sorted(listdir(objectsdir))
+        for obj in sorted_objectsdir:
+            if self.inventory_wanted(objectsdir, obj):
+                objpath = path.join(objectsdir, obj)
+                to_inventory.append((objpath, path.join(objpath, obj)))
+        # Objects, and the files inside them, are hashed on a shared worker pool
+        with self.report.stage('inventory'):
+            finished = inventory_objects(to_inventory, self.workers, self.pool, self.cache,
+                                         on_finish=self.inventory_finished, list_threads=self.list_threads,
+                                         update=self.update_manifests, index=self.duplicates,
+                                         progress=self.progress, report=self.report, hints=self.io_hints)
+        self.report_changes()
+        self.report_duplicates()
+        return len(finished)
+
+    def make_valid_apt_bag(self, bpath):
+        """ Adds 'aptrust-info.txt' to a new bag and validates it. Returns True if valid """
+        # Create the aptrust-info.txt file and add it to both tag manifests
+        add_aptrust_info(bpath, self.storage)
+        """# Validate bag
+        bag = bagit.Bag(bpath)
+        profile = bagit_profile.Profile('https://raw.githubusercontent.com/APTrust/preservation-services/master/profiles/aptrust-v2.2.json')
+        try:
+            profile.validate(bag)
+        except bagit.BagValidationError() as e:
+            print(e)
+            return False"""
+        # Freshly built bags default to the structural + tag manifest tier,
+        # since their payload digests were only just computed
+        with self.report.timed('validate', bpath):
+            problems = validate_bag(bpath, self.validation, self.sample, self.workers)
+        if problems:
+            return False
+        return True
+
+    def bag_object(self, inpath):
+        """ Bags one object according to the APTrust BagIt profile. Returns True if the bag is valid """
+        self.journal.begin(inpath, 'bagit', payload=listdir(inpath))
+        with self.report.timed('bagit', inpath):
+            # Objects with a 'manifest.csv' are bagged from the inventory digests
+            if path.isfile(path.join(inpath, 'manifest.csv')):
+                make_bag_from_inventory(inpath, BAG_INFO, ['md5', 'sha256'], self.cache, self.workers)
+            else:
+                import bagit
+                bagit.make_bag(inpath, dict(BAG_INFO), checksums=['md5', 'sha256'])
+            # Section to create the necessary APTrust Info file
+            valid = self.make_valid_apt_bag(inpath)
+        # What bagging writes is the tag files around the payload
+        tagfiles = [f for f in listdir(inpath) if path.isfile(path.join(inpath, f))]
+        self.report.add('bagit', inpath, files=len(tagfiles),
+                        bytes_written=sum(path.getsize(path.join(inpath, f)) for f in tagfiles))
+        self.journal.end(inpath, 'bagit', valid=valid)
+        return valid
+
+    def storage_ok(self):
+        if not self.storage in STORAGE_OPTIONS:
+            self.prompter.warn(f'APT Storage Option \"{self.storage}\" is not a valid option.\nStopping...')
+            return False
+        return True
+
+    def bag_wanted(self, bagsdir, f):
+        """ True if the object should be bagged """
+        inpath = path.join(bagsdir, f)
+        if not path.isdir(inpath):
+            return False
+        if self.already_done(inpath, 'bagit'):
+            return False
+        if path.exists(path.join(inpath, 'data')):
+            return self.prompter.ask('bag_existing_bags', "It appears that \'%s\' is already a bag.\nBag it anyway?" % f)
+        return True
+
+    def run_bagit(self, bagsdir):
+        """
+        Bags all objects in a single directory, according to APTrust BagIt profile.
+        Returns [total bags, valid bags], or None if the storage option is not valid.
+        """
+        validbags = 0
+        totalbags = 0
+        if not self.storage_ok():
+            return None
+        sorted_bagsdir = sorted(listdir(bagsdir))
+        with self.report.stage('bagit'):
+            for f in sorted_bagsdir:
+                self.check_cancel()
+                if self.bag_wanted(bagsdir, f):
+                    totalbags += 1
+                    if self.bag_object(path.join(bagsdir, f)):
+                        validbags += 1
+                    else:
+                        self.prompter.warn(f'Bag {f} is not a valid APTrust bag.')
+        return [totalbags, validbags]
+
+    def tar_path(self, procfolder, name):
+        return path.join(procfolder, 'ready_to_transfer', f'{path.splitext(name)[0]}{COMPRESSIONS[self.compression]}')
+
+    def tar_job(self, tarfolder, procfolder, name):
+        """
+        Returns the (infile, outfile, arcname) job for one object, or None
+        if it is not a folder or its tar already exists
+        """
+        infile = path.join(tarfolder, name)
+        if not path.isdir(infile):
+            return None
+        outfile = self.tar_path(procfolder, name)
+        # Tars finished by an earlier run are kept as long as they are unchanged
+        if self.journal.done(infile, 'tar') and self.tar_digests.get(outfile) is not None:
+            return None
+        if path.exists(outfile):
+            self.prompter.warn(f'The TAR file: {outfile}\nalready exists!\nTar archive not created.')
+            return None
+        return (infile, outfile, path.relpath(infile, tarfolder))
+
+    def tar_outfolder(self, procfolder):
+        outfolder = path.join(procfolder, 'ready_to_transfer')
+        if not path.exists(outfolder):
+            mkdir(outfolder)
+        return outfolder
+
+    def tar_counter(self, job):
+        """ Counts a tar's members for the run report (timed from its first member) and the progress """
+        return self.report.counter('tar', job[0], self.progress)
+
+    def tar_object(self, build, job):
+        """ Builds one tar with a tar_builder() function and records its digests """
+        self.journal.begin(job[0], 'tar', outfile=path.abspath(job[1]))
+        self.record_tar(job, build(*job, progress=self.tar_counter(job)))
+
+    def record_tar(self, job, digests):
+        """ Keeps the digests of a new tar for the transfer manifest """
+        outfile = job[1]
+        tarstat = self.tar_digests.add(outfile, digests)
+        self.report.add('tar', job[0], bytes_written=tarstat.st_size)
+        self.report.end('tar', job[0])
+        if self.cache is not None:
+            self.cache.store(tarstat, digests, outfile)
+        self.journal.end(job[0], 'tar', outfile=path.abspath(outfile), size=tarstat.st_size,
+                         mtime_ns=tarstat.st_mtime_ns, digests=digests)
+
+    def run_tar(self, tarfolder, procfolder):
+        """ Tars all objects in a single directory. Returns [tars created, tars already there] """
+        tarfiles = 0
+        outfolder = self.tar_outfolder(procfolder)
+        sorted_tarfolder = sorted(listdir(tarfolder))
+        tarjobs = []
+        for i in sorted_tarfolder:
+            job = self.tar_job(tarfolder, procfolder, i)
+            if job is not None:
+                tarjobs.append(job)
+        alreadytar = len([i for i in sorted_tarfolder if path.isdir(path.join(tarfolder, i))]) - len(tarjobs)
+        for job in tarjobs:
+            self.journal.begin(job[0], 'tar', outfile=path.abspath(job[1]))
+        # Several archives are built at once; each is hashed as it is written,
+        # for the transfer manifest
+        byoutfile = {job[1]: job for job in tarjobs}
+        with self.report.stage('tar'):
+            counted = [job + (self.tar_counter(job),) for job in tarjobs]
+            for outfile, digests in tar_many(counted, self.tar_workers, self.one_per_device, ['md5', 'sha256'],
+                                             self.compression, self.progress):
+                self.record_tar(byoutfile[outfile], digests)
+                tarfiles += 1
+        if not alreadytar == 0:
+            self.prompter.warn(f'The folder {outfolder} already contained {alreadytar} tar files which were skipped.')
+        return [tarfiles, alreadytar]
+
+    def tar_digests_for(self, tar_path):
+        """ MD5 and SHA256 of a tar: from this run's records, the cache, or a single read """
+        # Tars written by this run already have their digests
+        tar_digests = self.tar_digests.get(tar_path, ['md5', 'sha256'])
+        if tar_digests is None:
+            tar_digests = multi_hash(tar_path, ['md5', 'sha256'], cache=self.cache, hints=self.io_hints)
+            # An upper bound: the cache may have had them
+            self.report.add('transfer', tar_path, bytes_read=path.getsize(tar_path))
+        return tar_digests
+
+    def trans_manifest(self, indir, procdirectory):
+        """
+        Generates a manifest of filenames and checksums for a directory of
+        Bagged and Tarred objects. Returns [manifest path, number of tars].
+        """
+        outdir = path.join(procdirectory, 'transfer_manifests')
+        if not path.exists(outdir):
+            mkdir(outdir)
+        manifest_path = path.join(outdir, f'transfer_{time.strftime("%Y%b%d_%H%M%S")}.csv')
+        sorted_tarlist = sorted([t for t in listdir(indir) if '.tar' in t])
+        with self.report.stage('transfer'):
+            with open(manifest_path, 'w', encoding='utf-8', newline='') as tar_list:
+                for tars in sorted_tarlist:
+                    self.check_cancel()
+                    with self.report.timed('transfer', path.join(indir, tars)):
+                        tar_digests = self.tar_digests_for(path.join(indir, tars))
+                    self.report.add('transfer', path.join(indir, tars), files=1)
+                    tar_list.write(f'{tars},{tar_digests["md5"]},{tar_digests["sha256"]}\n')
+        return [manifest_path, len(sorted_tarlist)]
+
+
+def run_batch(pipeline, itemsdir, procdir, stages=STAGES, csvfile=None, idcolumn='Local ID', trust=True,
+              pipelined=True):
+    """
+    Runs the chosen stages over a folder of items and returns a summary
+    dict of the counts from each stage. By default objects flow through
+    the stages independently (see scheduler.py); with pipelined=False
+    each stage finishes the whole folder before the next one starts.
+    Raises StopBatch if a policy answer says to quit, ValueError for
+    unusable inputs, and Cancelled if pipeline.progress is cancelled.
+    """
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage: {stage}')
+    if not path.isdir(itemsdir):
+        raise ValueError(f'Items folder \'{itemsdir}\' not found.')
+    if 'meta' in stages and (csvfile is None or not path.exists(csvfile)):
+        raise ValueError(f'CSV file \'{csvfile}\' not found.')
+    if ('tar' in stages or 'transfer' in stages) and not path.isdir(procdir):
+        raise ValueError(f'Processing folder \'{procdir}\' not found.')
+    summary = {}
+    pipeline.open_cache(procdir, trust=trust)
+    pipeline.open_duplicates(procdir)
+    pipeline.open_journal(procdir)
+    pipeline.open_report(procdir)
+    reportpath = None
+    try:
+        pipeline.start_progress(itemsdir, stages)
+        if pipelined:
+            summary = run_pipelined(pipeline, itemsdir, procdir, [s for s in stages if not s == 'transfer'],
+                                    csvfile, idcolumn)
+        else:
+            summary = run_stages(pipeline, itemsdir, procdir, stages, csvfile, idcolumn)
+        if summary is None:
+            return {}
+        if 'transfer' in stages:
+            indir = path.join(procdir, 'ready_to_transfer')
+            summary['transfer_manifest'], summary['transferred_tars'] = pipeline.trans_manifest(indir, procdir)
+    finally:
+        reportpath = pipeline.close_report()
+        pipeline.close_journal()
+        pipeline.close_duplicates()
+        pipeline.close_cache()
+    if reportpath is not None:
+        summary['run_report'] = reportpath
+    return summary
+
+
+def run_stages(pipeline, itemsdir, procdir, stages, csvfile, idcolumn):
+    """ Runs each stage over the whole folder in turn. Returns the summary, or None if a stage gave up """
+    summary = {}
+    if 'prebag' in stages:
+        summary['prebagged'] = pipeline.pre_bag(itemsdir)
+    if 'meta' in stages:
+        counts = pipeline.create_meta(itemsdir, csvfile, idcolumn)
+        if counts is None:
+            return None
+        summary['metadata_csv'], summary['metadata_xml'] = counts
+    if 'inventory' in stages:
+        summary['manifests'] = pipeline.run_inventory(itemsdir)
+    if 'bagit' in stages:
+        counts = pipeline.run_bagit(itemsdir)
+        if counts is None:
+            return None
+        summary['bags'], summary['valid_bags'] = counts
+    if 'tar' in stages:
+        summary['tars'], summary['tars_skipped'] = pipeline.run_tar(itemsdir, procdir)
+    return summary
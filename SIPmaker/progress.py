@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Progress of a SIP Maker run
+The stages count the files and bytes they finish on a Progress, and
+check it between files, so a run can be cancelled at the next file
+boundary. Snapshots (files, bytes, MB/s and ETA) are posted to a queue
+at most a few times a second, for a window to show; nothing here loads
+tkinter.
+====================================================================
+"""
+
+import threading, time
+from collections import deque
+from walker import WALK_THREADS, entry_stat, walk_files
+
+""" Global Variables """
+# Seconds between snapshots posted to the queue
+UPDATE_SECONDS = 0.2
+# Throughput is measured over this many of the latest seconds
+RATE_SECONDS = 10
+
+
+class Cancelled(Exception):
+    """ Raised at the next file boundary once a run has been cancelled """
+
+
+class Progress:
+    """
+    Counters shared by every thread of a run. 'updates' is a queue that
+    receives ('progress', snapshot) tuples; without one, nothing is posted.
+    """
+    def __init__(self, updates=None, interval=UPDATE_SECONDS):
+        self.updates = updates
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self.start('')
+
+    def start(self, label, files=0, nbytes=0):
+        """ Starts counting again, towards totals of files and bytes (0 if not known) """
+        with self._lock:
+            self.label = label
+            self.total_files = files
+            self.total_bytes = nbytes
+            self.files = 0
+            self.bytes = 0
+            self.started = time.monotonic()
+            self.posted = 0
+            self.samples = deque([(self.started, 0)])
+        self.post()
+
+    def advance(self, files=1, nbytes=0):
+        """ Counts finished files and their bytes """
+        with self._lock:
+            self.files += files
+            self.bytes += nbytes
+            due = time.monotonic() - self.posted >= self.interval
+        if due:
+            self.post()
+
+    def check(self):
+        """ Raises Cancelled if the run has been cancelled """
+        if self._cancel.is_set():
+            raise Cancelled('Cancelled')
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def snapshot(self):
+        """ Returns a dict of the counts, totals, throughput (bytes/s) and ETA (seconds, or None) """
+        with self._lock:
+            now = time.monotonic()
+            self.samples.append((now, self.bytes))
+            while len(self.samples) > 2 and now - self.samples[0][0] > RATE_SECONDS:
+                self.samples.popleft()
+            then, done = self.samples[0]
+            rate = (self.bytes - done) / (now - then) if now > then else 0.0
+            eta = None
+            if self.total_bytes and rate > 0:
+                eta = max(0, self.total_bytes - self.bytes) / rate
+            return {'label': self.label, 'files': self.files, 'total_files': self.total_files,
+                    'bytes': self.bytes, 'total_bytes': self.total_bytes, 'rate': rate, 'eta': eta,
+                    'elapsed': now - self.started, 'cancelled': self._cancel.is_set()}
+
+    def post(self):
+        if self.updates is None:
+            return
+        snapshot = self.snapshot()
+        with self._lock:
+            self.posted = time.monotonic()
+        self.updates.put(('progress', snapshot))
+
+
+def tree_totals(folder, list_threads=WALK_THREADS):
+    """ The number of files and bytes below a folder, counted as the inventory would see them """
+    files = 0
+    nbytes = 0
+    for entry in walk_files(folder, hidden=False, ds_store='skip', threads=list_threads):
+        files += 1
+        nbytes += entry_stat(entry).st_size
+    return [files, nbytes]
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Run report for SIP Maker
+Where the time of a batch goes: each stage's wall-clock and CPU time,
+and for every object the seconds, files and bytes read and written of
+each stage it went through. Written at the end of the run as JSON (the
+summary, with the slowest objects of each stage) and CSV (one row per
+object and stage) to 'run_reports' in the Processing Folder.
+Recording is a few counters per file under a lock, so it stays on.
+
+When objects flow through the stages together (see scheduler.py), the
+stages overlap: their 'object_seconds' is the time objects spent in
+them, and wall-clock and CPU time are only known for the run as a whole.
+====================================================================
+"""
+
+import csv, json, statistics, threading, time
+from contextlib import contextmanager
+from os import mkdir, path
+
+""" Global Variables """
+REPORTS_FOLDER = 'run_reports'
+OBJECT_HEADROW = ['Stage', 'Object', 'Seconds', 'Files', 'Bytes Read', 'Bytes Written', 'MB/s', 'Outlier']
+# An object is an outlier when it takes this many times the stage's median...
+OUTLIER_FACTOR = 3
+# ...and at least this many seconds
+OUTLIER_MIN_SECONDS = 1.0
+# Slowest objects of each stage listed in the JSON report
+OUTLIERS_LISTED = 10
+
+
+def new_counts():
+    return {'seconds': 0.0, 'files': 0, 'bytes_read': 0, 'bytes_written': 0}
+
+
+class ObjectCounter:
+    """
+    Counts one object's files and bytes read for the report, and passes
+    them on to the run's Progress (see progress.py), if there is one.
+    The object is timed from the first check(); report.end() stops it.
+    """
+    def __init__(self, report, stage, objpath, progress=None):
+        self.report = report
+        self.stage = stage
+        self.objpath = objpath
+        self.progress = progress
+        self.started = False
+
+    def check(self):
+        if not self.started:
+            self.started = True
+            self.report.begin(self.stage, self.objpath)
+        if self.progress is not None:
+            self.progress.check()
+
+    def advance(self, files=1, nbytes=0):
+        self.report.add(self.stage, self.objpath, files=files, bytes_read=nbytes)
+        if self.progress is not None:
+            self.progress.advance(files, nbytes)
+
+
+class RunReport:
+    """
+    Timings and counts of one run. With no reportdir nothing is written,
+    but everything is still counted, so callers never need to check.
+    """
+    def __init__(self, reportdir=None, settings=None):
+        self.reportdir = reportdir
+        self.settings = settings or {}
+        self.name = time.strftime("%Y%m%d_%H%M%S")
+        self.started = time.strftime("%Y.%m.%d %H:%M:%S")
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.stages = {}
+        # (stage, object name) -> counts
+        self.objects = {}
+        self.starts = {}
+        self.lock = threading.Lock()
+
+    def _stage(self, stage):
+        # Called with the lock held
+        if stage not in self.stages:
+            self.stages[stage] = {'runs': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0}
+        return self.stages[stage]
+
+    def _object(self, stage, objpath):
+        # Called with the lock held
+        key = (stage, path.basename(path.normpath(objpath)))
+        if key not in self.objects:
+            self._stage(stage)
+            self.objects[key] = new_counts()
+        return self.objects[key]
+
+    @contextmanager
+    def stage(self, stage):
+        """ Times a whole stage (wall-clock and CPU of the process) """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                stats = self._stage(stage)
+                stats['runs'] += 1
+                stats['wall_seconds'] += time.perf_counter() - wall
+                stats['cpu_seconds'] += time.process_time() - cpu
+
+    def begin(self, stage, objpath):
+        with self.lock:
+            self.starts[(stage, objpath)] = time.perf_counter()
+
+    def end(self, stage, objpath):
+        with self.lock:
+            started = self.starts.pop((stage, objpath), None)
+            if started is not None:
+                self._object(stage, objpath)['seconds'] += time.perf_counter() - started
+
+    @contextmanager
+    def timed(self, stage, objpath):
+        """ Times one object's turn in a stage """
+        self.begin(stage, objpath)
+        try:
+            yield
+        finally:
+            self.end(stage, objpath)
+
+    def add(self, stage, objpath, files=0, bytes_read=0, bytes_written=0):
+        with self.lock:
+            counts = self._object(stage, objpath)
+            counts['files'] += files
+            counts['bytes_read'] += bytes_read
+            counts['bytes_written'] += bytes_written
+
+    def counter(self, stage, objpath, progress=None):
+        return ObjectCounter(self, stage, objpath, progress)
+
+    def outliers(self, stage):
+        """ [(object, seconds, times the median)] of a stage, slowest first, flagged or not """
+        timed = sorted(((counts['seconds'], obj) for (s, obj), counts in self.objects.items() if s == stage),
+                       reverse=True)
+        if not timed:
+            return []
+        median = statistics.median(seconds for seconds, obj in timed)
+        return [(obj, seconds, seconds / median if median > 0 else None) for seconds, obj in timed]
+
+    def is_outlier(self, seconds, factor):
+        return factor is not None and factor >= OUTLIER_FACTOR and seconds >= OUTLIER_MIN_SECONDS
+
+    def summary(self):
+        """ The JSON report, as a dict """
+        with self.lock:
+            wall = time.perf_counter() - self.wall0
+            cpu = time.process_time() - self.cpu0
+            stages = {}
+            for stage, stats in self.stages.items():
+                totals = new_counts()
+                objects = 0
+                for (s, obj), counts in self.objects.items():
+                    if s == stage:
+                        objects += 1
+                        for key in totals:
+                            totals[key] += counts[key]
+                seconds = stats['wall_seconds'] or totals['seconds']
+                stages[stage] = {
+                    'runs': stats['runs'],
+                    'wall_seconds': round(stats['wall_seconds'], 3) if stats['runs'] else None,
+                    'cpu_seconds': round(stats['cpu_seconds'], 3) if stats['runs'] else None,
+                    'object_seconds': round(totals['seconds'], 3),
+                    'objects': objects,
+                    'files': totals['files'],
+                    'bytes_read': totals['bytes_read'],
+                    'bytes_written': totals['bytes_written'],
+                    'read_mb_per_s': (round(totals['bytes_read'] / seconds / 1000000, 1)
+                                      if seconds and totals['bytes_read'] else None),
+                    }
+            outliers = {}
+            for stage in self.stages:
+                slowest = []
+                for obj, seconds, factor in self.outliers(stage)[:OUTLIERS_LISTED]:
+                    counts = self.objects[(stage, obj)]
+                    slowest.append({'object': obj, 'seconds': round(seconds, 3),
+                                    'times_median': round(factor, 1) if factor is not None else None,
+                                    'outlier': self.is_outlier(seconds, factor),
+                                    'files': counts['files'], 'bytes_read': counts['bytes_read']})
+                outliers[stage] = slowest
+        return {'run': self.name, 'started': self.started, 'finished': time.strftime("%Y.%m.%d %H:%M:%S"),
+                'wall_seconds': round(wall, 3), 'cpu_seconds': round(cpu, 3), 'settings': self.settings,
+                'stages': stages, 'slowest_objects': outliers}
+
+    def create_json(self):
+        """
+        Creates 'run_<name>.json' for this report, never an existing one: a
+        run that finishes in the same second as another gets '_2', '_3'...
+        added to its name. Returns the path and the open file.
+        """
+        stamp = self.name
+        n = 1
+        while True:
+            jsonpath = path.join(self.reportdir, f'run_{self.name}.json')
+            try:
+                return jsonpath, open(jsonpath, 'x', encoding='UTF-8')
+            except FileExistsError:
+                n += 1
+                self.name = f'{stamp}_{n}'
+
+    def write(self):
+        """ Writes 'run_<time>.json' and 'run_<time>_objects.csv'. Returns the JSON path, or None """
+        if self.reportdir is None or not (self.stages or self.objects):
+            return None
+        if not path.isdir(self.reportdir):
+            mkdir(self.reportdir)
+        jsonpath, jfile = self.create_json()
+        with jfile:
+            json.dump(self.summary(), jfile, indent=2)
+        with self.lock:
+            factors = {}
+            for stage in self.stages:
+                for obj, seconds, factor in self.outliers(stage):
+                    factors[(stage, obj)] = factor
+            rows = []
+            for (stage, obj), counts in sorted(self.objects.items()):
+                seconds = counts['seconds']
+                rate = round(counts['bytes_read'] / seconds / 1000000, 1) if seconds and counts['bytes_read'] else ''
+                rows.append([stage, obj, round(seconds, 3), counts['files'], counts['bytes_read'],
+                             counts['bytes_written'], rate,
+                             'yes' if self.is_outlier(seconds, factors.get((stage, obj))) else ''])
+        with open(path.join(self.reportdir, f'run_{self.name}_objects.csv'), 'w', newline='',
+                  encoding='UTF-8') as cfile:
+            cwriter = csv.writer(cfile)
+            cwriter.writerow(OBJECT_HEADROW)
+            cwriter.writerows(rows)
+        return jsonpath
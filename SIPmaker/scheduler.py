@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Pipelined scheduler for SIP Maker
+Instead of running each stage over the whole folder before starting
+the next, every object flows on its own through
+pre-bag -> metadata -> inventory -> BagIt -> tar, with small bounded
+queues between the stages. Inventory of one object overlaps bagging of
+the one before it and tarring of the one before that, so the first tar
+is ready for transfer long before the batch is done.
+
+Pre-bag, metadata and all of the yes/no questions run on the calling
+thread (so a window can show its dialogs); only the heavy stages run
+on worker threads.
+====================================================================
+"""
+
+import queue, threading
+from os import listdir, path
+from inventory import inventory_objects
+from progress import Cancelled
+from tarring import tar_builder
+
+""" Global Variables """
+# Objects waiting between two stages; a full queue holds back the stage before it
+STAGE_QUEUE_DEPTH = 2
+# Threads bagging at once (payload hashing inside a bag has its own pool)
+BAG_WORKERS = 2
+
+
+class ObjectJob:
+    """ One object on its way through the pipeline """
+    def __init__(self, name, objpath):
+        self.name = name
+        self.objpath = objpath
+        self.inventory = False
+        self.bag = False
+        self.tar = None
+        self.results = {}
+        self.failed = None
+
+
+class Stage:
+    """ Threads that take jobs from one queue, do their work, and pass them on to the next """
+    def __init__(self, name, work, workers, inbox, outbox):
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.threads = [threading.Thread(target=self.run, name=f'sip-{name}-{n}', daemon=True)
+                        for n in range(max(1, workers))]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                break
+            if job.failed is None:
+                try:
+                    self.work(job)
+                except Exception as e:
+                    job.failed = (self.name, e)
+            self.outbox.put(job)
+
+    def finish(self):
+        """ Waits for every job already queued to pass through """
+        for _ in self.threads:
+            self.inbox.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class InventoryStage:
+    """
+    A single thread running one inventory_objects() call over every
+    object the pipeline feeds it, so all objects share one hashing pool
+    """
+    name = 'inventory'
+
+    def __init__(self, pipeline, inbox, outbox):
+        self.pipeline = pipeline
+        self.inbox = inbox
+        self.outbox = outbox
+        self.pending = {}
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='sip-inventory', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def objects(self):
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                self.closed = True
+                return
+            if job.failed is None and job.inventory:
+                self.pending[job.objpath] = job
+                yield (job.objpath, path.join(job.objpath, job.name))
+            else:
+                self.outbox.put(job)
+
+    def done(self, objpath, changes):
+        job = self.pending.pop(objpath)
+        self.pipeline.inventory_finished(objpath, changes)
+        job.results['manifest'] = True
+        self.outbox.put(job)
+
+    def run(self):
+        try:
+            inventory_objects(self.objects(), self.pipeline.workers, self.pipeline.pool, self.pipeline.cache,
+                              on_finish=self.done, list_threads=self.pipeline.list_threads,
+                              update=self.pipeline.update_manifests, index=self.pipeline.duplicates,
+                              progress=self.pipeline.progress, report=self.pipeline.report,
+                              hints=self.pipeline.io_hints)
+        except Exception as e:
+            for job in list(self.pending.values()):
+                job.failed = (self.name, e)
+                self.outbox.put(job)
+            self.pending.clear()
+            # Keep jobs moving, so the stages downstream still finish
+            while not self.closed:
+                job = self.inbox.get()
+                if job is None:
+                    break
+                job.failed = job.failed or (self.name, e)
+                self.outbox.put(job)
+
+    def finish(self):
+        self.inbox.put(None)
+        self.thread.join()
+
+
+def run_pipelined(pipeline, itemsdir, procdir, stages, csvfile=None, idcolumn='Local ID'):
+    """
+    Runs the pre-bag, meta, inventory, bagit and tar stages object by
+    object, with the stages overlapping across objects. Returns the same
+    summary counts as running the stages one after another, plus the
+    names of any objects that failed. The transfer manifest is left to
+    the caller, since it covers the whole folder.
+    """
+    summary = {}
+    if 'bagit' in stages and not pipeline.storage_ok():
+        return summary
+    metacsv = None
+    if 'meta' in stages:
+        if not path.splitext(csvfile)[1] == '.csv':
+            pipeline.prompter.warn("The metadata source file must be CSV.\nQuitting action.")
+            return summary
+        metacsv = pipeline.read_meta_csv(csvfile)
+        if metacsv is None:
+            return summary
+        summary['metadata_csv'] = summary['metadata_xml'] = 0
+    if 'prebag' in stages:
+        summary['prebagged'] = 0
+    if 'inventory' in stages:
+        summary['manifests'] = 0
+    if 'bagit' in stages:
+        summary['bags'] = summary['valid_bags'] = 0
+    if 'tar' in stages:
+        summary['tars'] = summary['tars_skipped'] = 0
+        outfolder = pipeline.tar_outfolder(procdir)
+        build = tar_builder(pipeline.one_per_device, ['md5', 'sha256'], pipeline.compression, pipeline.progress)
+    summary['failed'] = []
+    names = sorted(listdir(itemsdir))
+    # Metadata rows are written once their object has been pre-bagged; rows
+    # that match no object are handled up front, as they only ask questions
+    meta_rows = {}
+    if metacsv is not None:
+        headers, rows = metacsv
+        for row in rows:
+            if row['%s' % idcolumn] in names:
+                meta_rows.setdefault(row['%s' % idcolumn], []).append(row)
+            else:
+                pipeline.meta_for_row(row, headers, idcolumn, itemsdir)
+
+    def bag(job):
+        pipeline.check_cancel()
+        if job.bag:
+            job.results['valid'] = pipeline.bag_object(job.objpath)
+
+    def tar(job):
+        pipeline.check_cancel()
+        if job.tar is not None:
+            pipeline.tar_object(build, job.tar)
+
+    inv_q = queue.Queue(STAGE_QUEUE_DEPTH)
+    bag_q = queue.Queue(STAGE_QUEUE_DEPTH)
+    tar_q = queue.Queue(STAGE_QUEUE_DEPTH)
+    done_q = queue.Queue()
+    workers = [InventoryStage(pipeline, inv_q, bag_q),
+               Stage('bagit', bag, BAG_WORKERS, bag_q, tar_q),
+               Stage('tar', tar, pipeline.tar_workers, tar_q, done_q)]
+
+    def report(job):
+        """ Counts a finished job and shows its warnings, on the calling thread """
+        if job.results.get('manifest'):
+            summary['manifests'] += 1
+        if job.failed is not None:
+            summary['failed'].append(job.name)
+            if isinstance(job.failed[1], Cancelled):
+                return
+            pipeline.prompter.warn(f'{job.name} failed during {job.failed[0]}: {job.failed[1]}')
+            return
+        if job.bag:
+            summary['bags'] += 1
+            if job.results['valid']:
+                summary['valid_bags'] += 1
+            else:
+                pipeline.prompter.warn(f'Bag {job.name} is not a valid APTrust bag.')
+        if job.tar is not None:
+            summary['tars'] += 1
+
+    def drain():
+        while True:
+            try:
+                report(done_q.get_nowait())
+            except queue.Empty:
+                return
+
+    # The stages overlap, so their wall-clock and CPU time is only known together
+    with pipeline.report.stage('pipelined'):
+        for worker in workers:
+            worker.start()
+        try:
+            for name in names:
+                pipeline.check_cancel()
+                objpath = path.join(itemsdir, name)
+                if 'prebag' in stages and len(name.split('.')) == 1:
+                    if pipeline.prebag_object(itemsdir, name, summary['prebagged'] + 1):
+                        summary['prebagged'] += 1
+                for row in meta_rows.get(name, []):
+                    made = pipeline.meta_for_row(row, headers, idcolumn, itemsdir)
+                    summary['metadata_csv'] += made[0]
+                    summary['metadata_xml'] += made[1]
+                job = ObjectJob(name, objpath)
+                if 'inventory' in stages:
+                    job.inventory = pipeline.inventory_wanted(itemsdir, name)
+                if 'bagit' in stages:
+                    job.bag = pipeline.bag_wanted(itemsdir, name)
+                if 'tar' in stages and path.isdir(objpath):
+                    job.tar = pipeline.tar_job(itemsdir, procdir, name)
+                    if job.tar is None:
+                        summary['tars_skipped'] += 1
+                if job.inventory or job.bag or job.tar is not None:
+                    inv_q.put(job)
+                drain()
+        finally:
+            # Let every queued object through, even if a question stopped the batch
+            for worker in workers:
+                worker.finish()
+            drain()
+    # Objects cut short by a cancel are rolled back by the journal next time
+    pipeline.check_cancel()
+    pipeline.report_changes()
+    if 'inventory' in stages:
+        pipeline.report_duplicates()
+    if summary.get('tars_skipped'):
+        pipeline.prompter.warn(f'The folder {outfolder} already contained {summary["tars_skipped"]} tar files which were skipped.')
+    return summary
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+====================================================================
+SIP Maker - command line
+Runs the SIP Maker stages without the window, e.g. on a server or
+from a scheduled job. Questions that the window would ask are answered
+by a policy file (JSON), and every answer is logged.
+
+Example:
+    python sipmaker_cli.py /data/items --processing /data/processing \
+        --csv /data/master.csv --storage Standard --policy policy.json
+====================================================================
+"""
+
+import argparse, sys
+from multiprocessing import freeze_support
+from inventory import DEFAULT_WORKERS, POOL_MODES
+from iohints import IO_HINT_MODES, IO_HINTS
+from bagging import VALIDATION_TIERS
+from tarring import COMPRESSIONS, TAR_WORKERS
+from pipeline import STAGES, STORAGE_OPTIONS, Policy, SIPPipeline, StopBatch, run_batch
+
+""" Exit codes """
+EXIT_OK = 0
+EXIT_STOPPED = 1
+EXIT_USAGE = 2
+EXIT_INVALID_BAGS = 3
+EXIT_FAILED = 4
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Build APTrust SIPs from a folder of items, without the window.')
+    parser.add_argument('items', help='Folder of Items')
+    parser.add_argument('-p', '--processing', default='', help='Processing Folder (for ready_to_transfer etc.)')
+    parser.add_argument('--csv', help='master CSV metadata file (needed for the "meta" stage)')
+    parser.add_argument('--id-column', default='Local ID', help='column of IDs in the CSV (default: Local ID)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f'comma-separated stages to run, in order (default: {",".join(STAGES)})')
+    parser.add_argument('--stage-by-stage', action='store_true',
+                        help='finish each stage for every object before starting the next (default: objects flow through the stages independently)')
+    parser.add_argument('--policy', help='JSON file of answers to the yes/no questions')
+    parser.add_argument('--storage', default='Glacier-Deep-OH', choices=STORAGE_OPTIONS, help='APTrust storage option')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='inventory worker count')
+    parser.add_argument('--list-threads', type=int, default=0,
+                        help='folders listed at once while walking objects; try 8-16 on network shares (default: 0, one by one)')
+    parser.add_argument('--update-manifests', action='store_true',
+                        help="bring an existing 'manifest.csv' up to date, rehashing only new and changed files")
+    parser.add_argument('--pool', default='thread', choices=POOL_MODES, help='inventory worker pool')
+    parser.add_argument('--force-rehash', action='store_true', help='ignore digests cached from earlier runs')
+    parser.add_argument('--validation', default='tags', choices=VALIDATION_TIERS, help='APTrust bag validation tier')
+    parser.add_argument('--sample', type=int, default=100, help='percent of files rehashed by "full" validation')
+    parser.add_argument('--tar-workers', type=int, default=TAR_WORKERS, help='archives built at once')
+    parser.add_argument('--one-per-device', action='store_true',
+                        help='only one archive at a time reading or writing each volume')
+    parser.add_argument('--compression', default='none', choices=sorted(COMPRESSIONS), help='tar compression')
+    parser.add_argument('--io-hints', default=IO_HINTS, choices=IO_HINT_MODES,
+                        help=f"page cache hints while hashing; 'stream' keeps a batch from filling the cache of a shared server (default: {IO_HINTS})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    try:
+        policy = Policy.from_file(args.policy) if args.policy else Policy()
+    except (OSError, ValueError) as e:
+        print(f'Cannot use policy file: {e}', file=sys.stderr)
+        return EXIT_USAGE
+    pipeline = SIPPipeline(policy, args.storage, args.workers, args.pool, args.validation, args.sample,
+                           args.tar_workers, args.one_per_device, args.compression, args.list_threads,
+                           args.update_manifests, args.io_hints)
+    try:
+        summary = run_batch(pipeline, args.items, args.processing, stages, args.csv, args.id_column,
+                            trust=not args.force_rehash, pipelined=not args.stage_by_stage)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return EXIT_USAGE
+    except StopBatch as e:
+        print(f'Stopped: {e}', file=sys.stderr)
+        return EXIT_STOPPED
+    for key, value in summary.items():
+        print(f'{key}: {value}')
+    if summary.get('failed'):
+        return EXIT_FAILED
+    if summary.get('bags', 0) != summary.get('valid_bags', 0):
+        return EXIT_INVALID_BAGS
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    freeze_support()
+    sys.exit(main())
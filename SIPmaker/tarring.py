@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Tar writer for SIP Maker
+Streams each archive through a digesting tee, so the MD5 and SHA-256
+needed for the transfer manifest are known the moment the tar is
+closed, without reading it back from disk. Archives can optionally be
+compressed in parallel blocks (gzip or zstd).
+====================================================================
+"""
+
+import gzip, tarfile, threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import ExitStack, contextmanager
+from os import cpu_count, listdir, path, stat
+from fixity import DEFAULT_ALGORITHMS, new_hashers
+
+""" Global Variables """
+# Archives built at once by tar_many
+TAR_WORKERS = 4
+# Compression formats and the file extension each one produces
+COMPRESSIONS = {'none': '.tar', 'gzip': '.tar.gz', 'zstd': '.tar.zst'}
+# Compression threads per archive, and the size of each independently compressed block
+COMPRESS_THREADS = min(8, cpu_count() or 1)
+BLOCKSIZE = 4 * 1024 * 1024
+# Normal and "store only" levels for each format
+LEVELS = {'gzip': (6, 0), 'zstd': (3, -7)}
+# Members in these formats are already compressed and are not recompressed
+ALREADY_COMPRESSED = ('.jpg', '.jpeg', '.jp2', '.mp4', '.mp3', '.zip', '.gz', '.zst')
+
+
+class HashingWriter:
+    """ Write-only file object that digests every byte passed through it """
+    def __init__(self, fileobj, algorithms=DEFAULT_ALGORITHMS):
+        self.fileobj = fileobj
+        self.hashers = new_hashers(algorithms)
+        self._updaters = [h.update for h in self.hashers.values()]
+        self.offset = 0
+
+    def write(self, data):
+        for update in self._updaters:
+            update(data)
+        self.offset += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def digests(self):
+        return {alg: h.hexdigest() for alg, h in self.hashers.items()}
+
+
+def gzip_block(data, level):
+    """ One complete gzip member; concatenated members are a valid .gz (as pigz -i) """
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def zstd_block(data, level):
+    """ One complete zstd frame; concatenated frames are a valid .zst """
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd compression needs the \'zstandard\' package (pip install zstandard)')
+    return zstandard.ZstdCompressor(level=level, write_content_size=True).compress(data)
+
+
+class BlockCompressor:
+    """
+    Write-only file object that cuts the stream into blocks and
+    compresses them on a thread pool (zlib and zstd release the GIL),
+    writing the results downstream in order
+    """
+    def __init__(self, fileobj, compression='gzip', threads=COMPRESS_THREADS, blocksize=BLOCKSIZE):
+        if compression not in LEVELS:
+            raise ValueError(f'Unknown compression: {compression}')
+        self.fileobj = fileobj
+        self.codec = gzip_block if compression == 'gzip' else zstd_block
+        self.level, self.store_level = LEVELS[compression]
+        self.current_level = self.level
+        self.blocksize = blocksize
+        self.threads = max(1, threads)
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        while len(self.buffer) >= self.blocksize:
+            self._submit(bytes(self.buffer[:self.blocksize]))
+            del self.buffer[:self.blocksize]
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def store_only(self, yesno):
+        """ Switches between normal compression and the fastest level for the members that follow """
+        level = self.store_level if yesno else self.level
+        if not level == self.current_level:
+            self._flush_block()
+            self.current_level = level
+
+    def _flush_block(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(self.codec, block, self.current_level))
+        # Bound the blocks in memory: write out the oldest once the pool is full
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._flush_block()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+
+
+def member_counter(progress):
+    """
+    A TarFile.add filter that checks the Progress before each member and
+    counts the one before it, once its data is written
+    """
+    last = []
+
+    def count(tarinfo):
+        progress.check()
+        if last:
+            progress.advance(1, last.pop())
+        if tarinfo.isreg():
+            last.append(tarinfo.size)
+        return tarinfo
+
+    def flush():
+        if last:
+            progress.advance(1, last.pop())
+    count.flush = flush
+    return count
+
+
+def add_tree(newtar, name, arcname, compressor, counter=None):
+    """
+    Same as TarFile.add (recursive, sorted), but tells the compressor
+    before each member whether its data is already compressed
+    """
+    tarinfo = newtar.gettarinfo(name, arcname)
+    if tarinfo is None:
+        return
+    if counter is not None:
+        counter(tarinfo)
+    compressor.store_only(tarinfo.isreg() and path.splitext(name)[1].lower() in ALREADY_COMPRESSED)
+    if tarinfo.isreg():
+        with open(name, 'rb') as memberfile:
+            newtar.addfile(tarinfo, memberfile)
+    elif tarinfo.isdir():
+        newtar.addfile(tarinfo)
+        for f in sorted(listdir(name)):
+            add_tree(newtar, path.join(name, f), path.join(arcname, f), compressor, counter)
+    else:
+        newtar.addfile(tarinfo)
+
+
+def write_tar(infile, outfile, arcname, algorithms=DEFAULT_ALGORITHMS, compression='none',
+              threads=COMPRESS_THREADS, progress=None):
+    """
+    Tars a folder to outfile, optionally compressed, and returns the
+    digests of the archive as written, keyed by algorithm. Each member
+    is counted on the Progress, if given, which is checked between members.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression: {compression}')
+    counter = member_counter(progress) if progress is not None else None
+    with open(outfile, 'wb') as rawtar:
+        tee = HashingWriter(rawtar, algorithms)
+        if compression == 'none':
+            with tarfile.open(fileobj=tee, mode='w') as newtar:
+                newtar.add(infile, arcname=arcname, filter=counter)
+        else:
+            compressor = BlockCompressor(tee, compression, threads)
+            try:
+                with tarfile.open(fileobj=compressor, mode='w') as newtar:
+                    add_tree(newtar, infile, arcname, compressor, counter)
+            finally:
+                compressor.close()
+    if counter is not None:
+        counter.flush()
+    return tee.digests()
+
+
+def tar_devices(infile, outfile):
+    """ The volumes (st_dev) an archive reads from and writes to, in a fixed order """
+    return sorted({stat(infile).st_dev, stat(path.dirname(outfile)).st_dev})
+
+
+class DeviceLocks:
+    """
+    One lock per volume, by st_dev. An archive holds the locks of both the
+    volume it reads and the one it writes, so each disk streams one
+    archive at a time and is read (or written) sequentially, while
+    archives that share no volume are tarred side by side. The locks are
+    always taken in st_dev order, so two archives cannot deadlock.
+    """
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def lock_for(self, device):
+        with self._guard:
+            return self._locks.setdefault(device, threading.Lock())
+
+    @contextmanager
+    def holding(self, infile, outfile):
+        with ExitStack() as stack:
+            for device in tar_devices(infile, outfile):
+                stack.enter_context(self.lock_for(device))
+            yield
+
+
+def tar_builder(one_per_device=False, algorithms=DEFAULT_ALGORITHMS, compression='none', progress=None):
+    """
+    Returns a function build(infile, outfile, arcname, progress=None) ->
+    digests that is safe to call from several threads. With one_per_device,
+    archives that share a source or destination volume are written one
+    after another. A progress given to build is used instead of the
+    builder's, e.g. to count each archive separately.
+    """
+    devices = DeviceLocks() if one_per_device else None
+    default_progress = progress
+
+    def build(infile, outfile, arcname, progress=None):
+        if progress is None:
+            progress = default_progress
+        if devices is None:
+            return write_tar(infile, outfile, arcname, algorithms, compression, progress=progress)
+        with devices.holding(infile, outfile):
+            return write_tar(infile, outfile, arcname, algorithms, compression, progress=progress)
+    return build
+
+
+def tar_many(jobs, workers=TAR_WORKERS, one_per_device=False, algorithms=DEFAULT_ALGORITHMS, compression='none',
+             progress=None):
+    """
+    Builds several tars at once. 'jobs' is a list of (infile, outfile,
+    arcname), each optionally followed by its own progress. Yields
+    (outfile, digests) as each archive is finished.
+    With one_per_device, the jobs wait in one queue per source volume and
+    a job is only handed to the pool once no running archive shares its
+    source or destination volume, so no worker sits idle waiting for a
+    disk while archives on other volumes could be built.
+    """
+    build = tar_builder(False, algorithms, compression, progress)
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if not one_per_device:
+            futures = {pool.submit(build, *job): job[1] for job in jobs}
+            for fut in as_completed(futures):
+                yield futures[fut], fut.result()
+            return
+        queues = {}
+        for job in jobs:
+            devices = tar_devices(job[0], job[1])
+            queues.setdefault(stat(job[0]).st_dev, deque()).append((devices, job))
+        busy = set()
+        running = {}
+
+        def fill():
+            for waiting in queues.values():
+                if len(running) >= workers:
+                    return
+                if waiting and not busy.intersection(waiting[0][0]):
+                    devices, job = waiting.popleft()
+                    busy.update(devices)
+                    running[pool.submit(build, *job)] = (job[1], devices)
+        fill()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                outfile, devices = running.pop(fut)
+                busy.difference_update(devices)
+                yield outfile, fut.result()
+            fill()
+
+
+class TarDigests:
+    """
+    Digests of the archives written during this run, so the transfer
+    manifest can use them as long as the tar on disk is unchanged
+    """
+    def __init__(self):
+        self.records = {}
+
+    def add(self, tarpath, digests):
+        statinfo = stat(tarpath)
+        self.records[path.abspath(tarpath)] = (statinfo.st_size, statinfo.st_mtime_ns, digests)
+        return statinfo
+
+    def remember(self, tarpath, size, mtime_ns, digests):
+        """ Digests recorded by an earlier run, e.g. in the job journal """
+        self.records[path.abspath(tarpath)] = (size, mtime_ns, digests)
+
+    def get(self, tarpath, algorithms=DEFAULT_ALGORITHMS):
+        record = self.records.get(path.abspath(tarpath))
+        if record is None or not path.exists(tarpath):
+            return None
+        size, mtime_ns, digests = record
+        statinfo = stat(tarpath)
+        if not (statinfo.st_size == size and statinfo.st_mtime_ns == mtime_ns):
+            return None
+        if not all(alg in digests for alg in algorithms):
+            return None
+        return {alg: digests[alg] for alg in algorithms}
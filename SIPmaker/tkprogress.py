@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Worker thread and progress panel for the Tk tools
+Shared by SIP Maker, DnDprepack, DVD Inventory and the ETD loader:
+BackgroundRun runs a job on a worker thread and shows its Progress
+(see progress.py) in a ProgressPanel with a Cancel button, while
+MainThread lets the worker show dialogs, which only the main thread
+may do.
+====================================================================
+"""
+
+import queue, threading
+from tkinter import Button, Label, StringVar, Toplevel
+from inventory import convert_size
+from progress import Progress
+
+""" Global Variables """
+# ms between checks on the worker
+POLL_MS = 100
+# Official UAB RGB values
+uabgreen = '#%02x%02x%02x' % (30, 107, 82)
+blazegold = '#%02x%02x%02x' % (170, 151, 103)
+gray = '#%02x%02x%02x' % (215, 210, 203)
+
+
+class MainThread:
+    """
+    Stands in for a module of Tk dialogs (messagebox, filedialog). Called
+    from the worker thread, each dialog is handed to the main thread, which
+    owns the window, and the worker waits for the answer.
+    """
+    calls = queue.Queue()
+
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        func = getattr(self.module, name)
+        return lambda *args, **kwargs: MainThread.call(func, *args, **kwargs)
+
+    @classmethod
+    def call(cls, func, *args, **kwargs):
+        if threading.current_thread() is threading.main_thread():
+            return func(*args, **kwargs)
+        answer = []
+        done = threading.Event()
+        cls.calls.put((func, args, kwargs, answer, done))
+        done.wait()
+        ok, value = answer[0]
+        if not ok:
+            raise value
+        return value
+
+    @classmethod
+    def run_pending(cls):
+        """ Shows the dialogs the worker is waiting on; called on the main thread """
+        while True:
+            try:
+                func, args, kwargs, answer, done = cls.calls.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                answer.append((True, func(*args, **kwargs)))
+            except Exception as e:
+                answer.append((False, e))
+            finally:
+                done.set()
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return '--'
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+class ProgressPanel(Toplevel):
+    """ Files, bytes, throughput and ETA of the running job, with a button to cancel it """
+    def __init__(self, root, title, progress):
+        Toplevel.__init__(self, root)
+        self.progress = progress
+        self.title(title)
+        self.configure(bg=uabgreen, bd=4)
+        self.transient(root)
+        # Closing the panel cancels, rather than leaving the job without a panel
+        self.protocol('WM_DELETE_WINDOW', self.cancel)
+        self.fields = {}
+        for row, name in enumerate(['Action', 'Files', 'Bytes', 'Throughput', 'ETA']):
+            labl = Label(self, text=f'{name}:', width=10, anchor='e')
+            labl.configure(fg='black', bg=blazegold, font=('Arial', 10))
+            labl.grid(column=0, row=row, pady=2, padx=5, sticky='e')
+            self.fields[name] = StringVar(self)
+            value = Label(self, textvariable=self.fields[name], width=36, anchor='w')
+            value.configure(fg='black', bg=gray, font=('Arial', 11))
+            value.grid(column=1, row=row, pady=2, padx=5, sticky='w')
+        self.cancel1 = Button(self, text='Cancel', command=self.cancel)
+        self.cancel1.configure(bg=gray, fg='black', highlightbackground=uabgreen, font=('Arial', 11))
+        self.cancel1.grid(column=0, row=5, columnspan=2, pady=5, padx=5)
+        self.show(progress.snapshot())
+
+    def cancel(self):
+        """ The job stops at the next file boundary """
+        self.progress.cancel()
+        self.cancel1.configure(text='Cancelling...', state='disabled')
+
+    def show(self, snapshot):
+        self.fields['Action'].set(snapshot['label'])
+        files = f'{snapshot["files"]:,}'
+        if snapshot['total_files']:
+            files += f' of {snapshot["total_files"]:,}'
+        self.fields['Files'].set(files)
+        nbytes = convert_size(snapshot['bytes'])
+        if snapshot['total_bytes']:
+            nbytes += f' of {convert_size(snapshot["total_bytes"])}'
+        self.fields['Bytes'].set(nbytes)
+        self.fields['Throughput'].set(f'{snapshot["rate"] / 1000000:.1f} MB/s')
+        self.fields['ETA'].set(format_eta(snapshot['eta']))
+
+
+class BackgroundRun:
+    """
+    Runs work(progress) on a worker thread, so the window keeps responding,
+    and shows its progress in a ProgressPanel. When the work ends,
+    on_done(result, error) is called on the main thread.
+    """
+    def __init__(self, root, title, work, on_done):
+        self.root = root
+        self.on_done = on_done
+        self.updates = queue.Queue()
+        self.progress = Progress(self.updates)
+        self.panel = ProgressPanel(root, title, self.progress)
+        self.thread = threading.Thread(target=self.run, args=(work,), name='tk-worker', daemon=True)
+        self.thread.start()
+        root.after(POLL_MS, self.poll)
+
+    def run(self, work):
+        try:
+            result = work(self.progress)
+        except BaseException as e:
+            self.updates.put(('done', None, e))
+        else:
+            self.updates.put(('done', result, None))
+
+    def poll(self):
+        MainThread.run_pending()
+        snapshot = None
+        finished = None
+        while True:
+            try:
+                message = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                snapshot = message[1]
+            else:
+                finished = message
+        if snapshot is not None:
+            self.panel.show(snapshot)
+        if finished is None:
+            self.root.after(POLL_MS, self.poll)
+            return
+        self.panel.destroy()
+        self.on_done(finished[1], finished[2])
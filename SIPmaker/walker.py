@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+====================================================================
+Directory walker for SIP Maker
+Built on os.scandir, so the file type of each entry comes with the
+directory listing and its stat() is made at most once and then cached
+on the DirEntry. On SMB/NFS shares every extra isdir/exists/stat is a
+network round trip; walking this way keeps it to one listing per folder
+and one stat per file.
+====================================================================
+"""
+
+import heapq, threading
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from os import path, remove, scandir, sep, stat
+from platform import system
+
+""" Global Variable for User OS"""
+USER_OS = system()
+
+""" Global Variable for the folders listed at once by walk_files; 0 lists them one by one """
+WALK_THREADS = 0
+
+
+def scan_dir(folder, hidden=True, exclude=()):
+    """
+    The entries of one folder, sorted by name. Hidden ('.') names are
+    left out unless hidden=True; names matching any 'exclude' pattern
+    (fnmatch style, e.g. 'Thumbs.db' or '*.tmp') are always left out.
+    """
+    with scandir(folder) as entries:
+        found = [entry for entry in entries
+                 if (hidden or not entry.name.startswith('.'))
+                 and not any(fnmatch(entry.name, pattern) for pattern in exclude)]
+    found.sort(key=lambda entry: entry.name)
+    return found
+
+
+def entry_stat(entry):
+    """
+    The stat result of a DirEntry. On Windows the cached one has no
+    inode, device or link count, so those are fetched with one full stat.
+    """
+    if USER_OS == 'Windows':
+        return stat(entry.path)
+    return entry.stat()
+
+
+def list_folder(folder, hidden=False, ds_store='remove', exclude=()):
+    """ One folder's files (DirEntry) and subfolder paths, both in name order, under the walk_files() rules """
+    files = []
+    subdirs = []
+    for entry in scan_dir(folder, True, exclude):
+        if entry.is_dir():
+            if not entry.is_symlink():
+                subdirs.append(entry.path)
+        elif entry.name == '.DS_Store' and not ds_store == 'keep':
+            if ds_store == 'remove':
+                remove(entry.path)
+        elif hidden or not entry.name.startswith('.'):
+            files.append(entry)
+    return [files, subdirs]
+
+
+class ConcurrentLister:
+    """
+    Lists folders ahead of a depth-first walk on a thread pool. As each
+    listing arrives its subfolders are queued, and the ones the walk will
+    reach first are listed first. At most 'limit' listings are running or
+    waiting to be used at any time, so memory stays flat on huge trees.
+    """
+    def __init__(self, pool, limit, lister):
+        self.pool = pool
+        self.limit = max(1, limit)
+        self.lister = lister
+        # Reentrant: a listing that is already finished runs its callback in _submit
+        self.lock = threading.RLock()
+        self.futures = {}
+        self.queued = []
+        # Every folder ever submitted, so none is listed twice, even once
+        # its listing has been used and dropped from self.futures
+        self.submitted = set()
+        self.outstanding = 0
+
+    def _submit(self, folder):
+        # Called with the lock held
+        self.outstanding += 1
+        self.submitted.add(folder)
+        future = self.pool.submit(self.lister, folder)
+        self.futures[folder] = future
+        future.add_done_callback(lambda fut: self._prefetch(fut))
+
+    def _fill(self):
+        while self.queued and self.outstanding < self.limit:
+            key, folder = heapq.heappop(self.queued)
+            if folder not in self.submitted:
+                self._submit(folder)
+
+    def _prefetch(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            for folder in future.result()[1]:
+                if folder not in self.submitted:
+                    heapq.heappush(self.queued, (path.normpath(folder).split(sep), folder))
+            self._fill()
+
+    def listing(self, folder):
+        """ The [files, subfolders] of a folder, waiting for it if need be """
+        with self.lock:
+            if folder not in self.futures:
+                self._submit(folder)
+            future = self.futures[folder]
+        try:
+            return future.result()
+        finally:
+            with self.lock:
+                del self.futures[folder]
+                self.outstanding -= 1
+                self._fill()
+
+    def cancel(self):
+        with self.lock:
+            self.queued = []
+            for future in self.futures.values():
+                future.cancel()
+
+
+def walk_files(top, hidden=False, ds_store='remove', exclude=(), threads=WALK_THREADS):
+    """
+    Yields a DirEntry for every file below top: the files of each folder
+    in name order, then each subfolder in name order (the same order as a
+    sorted os.walk). Use entry_stat(entry) for its stat result.
+    hidden:   yield files whose names begin with '.'; hidden folders are
+              always walked, as os.walk does
+    ds_store: 'remove' deletes '.DS_Store' files, 'skip' leaves them
+              out, and 'keep' yields them like any other file
+    exclude:  fnmatch patterns for file and folder names to leave out
+    threads:  list up to this many folders at once (for network shares,
+              where each listing is a round trip); 0 or 1 lists them in turn
+    Symbolic links to folders are not followed.
+    """
+    if threads > 1:
+        yield from walk_concurrent(top, hidden, ds_store, exclude, threads)
+        return
+    files, subdirs = list_folder(top, hidden, ds_store, exclude)
+    yield from files
+    for subdir in subdirs:
+        yield from walk_files(subdir, hidden, ds_store, exclude, 0)
+
+
+def walk_concurrent(top, hidden, ds_store, exclude, threads):
+    """ walk_files() with the folder listings made on a thread pool; same entries, same order """
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        lister = ConcurrentLister(pool, threads * 2, lambda folder: list_folder(folder, hidden, ds_store, exclude))
+        stack = [top]
+        try:
+            while stack:
+                files, subdirs = lister.listing(stack.pop())
+                yield from files
+                stack.extend(reversed(subdirs))
+        finally:
+            lister.cancel()
@@ -6,23 +6,29 @@ Created: 2024-08-21
 Last modified: 2024-10-15 by L. I. Menzies
 """
 
-import hashlib
-import io
 import math
-import mimetypes
 import operator
-from os import getenv, mkdir, remove, stat, walk
+import sys
+import traceback
+from os import getenv, mkdir, remove, stat
 from os.path import abspath, exists, join, basename, dirname, relpath, isdir
 from pandas import DataFrame, ExcelWriter, ExcelFile
 from platform import system
-from shutil import copy2, copytree
+from shutil import copytree
 from sys import exit
 from time import strftime, localtime
 import tkinter as tk
 from tkinter import *
-from tkinter import messagebox
+from tkinter import messagebox as tk_messagebox
 from tkinter.filedialog import askopenfilename, askdirectory
 
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'SIPmaker'))
+from formats import identify, identify_file
+from iohints import copy_file
+from progress import Cancelled
+from tkprogress import BackgroundRun, MainThread
+from walker import walk_files
+
 """ Global color definitions, w/ official UAB RGB values """
 uabgreen = '#%02x%02x%02x' % (30, 107, 82)
 dragongreen = '#%02x%02x%02x' % (20, 75, 57)
@@ -33,10 +39,22 @@ smoke = '#%02x%02x%02x' % (128, 130, 133)
 gray = '#%02x%02x%02x' % (215, 210, 203)
 
 """ Global Variables """
-CHUNKSIZE = io.DEFAULT_BUFFER_SIZE
+# Page cache hints while copying a disc: 'off', 'sequential' (read-ahead),
+# or 'stream' (also drop what was copied; for shared servers); see SIPmaker/iohints.py
+COPY_IO_HINTS = 'sequential'
+# Folders listed at once while walking a disc (see SIPmaker/walker.py). An optical
+# drive seeks for every listing, so one at a time; raise it for a disc copied to a network share
+LIST_THREADS = 1
+
+""" Dialogs that are safe to show from the worker thread """
+messagebox = MainThread(tk_messagebox)
+
 
 class GetValues:
     def __init__(self, root):
+        self.root = root
+        # The BackgroundRun of the actions, while they are running
+        self.running = None
         frame001 = Frame(root)
         labl000 = Label(frame001, text='DVD Inventory')
         labl000.configure(fg='black', bg=gray, bd=0, font=('Arial', 10), height=3,
@@ -138,9 +156,9 @@ class GetValues:
         space.configure(fg=uabgreen, bg=uabgreen, highlightbackground='black', bd=0, font=('Arial', 8))
         space.grid(column=1, row=0, pady=0, padx=215, sticky=NSEW)
         # Submit
-        submit = Button(frame003, text='Submit', command=lambda: self.run_procs(disk_number))
-        submit.configure(fg='black', bg=gray, highlightbackground='white', font=('Arial', 11))
-        submit.grid(column=2, row=0, pady=5, padx=5, sticky=E)
+        self.submit = Button(frame003, text='Submit', command=lambda: self.run_procs(disk_number))
+        self.submit.configure(fg='black', bg=gray, highlightbackground='white', font=('Arial', 11))
+        self.submit.grid(column=2, row=0, pady=5, padx=5, sticky=E)
         frame003.configure(bg=uabgreen, highlightbackground='black', bd=5, relief=RAISED)
         frame003.grid(column=0, row=2, pady=0, padx=0, sticky=NSEW)
 
@@ -179,28 +197,6 @@ class GetValues:
         entryvals[5] = self.en006.get() # BlazerID
         return entryvals
 
-    def md5hash(file_name):
-        """ Generate SHA3-256 hashes. """
-        hash_md5 = hashlib.md5()
-        try:
-            with open(file_name, "rb") as md5file:
-                for chunks in iter(lambda: md5file.read(CHUNKSIZE), b""):
-                    hash_md5.update(chunks)
-        except OSError:
-            return "OS Error"
-        return hash_md5.hexdigest()
-
-    def sha3hash(filname):
-        """ Generate SHA3-256 hashes. """
-        hash_sha3 = hashlib.sha3_256()
-        try:
-            with open(filname, "rb") as sha3file:
-                for chunks in iter(lambda: sha3file.read(CHUNKSIZE), b""):
-                    hash_sha3.update(chunks)
-        except OSError:
-            return "OS Error"
-        return hash_sha3.hexdigest()
-
     def convert_size(self, size):
         """ Make file sizes human readable """
         if (size == 0):
@@ -214,7 +210,7 @@ class GetValues:
         s = round(size / p, 2)
         return '%s%s' % (s, size_name[i])
 
-    def run_inventory(self, entry_values):
+    def run_inventory(self, entry_values, progress):
         """ Run the inventory and output as Excel """
         filecounter = 0
         dsstore_count = 0
@@ -236,31 +232,39 @@ class GetValues:
         all_rows = []
         colnames = ['Accession Number', 'Disk Number', 'Disk Label', 'File Name',
                     'Path', 'Size', 'Format', 'Created', 'Modified', 'Date Run', 'Run By']
-        for base, dirs, files in walk(indir):
-            for name in files:
-                filepathname = join(base, name)
-                # Ignore or delete .DS_Store Files
-                if basename(filepathname) == '.DS_Store':
-                    # remove(filepathname)
-                    dsstore_count += 1
-                elif not basename(filepathname) == '.DS_Store':
-                    filecounter += 1
-                    statinfo = stat(filepathname)
-                    filesize = statinfo[6]
-                    csize = self.convert_size(filesize)
-                    filemime = str(mimetypes.guess_type(filepathname)[0])
-                    filectime = strftime("%Y.%m.%d %H:%M:%S",
-                                         localtime(statinfo.st_ctime))
-                    # Note: On Windows, ctime is "date created" but on Unix it is
-                    # "change time", i.e. the last time the metadata was changed.
-                    modifdate = strftime("%Y.%m.%d %H:%M:%S",
-                                         localtime(statinfo.st_mtime))
-                    showpath = relpath(filepathname, dirname(indir))
-                    runtime = strftime("%Y.%m.%d %H:%M:%S")
-                    newrow = [accno, diskno, disklabel, name, showpath, csize,
-                                filemime, filectime, modifdate, runtime, runby]
-                    all_rows.append(newrow)
-                    # print(f'\rProgress: {filecounter} Files', end='')
+        # The files are only found by the walk itself, so there are no totals
+        progress.start('Inventory')
+        for entry in walk_files(indir, hidden=True, ds_store='keep', threads=LIST_THREADS):
+            progress.check()
+            name = entry.name
+            filepathname = entry.path
+            # Ignore or delete .DS_Store Files
+            if name == '.DS_Store':
+                # remove(filepathname)
+                dsstore_count += 1
+            elif not name == '.DS_Store':
+                filecounter += 1
+                statinfo = entry.stat()
+                filesize = statinfo[6]
+                csize = self.convert_size(filesize)
+                try:
+                    filemime = identify_file(filepathname)
+                except OSError:
+                    # An unreadable file (e.g. a scratched disc) is named by its extension alone
+                    filemime = identify(b'', filepathname)
+                filectime = strftime("%Y.%m.%d %H:%M:%S",
+                                     localtime(statinfo.st_ctime))
+                # Note: On Windows, ctime is "date created" but on Unix it is
+                # "change time", i.e. the last time the metadata was changed.
+                modifdate = strftime("%Y.%m.%d %H:%M:%S",
+                                     localtime(statinfo.st_mtime))
+                showpath = relpath(filepathname, dirname(indir))
+                runtime = strftime("%Y.%m.%d %H:%M:%S")
+                newrow = [accno, diskno, disklabel, name, showpath, csize,
+                            filemime, filectime, modifdate, runtime, runby]
+                all_rows.append(newrow)
+                progress.advance(1, filesize)
+                # print(f'\rProgress: {filecounter} Files', end='')
         if dsstore_count > 0:
         #    print(f'\nSkipped {dsstore_count} \'.DS_Store\' files.\n')
             messagebox.showinfo(message=f'Skipped {dsstore_count} \'.DS_Store\' files.')
@@ -273,7 +277,7 @@ class GetValues:
         messagebox.showinfo(message=f'Total Files: \n{filecounter}')
         return True
 
-    def copy_img_files(self, entry_values):
+    def copy_img_files(self, entry_values, progress):
         iso_dir = entry_values[0].strip().replace(" ", "")
         working_dir = entry_values[1].strip().replace(" ", "")
         acc_num = entry_values[2].strip().replace(" ", "")
@@ -284,14 +288,29 @@ class GetValues:
             mkdir(out_dir)
         # Create the Disk Copy Directory
         destination = join(out_dir, f'Disk{disk_num}')
+        if exists(destination):
+            messagebox.showwarning(message=f'{destination}\nalready exists! Fix,\nand run \"copy\" again.')
+            return False
+        sizes = [entry.stat().st_size
+                 for entry in walk_files(iso_dir, hidden=True, ds_store='keep', threads=LIST_THREADS)]
+        progress.start('Copying disk', len(sizes), sum(sizes))
+
+        def copy_counted(src, dst):
+            # Cancelling stops between files, never part way through a copy
+            progress.check()
+            copy_file(src, dst, COPY_IO_HINTS)
+            progress.advance(1, stat(dst).st_size)
         try:
-            copytree(iso_dir, destination, copy_function=copy2)
+            copytree(iso_dir, destination, copy_function=copy_counted)
         except FileExistsError:
             messagebox.showwarning(message=f'{destination}\nalready exists! Fix,\nand run \"copy\" again.')
             return False
         return True
 
     def run_procs(self, dnumber):
+        """ Starts the selected actions on a worker thread, so the window keeps responding """
+        if self.running is not None:
+            return
         valid = False
         valid = self.onValidate(dnumber)
         if valid == False:
@@ -300,15 +319,34 @@ class GetValues:
         values = self.get_entries()
         inventory_yesno = self.inventoryvar.get()
         copy_yesno = self.copyvar.get()
+        self.submit.configure(state=DISABLED)
+        self.running = BackgroundRun(self.root, 'DVD Inventory Progress',
+                                     lambda progress: self.run_actions(values, inventory_yesno, copy_yesno, progress),
+                                     self.actions_done)
+
+    def actions_done(self, result, error):
+        """ Back on the main thread once the worker has stopped """
+        self.running = None
+        self.submit.configure(state=NORMAL)
+        if isinstance(error, SystemExit):
+            exit()
+        if isinstance(error, Cancelled):
+            messagebox.showinfo(message=f'Cancelled.\nA partial disk copy must be\ndeleted before copying again.')
+        elif error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            messagebox.showwarning(message=f'Stopped by an error:\n{error}')
+
+    def run_actions(self, values, inventory_yesno, copy_yesno, progress):
+        """ Runs on the worker thread """
         if inventory_yesno == 1:
             successful = False
-            successful = self.run_inventory(values)
+            successful = self.run_inventory(values, progress)
             if successful == False:
                 messagebox.showwarning(message=f'Something went wrong during\ninventory creation. Quitting.')
                 exit()
         if copy_yesno == 1:
             success = False
-            success = self.copy_img_files(values)
+            success = self.copy_img_files(values, progress)
             if success == False:
                 messagebox.showwarning(message=f'Something went wrong during\nthe copy process. Quitting.')
                 exit()
@@ -7,7 +7,7 @@ Output is an Excel spreadsheet for batch upload to Digital Commons
 Last modified by L. I. Menzies 2023-11-15
 """
 
-import csv, lxml, openpyxl, zipfile
+import csv, lxml, openpyxl, sys, traceback, zipfile
 import tkinter as tk
 from bs4 import BeautifulSoup
 from os import getcwd, getenv, listdir, mkdir, path, remove
@@ -17,9 +17,14 @@ from platform import system
 from shutil import copyfile, rmtree
 from time import strftime
 from tkinter import *
-from tkinter import messagebox
+from tkinter import messagebox as tk_messagebox
 from tkinter.filedialog import askdirectory
 
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'SIPmaker'))
+from progress import Cancelled
+from tkprogress import BackgroundRun, MainThread
+from walker import scan_dir
+
 """ Global color definitions, w/ official UAB RGB values """
 uabgreen = '#%02x%02x%02x' % (30, 107, 82)
 dragongreen = '#%02x%02x%02x' % (20, 75, 57)
@@ -29,8 +34,15 @@ blazegold = '#%02x%02x%02x' % (170, 151, 103)
 smoke = '#%02x%02x%02x' % (128, 130, 133)
 gray = '#%02x%02x%02x' % (215, 210, 203)
 
+""" Dialogs that are safe to show from the worker thread """
+messagebox = MainThread(tk_messagebox)
+
+
 class GetValues:
     def __init__(self, root):
+        self.root = root
+        # The BackgroundRun of the actions, while they are running
+        self.running = None
         frame001 = Frame(root)
         labl000 = Label(frame001, text='ETD_dcom_loader')
         labl000.configure(fg='black', bg=gray, bd=0, font=('Arial', 10), height=3, width=20, relief=SUNKEN, justify=CENTER)
@@ -107,9 +119,9 @@ class GetValues:
         space = Label(frame003, text='')
         space.configure(fg=uabgreen, bg=uabgreen, highlightbackground='black', bd=0, font=('Arial', 8))
         space.grid(column=1, row=0, pady=0, padx=235, sticky=NSEW)
-        submit = Button(frame003, text='Submit', command=self.run_procs)
-        submit.configure(fg='black', bg=gray, highlightbackground='white', font=('Arial', 11))
-        submit.grid(column=2, row=0, pady=5, padx=5, sticky=E)
+        self.submit = Button(frame003, text='Submit', command=self.run_procs)
+        self.submit.configure(fg='black', bg=gray, highlightbackground='white', font=('Arial', 11))
+        self.submit.grid(column=2, row=0, pady=5, padx=5, sticky=E)
         frame003.configure(bg=uabgreen, highlightbackground='black', bd=5, relief=RAISED)
         frame003.grid(column=0, row=2, pady=0, padx=0, sticky=NSEW)
 
@@ -230,8 +242,7 @@ class GetValues:
             xml_file.close()
         return new_row, bad_yesno
 
-    def make_excel(self, etds_dir, suppress):
-        entries = self.get_entries()
+    def make_excel(self, etds_dir, suppress, entries, progress):
         excel_folder = entries[1]
         timestamp = strftime("%Y%b%d_%H%M%S")
         excel_file = path.join(excel_folder, f'ETD_loader{timestamp}.xlsx')
@@ -240,14 +251,12 @@ class GetValues:
         etds_added = 0
         xml_paths = []
         # Add paths of XML files to a list:
-        for etd in listdir(etds_dir):
-            etd_path = path.join(etds_dir, etd)
-            if path.isdir(etd_path):
-                for xml_file in listdir(etd_path):
-                    if path.splitext(xml_file)[1].lower() == '.xml':
+        for etd in scan_dir(etds_dir):
+            if etd.is_dir():
+                for xml_file in scan_dir(etd.path):
+                    if path.splitext(xml_file.name)[1].lower() == '.xml':
                         etds_found += 1
-                        xml_path = path.join(etd_path, xml_file)
-                        xml_paths.append(xml_path)
+                        xml_paths.append(xml_file.path)
         # Create row of column headers and each subsequent row as a list
         all_rows = []
         header_row = ['title', 'fulltext_url', 'filename', 'keywords', 'abstract',
@@ -258,8 +267,11 @@ class GetValues:
                 'isbn', 'publication_date', 'season', 'pubmedid', 'subject_area', 'uuid']
         all_rows.append(header_row)
         skipped = 0
+        progress.start('Reading XML files', len(xml_paths))
         for mdata_path in xml_paths:
+            progress.check()
             next_row, badfile = self.get_meta_from_xml(mdata_path)
+            progress.advance(1, path.getsize(mdata_path))
             if not badfile:
                 all_rows.append(next_row)
                 etds_added += 1
@@ -276,7 +288,7 @@ class GetValues:
                 messagebox.showinfo(message=f'Found {etds_found} XML files.\nCreated {etds_added} Excel rows.\nSkipped {skipped} XML files.')
         return True
 
-    def copy_files(self, etds_dir, suppress):
+    def copy_files(self, etds_dir, suppress, progress):
         pdf_found = 0
         xml_found = 0
         new = 0
@@ -312,22 +324,27 @@ class GetValues:
         except Exception as e:
             messagebox.showwarning(message=f'Error: {e}\nQuitting copy function.')
             return False
-        for fols in listdir(etds_dir):
-            fols_path = path.join(etds_dir, fols)
-            if path.isdir(fols_path):
-                for i in listdir(fols_path):
-                    ipath = path.join(fols_path, i)
-                    if not path.isdir(ipath):
+        progress.start('Copying PDFs and XMLs')
+        for fols in scan_dir(etds_dir):
+            if fols.is_dir():
+                for entry in scan_dir(fols.path):
+                    # Cancelling stops between files, never part way through a copy
+                    progress.check()
+                    i = entry.name
+                    ipath = entry.path
+                    if not entry.is_dir():
                         if path.splitext(i)[1].lower() == '.pdf':
                             pdf_found += 1
                             src_path = ipath
                             dst_path = path.join(dest_pdfs, i)
                             copyfile(src_path, dst_path)
+                            progress.advance(1, entry.stat().st_size)
                         elif path.splitext(i)[1].lower() == '.xml':
                             xml_found += 1
                             src_path = ipath
                             dst_path = path.join(dest_xmls, i)
                             copyfile(src_path, dst_path)
+                            progress.advance(1, entry.stat().st_size)
         if not suppress == 1:
             messagebox.showinfo(message=f'Found and copied:\n{pdf_found} PDFs\n{xml_found} XMLs')
         return True
@@ -341,17 +358,17 @@ class GetValues:
         if op_sys == 'Windows':
             with open(csv_path, 'w', newline='', encoding='UTF-8') as cfile:
                 cwriter = csv.writer(cfile)
-                for fol in listdir(unzipped_dir):
-                    folpath = path.join(unzipped_dir, fol)
-                    if path.isdir(folpath):
+                for folentry in scan_dir(unzipped_dir):
+                    fol = folentry.name
+                    if folentry.is_dir():
                         diss_filename = 'unknown'
                         extra = 0
-                        for f in listdir(folpath):
-                            fpath = path.join(folpath, f)
+                        for fentry in scan_dir(folentry.path):
+                            f = fentry.name
                             if path.splitext(f)[1].lower() == '.pdf':
                                 diss_filename = f
                                 pdfs_found += 1
-                            elif path.isdir(fpath):
+                            elif fentry.is_dir():
                                 extra += 1
                         if not extra == 0:
                             additional = 'yes'
@@ -363,11 +380,12 @@ class GetValues:
         else:
             with open(csv_path, 'w', encoding='UTF-8') as cfile:
                 cwriter = csv.writer(cfile)
-                for fol in listdir(unzipped_dir):
-                    folpath = path.join(unzipped_dir, fol)
-                    if path.isdir(folpath):
+                for folentry in scan_dir(unzipped_dir):
+                    fol = folentry.name
+                    if folentry.is_dir():
                         diss_filename = 'unknown'
-                        for f in listdir(folpath):
+                        for fentry in scan_dir(folentry.path):
+                            f = fentry.name
                             if path.splitext(f)[1].lower() == '.pdf':
                                 diss_filename = f
                                 pdfs_found += 1
@@ -378,8 +396,7 @@ class GetValues:
             messagebox.showinfo(message=f'Found {pdfs_found} PDF files\nand created {number_rows} rows.')
         return True
 
-    def unzip_ETDs(self, suppress):
-        info = self.get_entries()
+    def unzip_ETDs(self, suppress, info, progress):
         zips_folder = info[0]
         datetime = strftime("%Y%b%d_%H%M%S")
         unzip_folder = path.join(path.dirname(zips_folder), f'{path.basename(zips_folder)}_unzipped{datetime}')
@@ -387,20 +404,31 @@ class GetValues:
             mkdir(unzip_folder)
         except FileExistsError:
             messagebox.showwarning(message='The output folder already exists!\n\nQuitting.')
-            root.quit()
+            return False, unzip_folder
         else:
             unzip_fold = unzip_folder
         zips = 0
         unzips = 0
-        for z in listdir(zips_folder):
-            zip_path = path.join(zips_folder, z)
-            if not path.isdir(zip_path):
+        zip_entries = [zentry for zentry in scan_dir(zips_folder)
+                       if not zentry.is_dir() and path.splitext(zentry.name)[1].lower() == '.zip']
+        # Members are counted by their compressed size, which adds up to the size of the zips
+        progress.start('Unzipping', 0, sum(zentry.stat().st_size for zentry in zip_entries))
+        for zentry in scan_dir(zips_folder):
+            z = zentry.name
+            zip_path = zentry.path
+            if not zentry.is_dir():
                 if path.splitext(z)[1].lower() == '.zip':
                     zips += 1
                     extract_dir = path.join(unzip_folder, path.splitext(z)[0])
                     try:
                         with zipfile.ZipFile(zip_path, 'r') as ex_zip:
-                            ex_zip.extractall(extract_dir)
+                            # One member at a time, so a cancel stops at the next file
+                            for member in ex_zip.infolist():
+                                progress.check()
+                                ex_zip.extract(member, extract_dir)
+                                progress.advance(1, member.compress_size)
+                    except Cancelled:
+                        raise
                     except Exception as e:
                         messagebox.showwarning(message=f'There was an error extracting:\n{z}\nError = {e.message}\n\nSkipping...')
                     else:
@@ -410,41 +438,59 @@ class GetValues:
         return True, unzip_fold
 
     def run_procs(self):
+        """ Starts the selected actions on a worker thread, so the window keeps responding """
+        if self.running is not None:
+            return
+        choices = [self.extractvar.get(), self.csvvar.get(), self.copyvar.get(), self.excelvar.get(),
+                   self.suppressvar.get()]
+        dirs = self.get_entries()
+        self.submit.configure(state=DISABLED)
+        self.running = BackgroundRun(self.root, 'ETD_dcom_loader Progress',
+                                     lambda progress: self.run_actions(choices, dirs, progress), self.actions_done)
+
+    def actions_done(self, quitting, error):
+        """ Back on the main thread once the worker has stopped """
+        self.running = None
+        self.submit.configure(state=NORMAL)
+        if isinstance(error, Cancelled):
+            messagebox.showinfo(message=f'Cancelled.\nThe folder being written\nis incomplete.')
+        elif error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            messagebox.showwarning(message=f'Stopped by an error:\n{error}')
+        elif quitting:
+            self.root.quit()
+
+    def run_actions(self, choices, dirs, progress):
+        """ Runs on the worker thread. Returns True when the window should close """
         successful = False
         unsuccessful = 0
-        unzip_yesno = self.extractvar.get()
-        csv_yesno = self.csvvar.get()
-        copy_yesno = self.copyvar.get()
-        excel_yesno = self.excelvar.get()
-        suppress_yesno = self.suppressvar.get()
-        dirs = self.get_entries()
+        unzip_yesno, csv_yesno, copy_yesno, excel_yesno, suppress_yesno = choices
         unzip_dir = dirs[0]
         if unzip_yesno == 1:
-            successful, unzip_dir = self.unzip_ETDs(suppress_yesno)
+            successful, unzip_dir = self.unzip_ETDs(suppress_yesno, dirs, progress)
             if successful == False:
-                messagebox.showwarning(mesage=f'Something went wrong during\nunzipping. Quitting.')
-                root.quit()
+                messagebox.showwarning(message=f'Something went wrong during\nunzipping. Quitting.')
+                return True
         if csv_yesno == 1:
             successful = self.make_csv_log(unzip_dir, suppress_yesno)
             if successful == False:
-                messagebox.showwarning(mesage=f'Something went wrong during\nCSV logging. Moving on...')
+                messagebox.showwarning(message=f'Something went wrong during\nCSV logging. Moving on...')
                 unsuccessful += 1
         if copy_yesno == 1:
-            successful = self.copy_files(unzip_dir, suppress_yesno)
+            successful = self.copy_files(unzip_dir, suppress_yesno, progress)
             if successful == False:
-                messagebox.showwarning(mesage=f'Something went wrong during\ncopying. Moving on...')
+                messagebox.showwarning(message=f'Something went wrong during\ncopying. Moving on...')
                 unsuccessful += 1
         if excel_yesno == 1:
-            successful = self.make_excel(unzip_dir, suppress_yesno)
+            successful = self.make_excel(unzip_dir, suppress_yesno, dirs, progress)
             if successful == False:
                 messagebox.showwarning(message=f'Something went wrong during\nExcel generation. Quitting')
-                root.quit()
+                return True
         if not unsuccessful == 0:
             messagebox.showwarning(message=f'One or more processes were not successful.\nQuitting')
-            root.quit()
         else:
             messagebox.showinfo(message=f'Done!')
-            root.quit()
+        return True
 
 
 root = tk.Tk()